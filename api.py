@@ -5,8 +5,8 @@ from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional
-from datetime import datetime
+from typing import Optional, List
+from datetime import datetime, timedelta
 from fastapi.staticfiles import StaticFiles
 
 # === ДОДАНО ДЛЯ RATE LIMITING (slowapi) ===
@@ -16,20 +16,24 @@ from slowapi.errors import RateLimitExceeded
 
 # Ініціалізуємо лімітер (відстежує за IP-адресою)
 limiter = Limiter(key_func=get_remote_address)
-import httpx
 import os
 import pytz
-import re
 import urllib.parse
 import logging
 import json
+import random
 
 # Імпорти для Телеграм кнопок
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types.web_app_info import WebAppInfo
 
 import database
-from main import bot, dp, ActivityMiddleware, reminders_loop, finish_events_loop
+from moderation import engine as moderation, minhash
+from categories import classify
+from safety import pipeline as safety, SUSPICIOUS, event_text, text_key
+from fanout import send_many, send_to, broadcast_loop
+from utils import normalize_city, CITY_NAMES
+from main import bot, dp, ActivityMiddleware, reminders_loop, finish_events_loop, stats_rollup_loop, forget_deleted_events
 
 # ==========================================================
 # === СТРУКТУРИ ДАНИХ (MODELS - Валідація вхідних даних) ===
@@ -57,6 +61,7 @@ class EventCreate(BaseModel):
     needed_count: int  
     photo: Optional[str] = None
     is_address_public: bool = False
+    city: Optional[str] = None
 
 class JoinRequest(BaseModel):
     event_id: int
@@ -75,6 +80,15 @@ class UpdateRequestStatus(BaseModel):
     seeker_id: int
     status: str
 
+class RequestDecision(BaseModel):
+    seeker_id: int
+    status: str
+
+class BulkRequestStatus(BaseModel):
+    event_id: int
+    user_id: int
+    decisions: List[RequestDecision]
+
 class LeaveRequest(BaseModel):
     user_id: int
 
@@ -107,6 +121,17 @@ class RatingSubmit(BaseModel):
     score: int
     comment: Optional[str] = ""
 
+class RatingItem(BaseModel):
+    to_user_id: int
+    score: int
+    comment: Optional[str] = ""
+
+class RatingBatchSubmit(BaseModel):
+    event_id: int
+    from_user_id: int
+    role_evaluated: str = 'participant'
+    ratings: List[RatingItem]
+
 class ReportSubmit(BaseModel):
     reporter_id: int
     event_id: int
@@ -127,8 +152,6 @@ async def lifespan(app: FastAPI):
     async with database.db_pool.acquire() as conn:
         try:
             await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT;")
-            # Додаємо колонку для коментарів, якщо її ще немає
-            await conn.execute("ALTER TABLE reviews ADD COLUMN IF NOT EXISTS comment TEXT;")
         except Exception as e:
             print(f"Migration error: {e}")
             pass
@@ -137,9 +160,14 @@ async def lifespan(app: FastAPI):
     dp.message.middleware(ActivityMiddleware())
     dp.callback_query.middleware(ActivityMiddleware())
     
-    # 4. Запускаємо фонові задачі (нагадування та завершення івентів)
+    # 4. Запускаємо фонові задачі (нагадування, завершення івентів, відкладені пуші)
     asyncio.create_task(reminders_loop())
     asyncio.create_task(finish_events_loop())
+    asyncio.create_task(stats_rollup_loop())
+    asyncio.create_task(broadcast_loop(bot))
+    asyncio.create_task(deferred_pushes_loop())
+    asyncio.create_task(moderation_reload_loop())
+    await safety.start(on_safety_verdict)
     
     # 5. Піднімаємо Телеграм-бота (aiogram) паралельно з FastAPI
     print("🤖 Піднімаємо Телеграм-бота...")
@@ -150,6 +178,7 @@ async def lifespan(app: FastAPI):
     
     print("🛑 Вимикаємо сервер, зупиняємо бота...")
     bot_task.cancel()
+    await safety.stop()
 
 # Ініціалізація FastAPI
 app = FastAPI(title="Findsy TMA API", lifespan=lifespan)
@@ -177,25 +206,28 @@ templates = Jinja2Templates(directory="templates")
 # === БЕЗПЕКА, СТОП-СЛОВА ТА ТИХИЙ ЧАС =====================
 # ==========================================================
 
-# База стоп-слів для миттєвої модерації
-STOP_WORDS = [
-    'крипта', 'криптовалюта', 'ставки', 'эскорт', 'спонсор', 'казино', 
-    'наркотики', 'закладк', 'мефедрон', 'шишки', 'бошки', 'трава', 
-    'заработок', 'доход', 'инвестици', 'інвестиці', 'швидкі гроші', 
-    'швидкий заробіток', 'предоплат', 'передплат', 'onlyfans'
-]
-
 def has_links(text: str) -> bool:
     """Жорстка заборона посилань, юзернеймів і доменів у тексті"""
-    if not text: return False
-    pattern = re.compile(r"(https?://|www\.|t\.me/|@[\w]+|\b[\w-]+\.(com|ua|org|net|me|info)\b)", re.IGNORECASE)
-    return bool(pattern.search(text))
+    return moderation.has_links(text)
 
 def has_stop_words(text: str) -> bool:
-    """Миттєва локальна перевірка на підозрілі ключові слова. Працює за 0.001с."""
-    if not text: return False
-    text_lower = text.lower()
-    return any(word in text_lower for word in STOP_WORDS)
+    """Миттєва локальна перевірка на підозрілі ключові слова (скомпільований движок moderation.py)"""
+    return moderation.has_stop_words(text)
+
+async def moderation_reload_loop():
+    """Фоновий процес: підтягує зміни таблиці moderation_terms без рестарту"""
+    current = None
+    while True:
+        if database.db_pool:
+            try:
+                terms = await database.load_moderation_terms()
+                # Перекомпільовуємо лише коли словник справді змінився
+                if terms and terms != current:
+                    moderation.reload(terms)
+                    current = terms
+            except Exception as e:
+                print(f"Помилка в moderation_reload_loop: {e}")
+        await asyncio.sleep(60)
 
 def is_quiet_hours_kyiv() -> bool:
     """Перевіряє, чи зараз ніч у Києві (22:00 - 10:00). Використовується для блокування нічних пушів."""
@@ -207,174 +239,30 @@ def is_quiet_hours_kyiv() -> bool:
         print("Timezone error:", e)
         return False
 
+def city_label(event_dict: dict) -> str:
+    """Назва міста для прихованої адреси: з колонки city, а для старих записів — з першої частини адреси"""
+    key = event_dict.get('city')
+    if key and key in CITY_NAMES: return CITY_NAMES[key]
+    loc = event_dict.get('location')
+    return str(loc).split(',')[0] if loc else ""
+
 def get_category_icon_url(title: str, description: str) -> str:
-    """Повертає посилання на локальні заглушки"""
-    text = f"{title} {description}".lower()
-    
-    if any(w in text for w in [
-        'малюв', 'малюн', 'рисов', 'рису', 'рисун', 'скетч', 'арт',
-        'живопис', 'живопись', 'paint', 'drawing', 'draw'
-    ]):
-        return "img/art_painting.png"
-
-    # Баскетбол
-    if any(w in text for w in [
-        'баскет', 'баскетбол', 'баскетбольн', 'nba', 'стритбол',
-        'мяч', 'мʼяч', 'мячик', 'кільц', 'кольц'
-    ]):
-        return "img/basketball.png"
-
-    # Книжки / читання
-    if any(w in text for w in [
-        'книг', 'книж', 'читан', 'читати', 'читать', 'читаю',
-        'букклуб', 'книжков', 'книжн', 'book', 'books', 'reading'
-    ]):
-        return "img/books.png"
-
-    # Бокс
-    if any(w in text for w in [
-        'бокс', 'боксер', 'boxing', 'перчатк', 'рукавичк', 'груша'
-    ]):
-        return "img/boxing.png"
-
-    # Розмови / чіл / прогулянки
-    if any(w in text for w in [
-        'чил', 'чіл', 'чілінг', 'чилинг', 'розмов', 'разговор',
-        'общен', 'спілкув', 'спілк', 'прогулян', 'прогулк',
-        'гулят', 'гуляти', 'кава', 'кофе', 'чай', 'кафе',
-        'зустріч', 'встреч', 'meetup'
-    ]):
-        return "img/chilling_speaking.png"
-
-    # Кіно
-    if any(w in text for w in [
-        'кіно', 'кино', 'фільм', 'фильм', 'сеанс', 'премʼєр',
-        'премьер', 'кінотеатр', 'кинотеатр', 'cinema', 'movie'
-    ]):
-        return "img/cinema.png"
-
-    # Футбол
-    if any(w in text for w in [
-        'футб', 'футбол', 'soccer', 'football', 'гол', 'ворот',
-        'пенальт', 'матч'
-    ]):
-        return "img/football.png"
-
-    # Караоке
-    if any(w in text for w in [
-        'караок', 'karaoke', 'спів', 'співати', 'петь', 'поем',
-        'пісн', 'песн', 'мікрофон', 'микрофон'
-    ]):
-        return "img/karaoke.png"
-
-    # Мафія
-    if any(w in text for w in [
-        'мафі', 'мафи', 'мафия', 'мафія', 'детектив', 'мирн',
-        'мафию', 'мафію', 'ведуч', 'ведущ', 'дон', 'role card'
-    ]):
-        return "img/mafia.png"
-
-    # Монополія
-    if any(w in text for w in [
-        'монопол', 'monopoly', 'монополь', 'купюри', 'гроші',
-        'деньги', 'власність', 'собственность', 'будиночк',
-        'домик', 'отель', 'кубик', 'кубики'
-    ]):
-        return "img/monopoly.png"
-
-    # Паті / вечірка
-    if any(w in text for w in [
-        'паті', 'пати', 'party', 'вечірк', 'вечеринк', 'туса',
-        'тусовк', 'клуб', 'бар', 'дискотек', 'свят', 'праздн',
-        'день народж', 'день рожд', 'др'
-    ]):
-        return "img/party.png"
-
-    # Пікнік
-    if any(w in text for w in [
-        'пікнік', 'пикник', 'picnic', 'плед', 'корзин',
-        'бутер', 'сендвіч', 'сэндвич', 'закуск', 'їжа на природ',
-        'еда на природ'
-    ]):
-        return "img/picnic.png"
-
-    # Покер
-    if any(w in text for w in [
-        'покер', 'poker', 'блеф', 'блайнд', 'ставк', 'техас',
-        'карти', 'карты', 'фішк', 'фишк'
-    ]):
-        return "img/poker.png"
-
-    # Кальян
-    if any(w in text for w in [
-        'кальян', 'hookah', 'shisha', 'шиша', 'дим', 'дым',
-        'покур', 'покурить', 'smoke', 'smoking'
-    ]):
-        return "img/smoking.png"
-
-    # Більярд / снукер
-    if any(w in text for w in [
-        'більярд', 'бильярд', 'снукер', 'snooker', 'pool',
-        'пул', 'кий', 'шар', 'шары', 'куля', 'кулі'
-    ]):
-        return "img/snooker.png"
-
-    # Настільні ігри
-    if any(w in text for w in [
-        'настол', 'настільн', 'настольн', 'board game', 'boardgame',
-        'table game', 'кубик', 'кубики', 'dice', 'дайс',
-        'фішк', 'фишк', 'карточк', 'картк'
-    ]):
-        return "img/table_games.png"
-
-    # Теніс
-    if any(w in text for w in [
-        'теніс', 'теннис', 'tennis', 'ракетк', 'ракет',
-        'корт', 'подач', 'мяч тен', 'мʼяч тен'
-    ]):
-        return "img/tenis.png"
-
-    # Театр
-    if any(w in text for w in [
-        'театр', 'театральн', 'вистав', 'спектакл',
-        'пʼєс', 'пьес', 'сцен', 'актор', 'актер', 'маск'
-    ]):
-        return "img/theatr.png"
-
-    # Тренування
-    if any(w in text for w in [
-        'тренув', 'тренир', 'тренировка', 'тренування',
-        'зал', 'спортзал', 'фітнес', 'фитнес', 'качалк',
-        'гантел', 'гантелі', 'гантели', 'зарядк',
-        'workout', 'training', 'gym'
-    ]):
-        return "img/training.png"
-
-    # Подорожі
-    if any(w in text for w in [
-        'подорож', 'путешеств', 'мандр', 'мандрув',
-        'trip', 'travel', 'туризм', 'турист', 'похід',
-        'поход', 'гори', 'горы', 'рюкзак', 'валіз', 'чемодан'
-    ]):
-        return "img/trip.png"
-
-    # Дефолт
-    return "img/default.png"
-
-async def check_content_safety(text: str) -> bool:
-    api_key = os.getenv("GEMINI_API_KEY", "")
-    if not api_key: return True 
-    try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-09-2025:generateContent?key={api_key}"
-        prompt = f"Перевір текст на наявність пропозицій ескорту, скаму або продажу наркотиків. Відповідай 'SUSPICIOUS' або 'SAFE'. Текст: {text}"
-        payload = {"contents": [{"parts": [{"text": prompt}]}]}
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, json=payload, timeout=5.0)
-            if resp.status_code == 200:
-                word = resp.json()['candidates'][0]['content']['parts'][0]['text'].strip().upper()
-                if "SUSPICIOUS" in word: return False
-    except Exception as e: print("Gemini check error:", e)
-    return True
+    """Повертає посилання на локальні заглушки (категорію визначає categories.classify)"""
+    return f"img/{classify(title, description)}.png"
+
+async def on_safety_verdict(event_id: int, verdict: str, key: str):
+    """Вердикт AI-перевірки: підозрілий активний івент знімаємо з карти і віддаємо адміну (кнопки mod_approve_/mod_ban_)"""
+    if verdict != SUSPICIOUS or not database.db_pool: return
+    async with database.db_pool.acquire() as conn, conn.transaction():
+        ev = await conn.fetchrow("""
+            SELECT title, description, additional_info, safety_approved_key FROM events WHERE id = $1 AND status = 'active' FOR UPDATE
+        """, event_id)
+        # Вердикт для тексту до редагування або для тексту, який адмін уже схвалив, — не чіпаємо
+        if ev and (key == ev['safety_approved_key'] or key != text_key(event_text(ev['title'], ev['description'], ev['additional_info']))):
+            ev = None
+        if ev: await conn.execute("UPDATE events SET status = 'moderation' WHERE id = $1", event_id)
+    if ev:
+        await notify_admin_moderation(event_id, f"Причина: AI-перевірка (SUSPICIOUS)\nНазва: {ev['title']}\nОпис: {ev['description']}")
 
 async def notify_admin_moderation(event_id: int, text: str):
     """Надсилає адміну повідомлення в ТГ про івент, який потрапив у карантин"""
@@ -388,7 +276,7 @@ async def notify_admin_moderation(event_id: int, text: str):
         safe_text = str(text).replace('<', '&lt;').replace('>', '&gt;')
         await bot.send_message(
             chat_id=int(admin_id), 
-            text=f"🚨 <b>Івент затримано локальним фільтром стоп-слів!</b>\n\n{safe_text}", 
+            text=f"🚨 <b>Івент затримано на модерацію!</b>\n\n{safe_text}", 
             parse_mode="HTML", 
             reply_markup=markup
         )
@@ -455,27 +343,29 @@ async def get_profile(user_id: int):
     """Отримання даних профілю користувача"""
     if not database.db_pool: return {"success": False}
     async with database.db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id = $1", user_id)
-        if user:
-            org_count = await conn.fetchval("SELECT COUNT(*) FROM events WHERE user_id = $1", user_id)
-            part_count = await conn.fetchval("SELECT COUNT(*) FROM requests WHERE seeker_id = $1 AND status = 'approved'", user_id)
-            
-            return {
-                "success": True, 
-                "photo": user.get('photo'), 
-                "name": user.get('name'), 
-                "city": user.get('city'),            
-                "bio": user.get('bio'), 
-                "interests": user.get('interests'),
-                "events_organized": org_count or 0,
-                "events_joined": part_count or 0,
-                "rating_org": float(user.get('rating_org', 5.0)),
-                "votes_org": user.get('votes_org', 0),
-                "rating_part": float(user.get('rating_part', 5.0)),
-                "votes_part": user.get('votes_part', 0),
-                "status": user.get('status', 'active')
-            }
-        return {"success": False}
+        # Лічильники ведуться тригерами в user_stats — PK-джойн замість двох COUNT
+        user = await conn.fetchrow(f"SELECT {_PROFILE_COLUMNS} FROM users u LEFT JOIN user_stats s ON s.user_id = u.telegram_id WHERE u.telegram_id = $1", user_id)
+        return _profile_payload(user) if user else {"success": False}
+
+_PROFILE_COLUMNS = """u.photo, u.name, u.city, u.bio, u.interests, u.rating_org, u.votes_org, u.rating_part, u.votes_part, u.status,
+    COALESCE(s.events_organized, 0) AS events_organized, COALESCE(s.events_joined, 0) AS events_joined"""
+
+def _profile_payload(user) -> dict:
+    return {
+        "success": True, 
+        "photo": user.get('photo'), 
+        "name": user.get('name'), 
+        "city": user.get('city'),            
+        "bio": user.get('bio'), 
+        "interests": user.get('interests'),
+        "events_organized": user['events_organized'],
+        "events_joined": user['events_joined'],
+        "rating_org": float(user.get('rating_org') or 5.0),
+        "votes_org": user.get('votes_org') or 0,
+        "rating_part": float(user.get('rating_part') or 5.0),
+        "votes_part": user.get('votes_part') or 0,
+        "status": user.get('status') or 'active'
+    }
 
 @app.post("/api/profile/update")
 async def update_profile(data: ProfileUpdate):
@@ -501,6 +391,9 @@ async def update_profile(data: ProfileUpdate):
             print(f"Помилка оновлення профілю: {e}")
             raise HTTPException(status_code=500, detail=str(e))
 
+# Ліміти на створення івентів за період; понад ліміт — на ручну модерацію (ключі з database.EVENT_QUOTA_PERIODS)
+EVENT_QUOTA_LIMITS = {"month": 10}
+
 @app.post("/api/events/create")
 @limiter.limit("20/minute") 
 async def create_event(event: EventCreate, request: Request):
@@ -508,9 +401,9 @@ async def create_event(event: EventCreate, request: Request):
     if not database.db_pool:
         raise HTTPException(status_code=500, detail="База даних не підключена")
         
-    # 1. Жорсткий блок посилань
-    full_text = f"{event.title} {event.description} {event.additional_info} {event.location}"
-    if has_links(full_text):
+    # 1. Жорсткий блок посилань (і заодно стоп-слова — один прохід по тексту)
+    mod = moderation.check(event.title, event.description, event.additional_info, event.location)
+    if mod.links:
         return {"success": False, "error": "links_not_allowed"}
         
     async with database.db_pool.acquire() as conn:
@@ -523,37 +416,56 @@ async def create_event(event: EventCreate, request: Request):
         u_status = await conn.fetchval("SELECT status FROM users WHERE telegram_id = $1", event.user_id)
         if u_status == 'blocked': return {"success": False, "error": "blocked"}
 
-        # 2. Перевірка на місячний ліміт організатора (макс 10 активних без перевірки)
-        monthly_count = await database.get_user_monthly_count(event.user_id)
-        limit_exceeded = monthly_count >= 10
+        # 2. Перевірка лімітів організатора (понад ліміт — на модерацію)
+        quota = await database.get_user_quota_counts(event.user_id, conn)
+        limit_exceeded = any(quota[p] >= lim for p, lim in EVENT_QUOTA_LIMITS.items())
 
         # 3. Локальна модерація стоп-слів (швидка)
-        has_bad_words = has_stop_words(full_text)
+        has_bad_words = mod.flagged
+
+        # 4. Майже-дублікат свіжого івенту (свого чи чужого) — типовий спам-репост з дрібними правками
+        signature = minhash(event.title, event.description)
+        duplicate = await database.find_near_duplicate(conn, signature)
         
-        # Якщо є стоп-слова АБО перевищено ліміт 10 івентів/місяць -> відправляємо на модерацію
-        status = 'moderation' if (has_bad_words or limit_exceeded) else 'active'
+        # Якщо є стоп-слова, ліміт 10 івентів/місяць АБО дублікат -> відправляємо на модерацію
+        status = 'moderation' if (has_bad_words or limit_exceeded or duplicate) else 'active'
 
-        # 4. Підбір обкладинки без зависань
+        # 5. Підбір обкладинки без зависань
         if not event.photo or event.photo.strip() == "":
             event.photo = get_category_icon_url(event.title, event.description)
             
+        # Нормалізоване місто (з селекту форми, або з адреси "Київ, ...")
+        city_key = normalize_city(event.city) or normalize_city(event.location)
+            
         try:
             event_id = await conn.fetchval("""
                 INSERT INTO events (
                     user_id, creator_name, title, description, additional_info, 
                     date, location, location_lat, location_lon, 
-                    capacity, needed_count, status, photo, is_address_public, created_at
+                    capacity, needed_count, status, photo, is_address_public, city, created_at
                 ) VALUES (
-                    $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, NOW()
+                    $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, NOW()
                 ) RETURNING id
             """, 
             event.user_id, event.creator_name, event.title, event.description, event.additional_info, 
             event.date, event.location, event.location_lat, event.location_lon,
-            event.capacity, event.needed_count, status, event.photo, event.is_address_public)
+            event.capacity, event.needed_count, status, event.photo, event.is_address_public, city_key)
             
-            # 5. Якщо затримано фільтром (слова або ліміт) — кидаємо алерт адміну
+            await database.save_event_minhash(conn, event_id, signature)
+
+            # 6. AI-перевірка у фоні: публікація не чекає на модель
+            safety.submit(event_id, event_text(event.title, event.description, event.additional_info))
+
+            # 7. Якщо затримано фільтром (слова, ліміт або дублікат) — кидаємо алерт адміну
             if status == 'moderation':
-                reason_str = "Перевищено місячний ліміт (11+ івент)" if limit_exceeded else "Спрацював фільтр стоп-слів"
+                reasons = []
+                if limit_exceeded: reasons.append("Перевищено місячний ліміт (11+ івент)")
+                if has_bad_words: reasons.append(f"Спрацював фільтр стоп-слів: {', '.join(mod.matches)}")
+                if duplicate:
+                    dup_id, dup_owner, sim = duplicate
+                    whose = "того ж автора" if dup_owner == event.user_id else f"іншого автора ({dup_owner})"
+                    reasons.append(f"Майже-дублікат івенту #{dup_id} {whose}, схожість {sim:.0%}")
+                reason_str = "; ".join(reasons)
                 asyncio.create_task(notify_admin_moderation(
                     event_id, 
                     f"Причина: {reason_str}\nНазва: {event.title}\nОпис: {event.description}"
@@ -565,36 +477,44 @@ async def create_event(event: EventCreate, request: Request):
             raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/events")
-async def get_events(user_id: int = 0):
-    """Повертає список активних івентів для карти. Відсікає ті, куди юзер вже подав заявку, зібрані події та ті, що вже почалися."""
+async def get_events(user_id: int = 0, city: str = ""):
+    """Повертає список активних івентів для карти. Відсікає ті, куди юзер вже подав заявку, зібрані події та ті, що вже почалися.
+    Якщо передано city — віддає стрічку одного міста (індекс по (city, date))."""
     if not database.db_pool:
         raise HTTPException(status_code=500, detail="База даних не підключена")
+    city_key = normalize_city(city) if city else None
+    # Невідоме місто — порожня стрічка, а не тихо всі міста
+    if city and not city_key: return []
     async with database.db_pool.acquire() as conn:
         try:
             if user_id > 0:
-                mine = await conn.fetch("""
-                    SELECT id, user_id, title, description, date, location, location_lat, location_lon, capacity, needed_count, photo, creator_name, is_address_public 
+                city_sql = " AND city = $2" if city_key else ""
+                args = [user_id, city_key] if city_key else [user_id]
+                mine = await conn.fetch(f"""
+                    SELECT id, user_id, title, description, date, location, city, location_lat, location_lon, capacity, needed_count, photo, creator_name, is_address_public 
                     FROM events 
-                    WHERE status = 'active' AND needed_count > 0 AND date >= NOW() AND user_id = $1
+                    WHERE status = 'active' AND needed_count > 0 AND date >= NOW() AND user_id = $1{city_sql}
                     ORDER BY created_at DESC
-                """, user_id)
+                """, *args)
 
-                others = await conn.fetch("""
-                    SELECT id, user_id, title, description, date, location, location_lat, location_lon, capacity, needed_count, photo, creator_name, is_address_public 
+                others = await conn.fetch(f"""
+                    SELECT id, user_id, title, description, date, location, city, location_lat, location_lon, capacity, needed_count, photo, creator_name, is_address_public 
                     FROM events 
-                    WHERE status = 'active' AND needed_count > 0 AND date >= NOW() AND user_id != $1
+                    WHERE status = 'active' AND needed_count > 0 AND date >= NOW() AND user_id != $1{city_sql}
                     AND id NOT IN (SELECT event_id FROM requests WHERE seeker_id = $1)
                     ORDER BY created_at DESC
-                """, user_id)
+                """, *args)
 
                 rows = list(mine) + list(others)
             else:
-                rows = await conn.fetch("""
-                    SELECT id, user_id, title, description, date, location, location_lat, location_lon, capacity, needed_count, photo, creator_name, is_address_public 
+                city_sql = " AND city = $1" if city_key else ""
+                args = [city_key] if city_key else []
+                rows = await conn.fetch(f"""
+                    SELECT id, user_id, title, description, date, location, city, location_lat, location_lon, capacity, needed_count, photo, creator_name, is_address_public 
                     FROM events 
-                    WHERE status = 'active' AND needed_count > 0 AND date >= NOW()
+                    WHERE status = 'active' AND needed_count > 0 AND date >= NOW(){city_sql}
                     ORDER BY created_at DESC
-                """)
+                """, *args)
             
             events_list = []
             for row in rows:
@@ -604,8 +524,7 @@ async def get_events(user_id: int = 0):
                 
                 # Приховуємо точну адресу, якщо вона не публічна
                 if not event_dict.get('is_address_public'):
-                    city = event_dict['location'].split(',')[0]
-                    event_dict['location'] = f"{city} (Точна адреса після підтвердження)"
+                    event_dict['location'] = f"{city_label(event_dict)} (Точна адреса після підтвердження)"
                     
                 events_list.append(event_dict)
             return events_list
@@ -620,42 +539,80 @@ async def get_single_event(event_id: int, user_id: int = 0):
         raise HTTPException(status_code=500, detail="БД не підключена")
     async with database.db_pool.acquire() as conn:
         try:
-            row = await conn.fetchrow("""
-                SELECT e.*, u.username as creator_username 
-                FROM events e 
-                LEFT JOIN users u ON e.user_id = u.telegram_id 
-                WHERE e.id = $1
-            """, event_id)
-            if not row:
-                raise HTTPException(status_code=404, detail="Івент не знайдено")
-            
-            event_dict = dict(row)
-            if event_dict.get('date'):
-                event_dict['date'] = event_dict['date'].isoformat()
-            if event_dict.get('created_at'):
-                event_dict['created_at'] = event_dict['created_at'].isoformat()
-                
-            if user_id > 0:
-                req = await conn.fetchrow("SELECT status FROM requests WHERE event_id = $1 AND seeker_id = $2", event_id, user_id)
-                if req:
-                    event_dict['my_request_status'] = req['status']
-            
-            is_owner = (user_id == event_dict['user_id'])
-            is_approved = (event_dict.get('my_request_status') == 'approved')
-            
-            # БЕЗПЕЧНЕ ПРИХОВУВАННЯ ЛОКАЦІЇ
-            if not event_dict.get('is_address_public') and not is_owner and not is_approved:
-                loc = event_dict.get('location')
-                if loc:
-                    city = str(loc).split(',')[0]
-                    event_dict['location'] = f"{city} (Точна адреса після підтвердження)"
-                else:
-                    event_dict['location'] = "Точна адреса після підтвердження"
-                    
-            return event_dict
+            return await _event_payload(conn, event_id, user_id)
+        except HTTPException: raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/events/{event_id}/details")
+async def get_event_details(event_id: int, user_id: int = 0):
+    """Все для Details_of_event.html одним запитом: івент (+ статус заявки глядача), профіль організатора, учасники.
+    Три частини залежать лише від event_id, тож ідуть паралельно на окремих з'єднаннях пулу"""
+    if not database.db_pool:
+        raise HTTPException(status_code=500, detail="БД не підключена")
+
+    async def on_conn(fn, *args):
+        async with database.db_pool.acquire() as conn: return await fn(conn, *args)
+
+    try:
+        event, org, participants = await asyncio.gather(
+            on_conn(_event_payload, event_id, user_id),
+            on_conn(lambda conn: conn.fetchrow(f"""
+                SELECT {_PROFILE_COLUMNS} FROM events e
+                JOIN users u ON u.telegram_id = e.user_id LEFT JOIN user_stats s ON s.user_id = e.user_id
+                WHERE e.id = $1
+            """, event_id)),
+            on_conn(_approved_participants, event_id))
+    except HTTPException: raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"event": event, "orgData": _profile_payload(org) if org else {"success": False}, "participants": participants}
+
+async def _event_payload(conn, event_id: int, user_id: int) -> dict:
+    """Івент для показу глядачу user_id: статус його заявки/місце в черзі, адреса прихована до підтвердження"""
+    row = await conn.fetchrow("""
+        SELECT e.*, u.username as creator_username 
+        FROM events e 
+        LEFT JOIN users u ON e.user_id = u.telegram_id 
+        WHERE e.id = $1
+    """, event_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Івент не знайдено")
+
+    event_dict = dict(row)
+    event_dict.pop('minhash', None)  # службовий підпис для пошуку дублікатів, фронту не потрібен
+    if event_dict.get('date'):
+        event_dict['date'] = event_dict['date'].isoformat()
+    if event_dict.get('created_at'):
+        event_dict['created_at'] = event_dict['created_at'].isoformat()
+
+    if user_id > 0:
+        # Позиція в черзі рахується по індексу (event_id, status, created_at)
+        req = await conn.fetchrow("""
+            SELECT me.status,
+                   CASE WHEN me.status = 'waitlist' THEN (
+                       SELECT COUNT(*) FROM requests w
+                       WHERE w.event_id = me.event_id AND w.status = 'waitlist' AND (w.created_at, w.id) <= (me.created_at, me.id)
+                   ) END AS position
+            FROM requests me WHERE me.event_id = $1 AND me.seeker_id = $2
+        """, event_id, user_id)
+        if req:
+            event_dict['my_request_status'] = req['status']
+            if req['position']:
+                event_dict['my_waitlist_position'] = req['position']
+
+    is_owner = (user_id == event_dict['user_id'])
+    is_approved = (event_dict.get('my_request_status') == 'approved')
+
+    # БЕЗПЕЧНЕ ПРИХОВУВАННЯ ЛОКАЦІЇ
+    if not event_dict.get('is_address_public') and not is_owner and not is_approved:
+        if event_dict.get('location') or event_dict.get('city'):
+            event_dict['location'] = f"{city_label(event_dict)} (Точна адреса після підтвердження)"
+        else:
+            event_dict['location'] = "Точна адреса після підтвердження"
+
+    return event_dict
+
 # ==========================================================
 # === ФОНОВІ ФУНКЦІЇ ПУШІВ (ТЕЛЕГРАМ СПОВІЩЕННЯ) ===========
 # ==========================================================
@@ -670,54 +627,121 @@ async def send_event_approved_push(event_id: int):
             if event:
                 safe_title = str(event['title']).replace('<', '&lt;').replace('>', '&gt;')
                 msg = f"🎉 <b>Івент опубліковано!</b>\n\nВаша подія «{safe_title}» успішно пройшла модерацію та вже відображається на карті для всіх користувачів!"
-                await bot.send_message(chat_id=event['user_id'], text=msg, parse_mode="HTML")
+                await send_to(bot, event['user_id'], msg, parse_mode="HTML")
     except Exception as e:
         print(f"Помилка пуша схвалення модерацією: {e}")
 
+# === ДАЙДЖЕСТ НОВИХ ЗАЯВОК ДЛЯ ОРГАНІЗАТОРА ===
+# Заявки збираються в буфер по організатору і йдуть одним повідомленням раз на вікно.
+# У тихий час заявки йдуть у чергу відкладених пушів (deferred_pushes) і приходять зранку.
+REQUEST_DIGEST_WINDOW = int(os.getenv("REQUEST_DIGEST_WINDOW", "60"))
+_request_digest: dict[int, dict[int, list[int]]] = {}   # organizer_id -> {event_id: [seeker_id, ...]}
+_request_digest_tasks: dict[int, asyncio.Task] = {}
+
+# === ВІДКЛАДЕНІ ПУШІ (замість втрати в тихий час) ===
+# Ранковий випуск розмазуємо по вікну, щоб не впертися в ліміти Bot API
+DEFERRED_PUSH_SPREAD = int(os.getenv("DEFERRED_PUSH_SPREAD", "1800"))
+DEFERRED_PUSH_RATE = int(os.getenv("DEFERRED_PUSH_RATE", "20"))  # повідомлень на секунду
+# Типи, які чекають кінця тихого часу ('finish_rate' з тієї ж таблиці шле finish_events_loop без паузи)
+DEFERRED_KINDS = ['new_request', 'rejected', 'event_full_org', 'event_full']
+
+def seconds_until_quiet_end() -> float:
+    """Скільки секунд лишилось до 10:00 за Києвом (0, якщо зараз не тихий час)"""
+    if not is_quiet_hours_kyiv(): return 0
+    tz = pytz.timezone('Europe/Kiev')
+    now = datetime.now(tz)
+    wake = now.replace(hour=10, minute=0, second=0, microsecond=0)
+    if now.hour >= 22: wake += timedelta(days=1)
+    return (wake - now).total_seconds()
+
+def quiet_release_at() -> datetime:
+    """Коли випустити відкладений пуш: 10:00 за Києвом + випадковий зсув у межах DEFERRED_PUSH_SPREAD"""
+    return datetime.now(pytz.utc) + timedelta(seconds=seconds_until_quiet_end() + random.uniform(0, DEFERRED_PUSH_SPREAD))
+
+def _html(t) -> str:
+    return str(t).replace('<', '&lt;').replace('>', '&gt;')
+
+def _new_requests_text(counts: dict[int, int], titles: dict[int, str], seeker_name: str | None = None) -> str:
+    """Текст дайджесту: counts = {event_id: скільки заявок}"""
+    total = sum(counts.values())
+    if total == 1 and seeker_name:
+        msg = f"🔔 <b>Нова заявка!</b>\n\n<b>{_html(seeker_name)}</b> хоче долучитися до «{_html(titles.get(next(iter(counts)), ''))}».\n\n"
+    else:
+        if total % 10 == 1 and total % 100 != 11: word = "нова заявка"
+        elif total % 10 in (2, 3, 4) and total % 100 not in (12, 13, 14): word = "нові заявки"
+        else: word = "нових заявок"
+        if len(counts) == 1:
+            msg = f"🔔 <b>{total} {word}</b> на «{_html(titles.get(next(iter(counts)), ''))}»!\n\n"
+        else:
+            lines = "\n".join(f"• {n} — «{_html(titles.get(eid, ''))}»" for eid, n in counts.items())
+            msg = f"🔔 <b>{total} {word}</b>\n\n{lines}\n\n"
+    return msg + "Відкрий додаток (розділ «Івенти»), щоб переглянути деталі та прийняти рішення."
+
+def _open_app_markup() -> InlineKeyboardMarkup:
+    domain = os.getenv("RAILWAY_PUBLIC_DOMAIN", "worker-production-784c.up.railway.app")
+    clean_domain = domain.replace("https://", "").replace("http://", "").strip("/")
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📱 Відкрити Findsy", web_app=WebAppInfo(url=f"https://{clean_domain}/"))]
+    ])
+
+def _rejected_text(title: str) -> str:
+    return f"😔 *Заявку відхилено*\n\nНа жаль, організатор івенту «_{title}_» не зміг прийняти твою заявку. Не засмучуйся, поруч є ще багато цікавого!"
+
+def _event_full_org_text(title: str) -> str:
+    return f"🥳 *Бінго!*\n\nТвій івент «_{title}_» повністю зібрано! Всі місця зайняті. Перейди в чати з учасниками, щоб обговорити останні деталі."
+
+def _event_full_part_text(title: str) -> str:
+    return f"🔥 *Компанія зібрана!*\n\nІвент «_{title}_» повністю укомплектований! Готуйся до крутого двіжу. Не забудь перевірити чат з організатором."
+
 async def send_new_request_push(event_id: int, seeker_id: int):
-    """Пуш організатору про нову заявку (з перевіркою на тихий час)"""
-    await asyncio.sleep(1) 
+    """Кладе заявку в дайджест організатора і планує відправку, якщо її ще немає"""
     if not database.db_pool: return
-    
-    # 🌙 ПЕРЕВІРКА НА ТИХИЙ ЧАС
-    if is_quiet_hours_kyiv():
-        print(f"[PUSH] 🌙 Тихий час (22:00-10:00). Пуш організатору скасовано.")
-        return
-
     try:
-        from main import bot
-        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-        from aiogram.types.web_app_info import WebAppInfo
+        async with database.db_pool.acquire() as conn:
+            org_id = await conn.fetchval("SELECT user_id FROM events WHERE id = $1", event_id)
+        if not org_id: return
+        if is_quiet_hours_kyiv():
+            await database.defer_push(org_id, event_id, 'new_request', quiet_release_at())
+            return
+        _request_digest.setdefault(org_id, {}).setdefault(event_id, []).append(seeker_id)
+        if org_id not in _request_digest_tasks:
+            _request_digest_tasks[org_id] = asyncio.create_task(_flush_request_digest(org_id, REQUEST_DIGEST_WINDOW))
+    except Exception as e:
+        print(f"Помилка пуша: {e}")
 
-        domain = os.getenv("RAILWAY_PUBLIC_DOMAIN", "worker-production-784c.up.railway.app")
-        clean_domain = domain.replace("https://", "").replace("http://", "").strip("/")
+async def _flush_request_digest(org_id: int, delay: float):
+    """Відправляє організатору одне повідомлення на всі заявки, що накопичились за вікно"""
+    await asyncio.sleep(delay)
+    _request_digest_tasks.pop(org_id, None)
+    pending = _request_digest.pop(org_id, None)
+    if not pending: return
+    try:
+        # Вікно закрилось вже в тихий час — переносимо на ранок
+        if is_quiet_hours_kyiv():
+            release_at = quiet_release_at()
+            for eid, ids in pending.items():
+                await database.defer_push(org_id, eid, 'new_request', release_at, len(ids))
+            return
 
         async with database.db_pool.acquire() as conn:
-            event = await conn.fetchrow("SELECT title, user_id FROM events WHERE id = $1", event_id)
-            seeker = await conn.fetchrow("SELECT name FROM users WHERE telegram_id = $1", seeker_id)
-            
-            if event and seeker:
-                safe_name = str(seeker['name'] or 'Хтось').replace('<', '&lt;').replace('>', '&gt;')
-                safe_title = str(event['title']).replace('<', '&lt;').replace('>', '&gt;')
-                
-                msg = (f"🔔 <b>Нова заявка!</b>\n\n"
-                       f"<b>{safe_name}</b> хоче долучитися до «{safe_title}».\n\n"
-                       f"Відкрий додаток (розділ «Івенти»), щоб переглянути деталі та прийняти рішення.")
-                
-                markup = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="📱 Відкрити Findsy", web_app=WebAppInfo(url=f"https://{clean_domain}/"))]
-                ])
-                
-                await bot.send_message(chat_id=event['user_id'], text=msg, parse_mode="HTML", reply_markup=markup)
-    except Exception as e: 
-        print(f"Помилка пуша: {e}")
+            titles = {r['id']: r['title'] for r in await conn.fetch("SELECT id, title FROM events WHERE id = ANY($1::int[])", list(pending))}
+            first_seeker = next(iter(pending.values()))[0]
+            seeker_name = await conn.fetchval("SELECT name FROM users WHERE telegram_id = $1", first_seeker)
+
+        msg = _new_requests_text({eid: len(ids) for eid, ids in pending.items()}, titles, seeker_name or 'Хтось')
+        await send_to(bot, org_id, msg, parse_mode="HTML", reply_markup=_open_app_markup())
+    except Exception as e:
+        print(f"Помилка пуша дайджесту заявок: {e}")
 
 async def send_decision_push(event_id: int, seeker_id: int, status: str):
     """Пуш учаснику про рішення організатора"""
     await asyncio.sleep(1)
     
-    # Відмову вночі не пушимо, щоб не засмучувати. Схвалення пушимо завжди.
+    # Відмову вночі не пушимо, щоб не засмучувати, а відкладаємо до ранку. Схвалення пушимо завжди.
     if is_quiet_hours_kyiv() and status != 'approved':
+        if status == 'rejected':
+            try: await database.defer_push(seeker_id, event_id, 'rejected', quiet_release_at())
+            except Exception as e: print(f"Помилка відкладення пуша: {e}")
         return
 
     try:
@@ -729,73 +753,135 @@ async def send_decision_push(event_id: int, seeker_id: int, status: str):
                     if event.get('additional_info'):
                         msg += f"\n\n🔐 *Секретна інфа:*\n_{event['additional_info']}_"
                     markup = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💬 Написати організатору", url=f"tg://user?id={event['user_id']}")]])
-                    await bot.send_message(chat_id=seeker_id, text=msg, parse_mode="Markdown", reply_markup=markup)
+                    await send_to(bot, seeker_id, msg, parse_mode="Markdown", reply_markup=markup)
                 elif status == 'rejected':
-                    msg = f"😔 *Заявку відхилено*\n\nНа жаль, організатор івенту «_{event['title']}_» не зміг прийняти твою заявку. Не засмучуйся, поруч є ще багато цікавого!"
-                    await bot.send_message(chat_id=seeker_id, text=msg, parse_mode="Markdown")
+                    await send_to(bot, seeker_id, _rejected_text(event['title']), parse_mode="Markdown")
     except Exception as e: print(f"Помилка пуша рішення: {e}")
 
+async def send_bulk_decision_pushes(event_id: int, approved: list, rejected: list):
+    """Пуші учасникам після пакетного рішення: один запит за івентом, далі розсилка"""
+    await asyncio.sleep(1)
+    try:
+        # Як і в send_decision_push: відмови вночі відкладаємо до ранку
+        if is_quiet_hours_kyiv() and rejected:
+            release_at = quiet_release_at()
+            for seeker_id in rejected:
+                await database.defer_push(seeker_id, event_id, 'rejected', release_at)
+            rejected = []
+        if not approved and not rejected: return
+        async with database.db_pool.acquire() as conn:
+            event = await conn.fetchrow("SELECT title, location, additional_info, user_id FROM events WHERE id = $1", event_id)
+        if not event: return
+        ok_msg = f"🎉 *Заявку прийнято!*\n\nОрганізатор додав тебе до івенту «_{event['title']}_».\n\n📍 *Точна адреса:*\n{event['location']}"
+        if event.get('additional_info'):
+            ok_msg += f"\n\n🔐 *Секретна інфа:*\n_{event['additional_info']}_"
+        markup = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💬 Написати організатору", url=f"tg://user?id={event['user_id']}")]])
+        no_msg = _rejected_text(event['title'])
+        await asyncio.gather(send_many(bot, approved, ok_msg, parse_mode="Markdown", reply_markup=markup),
+                             send_many(bot, rejected, no_msg, parse_mode="Markdown"))
+    except Exception as e: print(f"Помилка пакетних пушів рішень: {e}")
+
+# Схвалені учасники, до яких пуші ще доходять (див. users.reachable)
+_REACHABLE_APPROVED_SQL = """
+    SELECT r.seeker_id FROM requests r JOIN users u ON u.telegram_id::text = r.seeker_id::text
+    WHERE r.event_id = $1 AND r.status = 'approved' AND u.reachable
+"""
+
 async def send_event_full_push(event_id: int):
     """Пуш всім, коли івент повністю зібрав компанію"""
     await asyncio.sleep(1)
-    if is_quiet_hours_kyiv(): return
     try:
         async with database.db_pool.acquire() as conn:
             event = await conn.fetchrow("SELECT title, user_id FROM events WHERE id = $1", event_id)
             if not event: return
-            
-            # 1. Пуш Організатору
-            org_msg = f"🥳 *Бінго!*\n\nТвій івент «_{event['title']}_» повністю зібрано! Всі місця зайняті. Перейди в чати з учасниками, щоб обговорити останні деталі."
-            try: await bot.send_message(chat_id=event['user_id'], text=org_msg, parse_mode="Markdown")
-            except Exception as e: print(f"Не вийшло пушнути оргу: {e}")
-            
-            # 2. Пуш Учасникам
-            participants = await conn.fetch("SELECT seeker_id FROM requests WHERE event_id = $1 AND status = 'approved'", event_id)
-            part_msg = f"🔥 *Компанія зібрана!*\n\nІвент «_{event['title']}_» повністю укомплектований! Готуйся до крутого двіжу. Не забудь перевірити чат з організатором."
+            participants = await conn.fetch(_REACHABLE_APPROVED_SQL, event_id)
+
+        # Вночі — в чергу до ранку
+        if is_quiet_hours_kyiv():
+            release_at = quiet_release_at()
+            await database.defer_push(event['user_id'], event_id, 'event_full_org', release_at)
             for p in participants:
-                try: await bot.send_message(chat_id=p['seeker_id'], text=part_msg, parse_mode="Markdown")
-                except: pass
+                await database.defer_push(p['seeker_id'], event_id, 'event_full', release_at)
+            return
+
+        # 1. Пуш Організатору
+        await send_to(bot, event['user_id'], _event_full_org_text(event['title']), parse_mode="Markdown")
+
+        # 2. Пуш Учасникам
+        await send_many(bot, [p['seeker_id'] for p in participants], _event_full_part_text(event['title']), parse_mode="Markdown")
     except Exception as e:
         print(f"Помилка пуша про повний збір: {e}")
 
-async def send_participant_left_push(event_id: int, seeker_id: int):
+async def deferred_pushes_loop():
+    """Випускає відкладені пуші після тихого часу, не швидше DEFERRED_PUSH_RATE повідомлень на секунду"""
+    while True:
+        try:
+            rows = [] if is_quiet_hours_kyiv() else await database.claim_deferred_pushes(DEFERRED_PUSH_RATE, DEFERRED_KINDS)
+            if rows:
+                async with database.db_pool.acquire() as conn:
+                    titles = {r['id']: r['title'] for r in await conn.fetch(
+                        "SELECT id, title FROM events WHERE id = ANY($1::int[])", list({r['event_id'] for r in rows}))}
+                # Заявки одному організатору з однієї пачки зливаємо в один дайджест
+                digests: dict[int, list] = {}
+                for r in rows:
+                    if r['kind'] == 'new_request':
+                        digests.setdefault(r['recipient_id'], []).append(r)
+                        continue
+                    title = titles.get(r['event_id'])
+                    if title:
+                        text = {'rejected': _rejected_text, 'event_full_org': _event_full_org_text, 'event_full': _event_full_part_text}[r['kind']](title)
+                        await send_to(bot, r['recipient_id'], text, parse_mode="Markdown")
+                        await asyncio.sleep(1 / DEFERRED_PUSH_RATE)
+                    # Кожен рядок видаляємо одразу після відправки: падіння посеред пачки не губить решту
+                    await database.done_deferred_pushes([r])
+                for org_id, org_rows in digests.items():
+                    counts = {r['event_id']: r['count'] for r in org_rows}
+                    await send_to(bot, org_id, _new_requests_text(counts, titles), parse_mode="HTML", reply_markup=_open_app_markup())
+                    await database.done_deferred_pushes(org_rows)
+                    await asyncio.sleep(1 / DEFERRED_PUSH_RATE)
+            await asyncio.sleep(1 if rows else 30)
+        except Exception as e:
+            print(f"Помилка в deferred_pushes_loop: {e}")
+            await asyncio.sleep(30)
+
+async def send_participant_left_push(event_id: int, seeker_id: int, promoted_id: int | None = None):
     try:
         async with database.db_pool.acquire() as conn:
             event = await conn.fetchrow("SELECT title, user_id FROM events WHERE id = $1", event_id)
             seeker = await conn.fetchrow("SELECT name FROM users WHERE telegram_id = $1", seeker_id)
             if event and seeker:
-                msg = f"⚠️ *Зміни в івенті*\n\nУчасник *{seeker['name']}* покинув твій івент «_{event['title']}_». Місце знову стало вільним."
-                await bot.send_message(chat_id=event['user_id'], text=msg, parse_mode="Markdown")
+                seat_text = "Місце знову стало вільним." if not promoted_id else "Місце автоматично отримав перший з листа очікування."
+                msg = f"⚠️ *Зміни в івенті*\n\nУчасник *{seeker['name']}* покинув твій івент «_{event['title']}_». {seat_text}"
+                await send_to(bot, event['user_id'], msg, parse_mode="Markdown")
     except Exception as e: print(f"Помилка пуша виходу: {e}")
 
+async def _approved_recipients(event_id: int):
+    """Назва івенту і схвалені учасники; з'єднання повертається в пул до початку розсилки"""
+    async with database.db_pool.acquire() as conn:
+        event = await conn.fetchrow("SELECT title FROM events WHERE id = $1", event_id)
+        seekers = await conn.fetch(_REACHABLE_APPROVED_SQL, event_id)
+    return event, [r['seeker_id'] for r in seekers]
+
 async def send_event_deleted_push(event_id: int):
     try:
-        async with database.db_pool.acquire() as conn:
-            event = await conn.fetchrow("SELECT title FROM events WHERE id = $1", event_id)
-            seekers = await conn.fetch("SELECT seeker_id FROM requests WHERE event_id = $1 AND status = 'approved'", event_id)
-            if event:
-                for row in seekers:
-                    msg = f"❌ *Івент скасовано*\n\nОрганізатор видалив івент «_{event['title']}_». Плани змінюються, але попереду ще багато двіжу!"
-                    try: await bot.send_message(chat_id=row['seeker_id'], text=msg, parse_mode="Markdown")
-                    except: pass
+        event, seekers = await _approved_recipients(event_id)
+        if event:
+            msg = f"❌ *Івент скасовано*\n\nОрганізатор видалив івент «_{event['title']}_». Плани змінюються, але попереду ще багато двіжу!"
+            await send_many(bot, seekers, msg, parse_mode="Markdown")
     except Exception as e: print(f"Помилка пуша видалення: {e}")
 
 async def send_event_updated_push(event_id: int):
     try:
-        async with database.db_pool.acquire() as conn:
-            event = await conn.fetchrow("SELECT title FROM events WHERE id = $1", event_id)
-            seekers = await conn.fetch("SELECT seeker_id FROM requests WHERE event_id = $1 AND status = 'approved'", event_id)
-            if event:
-                for row in seekers:
-                    msg = f"⚠️ *Оновлення івенту*\n\nОрганізатор змінив деталі події «_{event['title']}_». Зайди у свої івенти, щоб перевірити, що нового!"
-                    try: await bot.send_message(chat_id=row['seeker_id'], text=msg, parse_mode="Markdown")
-                    except: pass
+        event, seekers = await _approved_recipients(event_id)
+        if event:
+            msg = f"⚠️ *Оновлення івенту*\n\nОрганізатор змінив деталі події «_{event['title']}_». Зайди у свої івенти, щоб перевірити, що нового!"
+            await send_many(bot, seekers, msg, parse_mode="Markdown")
     except Exception as e: print(f"Помилка пуша оновлення: {e}")
 
 async def send_kicked_push(event_title: str, seeker_id: int):
     try:
         msg = f"😔 *Зміни в планах*\n\nОрганізатор івенту «_{event_title}_» скасував твою участь. Але не засмучуйся, поруч ще багато крутих івентів!"
-        await bot.send_message(chat_id=seeker_id, text=msg, parse_mode="Markdown")
+        await send_to(bot, seeker_id, msg, parse_mode="Markdown")
     except Exception as e: print(f"Помилка пуша про вилучення: {e}")
 
 
@@ -837,18 +923,22 @@ async def join_event(req: JoinRequest):
                     photo = COALESCE(photo, $3)
                 WHERE telegram_id = $4
             """, req.username, req.user_name, req.user_photo, req.user_id)
-            
-            print(f"[API] 📝 Збереження заявки в базу... Message: {req.message}")
-            await conn.execute("""
-                INSERT INTO requests (event_id, seeker_id, status, message) 
-                VALUES ($1, $2, 'pending', $3)
-            """, req.event_id, req.user_id, req.message)
-            print("[API] ✅ Заявка успішно збережена в БД!")
-            
-            # Викликаємо пуш (всередині нього є перевірка на тихий час)
-            asyncio.create_task(send_new_request_push(req.event_id, req.user_id))
-            
-            return {"success": True}
+
+        # Статус (pending / waitlist) визначається в тому ж INSERT по needed_count
+        print(f"[API] 📝 Збереження заявки в базу... Message: {req.message}")
+        row = await database.create_join_request(req.event_id, req.user_id, req.message)
+        if not row:
+            return {"success": False, "error": "Ти вже подав заявку на цей івент!"}
+        print(f"[API] ✅ Заявка успішно збережена в БД! Статус: {row['status']}")
+
+        if row['status'] == 'waitlist':
+            # Організатору нічого вирішувати — місце прийде автоматично
+            return {"success": True, "waitlist": True, "position": row['position']}
+
+        # Викликаємо пуш (всередині нього є перевірка на тихий час)
+        asyncio.create_task(send_new_request_push(req.event_id, req.user_id))
+
+        return {"success": True}
 
     except Exception as e:
         print(f"[API] 🛑 КРИТИЧНА ПОМИЛКА: {e}")
@@ -858,21 +948,19 @@ async def join_event(req: JoinRequest):
         
 @app.post("/api/events/{event_id}/leave")
 async def leave_event(event_id: int, req: LeaveRequest):
-    """Вихід з івенту"""
+    """Вихід з івенту (одним атомарним запитом)"""
     if not database.db_pool:
         raise HTTPException(status_code=500, detail="БД не підключена")
-    async with database.db_pool.acquire() as conn:
-        try:
-            req_row = await conn.fetchrow("SELECT status FROM requests WHERE event_id = $1 AND seeker_id = $2", event_id, req.user_id)
-            if req_row:
-                await conn.execute("DELETE FROM requests WHERE event_id = $1 AND seeker_id = $2", event_id, req.user_id)
-                if req_row['status'] == 'approved':
-                    await conn.execute("UPDATE events SET needed_count = needed_count + 1 WHERE id = $1", event_id)
-                    asyncio.create_task(send_participant_left_push(event_id, req.user_id))
-            return {"success": True}
-        except Exception as e:
-            print(f"Помилка виходу з івенту: {e}")
-            return {"success": False, "error": str(e)}
+    try:
+        res = await database.leave_event_atomic(event_id, req.user_id)
+        if res['old_status'] == 'approved':
+            asyncio.create_task(send_participant_left_push(event_id, req.user_id, res['promoted_id']))
+        if res['promoted_id']:
+            asyncio.create_task(send_decision_push(event_id, res['promoted_id'], 'approved'))
+        return {"success": True, "needed_count": res['needed_count']}
+    except Exception as e:
+        print(f"Помилка виходу з івенту: {e}")
+        return {"success": False, "error": str(e)}
 
 @app.delete("/api/events/{event_id}")
 async def delete_event(event_id: int, user_id: int):
@@ -894,49 +982,67 @@ async def delete_event(event_id: int, user_id: int):
 async def update_request_status(req: UpdateRequestStatus):
     if not database.db_pool:
         raise HTTPException(status_code=500, detail="БД не підключена")
-    async with database.db_pool.acquire() as conn:
-        try:
-            await conn.execute("""
-                UPDATE requests 
-                SET status = $1 
-                WHERE event_id = $2 AND seeker_id = $3
-            """, req.status, req.event_id, req.seeker_id)
-            
-            if req.status == 'approved':
-                new_needed = await conn.fetchval("""
-                    UPDATE events SET needed_count = GREATEST(needed_count - 1, 0) 
-                    WHERE id = $1 RETURNING needed_count
-                """, req.event_id)
-                
-                if new_needed == 0:
-                    asyncio.create_task(send_event_full_push(req.event_id))
-                
+    try:
+        if req.status == 'approved':
+            res = await database.approve_request_atomic(req.event_id, req.seeker_id)
+            if not res['ok']:
+                return {"success": False, "error": res['error']}
+            if res['needed_count'] == 0:
+                asyncio.create_task(send_event_full_push(req.event_id))
             asyncio.create_task(send_decision_push(req.event_id, req.seeker_id, req.status))
-            return {"success": True}
-        except Exception as e:
-            print(f"Помилка оновлення статусу: {e}")
-            return {"success": False, "error": str(e)}
+            return {"success": True, "needed_count": res['needed_count']}
+
+        if req.status == 'rejected':
+            if not await database.reject_request_atomic(req.event_id, req.seeker_id):
+                return {"success": False, "error": "not_pending"}
+        else:
+            async with database.db_pool.acquire() as conn:
+                await conn.execute("""
+                    UPDATE requests 
+                    SET status = $1, decided_at = now() 
+                    WHERE event_id = $2 AND seeker_id = $3
+                """, req.status, req.event_id, req.seeker_id)
+
+        asyncio.create_task(send_decision_push(req.event_id, req.seeker_id, req.status))
+        return {"success": True}
+    except Exception as e:
+        print(f"Помилка оновлення статусу: {e}")
+        return {"success": False, "error": str(e)}
+
+@app.post("/api/events/requests/bulk-status")
+async def bulk_update_request_status(req: BulkRequestStatus):
+    """Пакетне схвалення/відхилення заявок однією транзакцією"""
+    if not database.db_pool:
+        raise HTTPException(status_code=500, detail="БД не підключена")
+    try:
+        res = await database.decide_requests_bulk(req.event_id, req.user_id, [(d.seeker_id, d.status) for d in req.decisions])
+        if res is None:
+            return {"success": False, "error": "Немає прав"}
+        if res['approved'] and res['needed_count'] == 0:
+            asyncio.create_task(send_event_full_push(req.event_id))
+        asyncio.create_task(send_bulk_decision_pushes(req.event_id, res['approved'], res['rejected']))
+        return {"success": True, **res}
+    except Exception as e:
+        print(f"Помилка пакетного оновлення статусів: {e}")
+        return {"success": False, "error": str(e)}
 
 @app.post("/api/events/{event_id}/kick")
 async def kick_participant(event_id: int, req: KickRequest):
     if not database.db_pool:
         raise HTTPException(status_code=500, detail="БД не підключена")
-    async with database.db_pool.acquire() as conn:
-        try:
-            event = await conn.fetchrow("SELECT user_id, title FROM events WHERE id = $1", event_id)
-            if not event or event['user_id'] != req.user_id:
-                return {"success": False, "error": "Немає прав"}
-            
-            req_row = await conn.fetchrow("SELECT status FROM requests WHERE event_id = $1 AND seeker_id = $2", event_id, req.seeker_id)
-            if req_row and req_row['status'] == 'approved':
-                await conn.execute("DELETE FROM requests WHERE event_id = $1 AND seeker_id = $2", event_id, req.seeker_id)
-                await conn.execute("UPDATE events SET needed_count = needed_count + 1 WHERE id = $1", event_id)
-                asyncio.create_task(send_kicked_push(event['title'], req.seeker_id))
-                return {"success": True}
-            return {"success": False, "error": "Користувач не знайдений або не підтверджений"}
-        except Exception as e:
-            print(f"Помилка вилучення учасника: {e}")
-            return {"success": False, "error": str(e)}
+    try:
+        res = await database.kick_participant_atomic(event_id, req.user_id, req.seeker_id)
+        if res['owner_id'] != req.user_id:
+            return {"success": False, "error": "Немає прав"}
+        if res['req_id']:
+            asyncio.create_task(send_kicked_push(res['title'], req.seeker_id))
+            if res['promoted_id']:
+                asyncio.create_task(send_decision_push(event_id, res['promoted_id'], 'approved'))
+            return {"success": True, "needed_count": res['needed_count']}
+        return {"success": False, "error": "Користувач не знайдений або не підтверджений"}
+    except Exception as e:
+        print(f"Помилка вилучення учасника: {e}")
+        return {"success": False, "error": str(e)}
 
 @app.get("/api/events/{event_id}/requests")
 async def get_event_requests(event_id: int):
@@ -961,17 +1067,20 @@ async def get_event_participants(event_id: int):
         raise HTTPException(status_code=500, detail="БД не підключена")
     async with database.db_pool.acquire() as conn:
         try:
-            rows = await conn.fetch("""
-                SELECT u.telegram_id as id, u.name, u.photo, u.username 
-                FROM requests r
-                JOIN users u ON r.seeker_id = u.telegram_id
-                WHERE r.event_id = $1 AND r.status = 'approved'
-            """, event_id)
-            return [dict(row) for row in rows]
+            return await _approved_participants(conn, event_id)
         except Exception as e:
             print(f"Помилка отримання учасників: {e}")
             return []
 
+async def _approved_participants(conn, event_id: int) -> list[dict]:
+    rows = await conn.fetch("""
+        SELECT u.telegram_id as id, u.name, u.photo, u.username 
+        FROM requests r
+        JOIN users u ON r.seeker_id = u.telegram_id
+        WHERE r.event_id = $1 AND r.status = 'approved'
+    """, event_id)
+    return [dict(row) for row in rows]
+
 @app.get("/api/users/{user_id}/my_events")
 async def get_my_events(user_id: int):
     import traceback
@@ -1131,16 +1240,17 @@ async def sync_user_data(req: SyncRequest):
                         name = $2,
                         photo = $3,
                         city = $4,
+                        city_key = $8,
                         interests = $5,
                         bio = $6,
                         last_active = now()
                     WHERE telegram_id = $7
-                """, req.username, req.name, req.photo, req.city, req.interests, req.bio, req.user_id)
+                """, req.username, req.name, req.photo, req.city, req.interests, req.bio, req.user_id, normalize_city(req.city))
             else:
                 await conn.execute("""
-                    INSERT INTO users (telegram_id, username, name, photo, city, interests, bio, last_active)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7, now())
-                """, req.user_id, req.username, req.name, req.photo, req.city, req.interests, req.bio)
+                    INSERT INTO users (telegram_id, username, name, photo, city, interests, bio, last_active, city_key)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, now(), $8)
+                """, req.user_id, req.username, req.name, req.photo, req.city, req.interests, req.bio, normalize_city(req.city))
             
             return {"success": True}
         except Exception as e:
@@ -1156,17 +1266,42 @@ async def edit_event(event_id: int, req: EventEdit):
         
     async with database.db_pool.acquire() as conn:
         try:
-            owner = await conn.fetchval("SELECT user_id FROM events WHERE id = $1", event_id)
-            if owner != req.user_id:
-                return {"success": False, "error": "Немає прав"}
-            
-            await conn.execute("""
-                UPDATE events 
-                SET title = $1, description = $2, capacity = $3, needed_count = $4, date = $5
-                WHERE id = $6
-            """, req.title, req.description, req.capacity, req.needed_count, req.date, event_id)
-            
+            async with conn.transaction():
+                current = await conn.fetchrow("SELECT user_id, title, description, additional_info FROM events WHERE id = $1 FOR UPDATE", event_id)
+                if not current or current['user_id'] != req.user_id:
+                    return {"success": False, "error": "Немає прав"}
+
+                # Та сама перевірка на майже-дублікат, що й при створенні (інакше унікальний івент правкою стає копією спаму).
+                # Лише коли текст змінився: правка дати чи місць не повертає вже схвалений адміном івент у карантин
+                signature = minhash(req.title, req.description)
+                duplicate = None
+                if (req.title, req.description) != (current['title'], current['description']):
+                    duplicate = await database.find_near_duplicate(conn, signature, exclude_id=event_id)
+                
+                status = await conn.fetchval("""
+                    UPDATE events 
+                    SET title = $1, description = $2, capacity = $3, needed_count = $4, date = $5,
+                        status = CASE WHEN $7 AND status = 'active' THEN 'moderation' ELSE status END
+                    WHERE id = $6
+                    RETURNING status
+                """, req.title, req.description, req.capacity, req.needed_count, req.date, event_id, duplicate is not None)
+                
+                # Якщо місць стало більше — вони одразу дістаються черзі
+                promoted = await database.promote_waitlist(conn, event_id)
+                await database.save_event_minhash(conn, event_id, signature)
+
+            for seeker_id in promoted:
+                asyncio.create_task(send_decision_push(event_id, seeker_id, 'approved'))
             asyncio.create_task(send_event_updated_push(event_id))
+            # Ті самі поля, що й при створенні: additional_info форма не редагує, але перевіряємо його разом з новим текстом
+            safety.submit(event_id, event_text(req.title, req.description, current['additional_info']))
+            if duplicate and status == 'moderation':
+                dup_id, dup_owner, sim = duplicate
+                whose = "того ж автора" if dup_owner == req.user_id else f"іншого автора ({dup_owner})"
+                asyncio.create_task(notify_admin_moderation(
+                    event_id,
+                    f"Причина: Майже-дублікат івенту #{dup_id} {whose} після редагування, схожість {sim:.0%}\nНазва: {req.title}\nОпис: {req.description}"
+                ))
             
             return {"success": True}
         except Exception as e:
@@ -1209,11 +1344,41 @@ async def submit_rating(req: RatingSubmit):
 
     return {"success": True}
 
+# Всі оцінки за івент однією транзакцією: один запис на кожного адресата, рейтинг кожного перераховується один раз
+@app.post("/api/rating/submit-batch")
+async def submit_ratings_batch(req: RatingBatchSubmit):
+    if not database.db_pool: return {"success": False, "error": "db_error"}
+
+    results = {}
+    items = []
+    for r in req.ratings:
+        if not 1 <= r.score <= 5:
+            results[r.to_user_id] = "invalid_score"
+            continue
+        comment = r.comment.strip() if r.comment and r.comment.strip() else None
+        items.append((r.to_user_id, req.role_evaluated, r.score, comment))
+
+    try:
+        async with database.db_pool.acquire() as conn:
+            async with conn.transaction():
+                # Вже оцінених не перезаписуємо — як і /api/rating/submit
+                saved = await database.add_reviews_batch(req.event_id, req.from_user_id, items, conn=conn, overwrite=False)
+    except Exception as e:
+        print(f"Помилка пакетного збереження оцінок: {e}")
+        return {"success": False, "error": "db_error"}
+
+    saved_ids = {row['to_user_id'] for row in saved}
+    for to_id, *_ in items:
+        results[to_id] = "ok" if to_id in saved_ids else "already_rated"
+
+    return {"success": True, "results": [{"to_user_id": to_id, "status": st} for to_id, st in results.items()]}
+
 @app.post("/api/report")
 async def submit_report(req: ReportSubmit):
     if not database.db_pool: return {"success": False}
     try:
-        await database.save_report_db(req.reporter_id, req.event_id, req.reason)
+        banned = await database.save_report_db(req.reporter_id, req.event_id, req.reason)
+        if banned: forget_deleted_events(banned[1])
         return {"success": True}
     except Exception as e:
         return {"success": False, "error": str(e)}
@@ -0,0 +1,153 @@
+import re
+
+# === КЛАСИФІКАТОР КАТЕГОРІЙ ІВЕНТІВ ===
+# Індекс "основа слова -> категорії" будується один раз при імпорті. Текст розбивається на слова і проходиться один раз,
+# кожна категорія набирає бали, перемагає найбільша сума. При рівності — порядок у CATEGORIES (детерміновано).
+# Ключові слова — основи ("баскет" ловить "баскетбол"). Основи до 3 літер ("бар", "гол", "дон", "др") матчаться лише цілим словом — інакше "старт" стає "арт", "Лондон" — мафією.
+
+CORE, HINT = 3.0, 1.0  # назва активності vs супутні слова/атрибути
+
+# (категорія = назва іконки, основні слова, супутні слова). Спільні слова ("кубик", "мяч", "фішк") — у кількох категоріях
+CATEGORIES = [
+    ("art_painting", ['малюв', 'малюн', 'рисов', 'рисун', 'скетч', 'живопис', 'paint', 'drawing', 'draw'],
+                     ['рису', 'арт', 'фарб', 'пензл', 'полотн']),
+    ("basketball",   ['баскет', 'nba', 'стритбол'],
+                     ['мяч', 'мʼяч', 'мячик', 'кільц', 'кольц']),
+    ("books",        ['книг', 'книж', 'букклуб', 'book', 'reading'],
+                     ['читан', 'читати', 'читать', 'читаю']),
+    ("boxing",       ['бокс', 'boxing'],
+                     ['перчатк', 'рукавичк', 'груша']),
+    ("chilling_speaking", ['чил', 'чіл', 'чілінг', 'чилинг', 'meetup'],
+                     ['розмов', 'разговор', 'общен', 'спілкув', 'спілк', 'прогулян', 'прогулк', 'гулят', 'гуляти',
+                      'кава', 'каву', 'кофе', 'чай', 'кафе', 'зустріч', 'встреч']),
+    ("cinema",       ['кіно', 'кино', 'фільм', 'фильм', 'кінотеатр', 'кинотеатр', 'cinema', 'movie'],
+                     ['сеанс', 'премʼєр', 'премьер']),
+    ("football",     ['футб', 'soccer', 'football'],
+                     ['гол', 'ворот', 'пенальт', 'матч', 'мяч', 'мʼяч']),
+    ("karaoke",      ['караок', 'karaoke'],
+                     ['спів', 'співати', 'петь', 'поем', 'пісн', 'песн', 'мікрофон', 'микрофон']),
+    ("mafia",        ['мафі', 'мафи', 'мафия', 'мафію'],
+                     ['детектив', 'мирн', 'ведуч', 'ведущ', 'дон', 'role card']),
+    ("monopoly",     ['монопол', 'monopoly'],
+                     ['купюри', 'гроші', 'деньги', 'власність', 'собственность', 'будиночк', 'домик', 'отель',
+                      'кубик', 'кубики']),
+    ("party",        ['паті', 'пати', 'party', 'вечірк', 'вечеринк', 'туса', 'тусовк', 'дискотек', 'день народж', 'день рожд'],
+                     ['клуб', 'бар', 'свят', 'праздн', 'др']),
+    ("picnic",       ['пікнік', 'пикник', 'picnic'],
+                     ['плед', 'корзин', 'бутер', 'сендвіч', 'сэндвич', 'закуск', 'їжа на природ', 'еда на природ']),
+    ("poker",        ['покер', 'poker', 'блайнд'],
+                     ['блеф', 'ставк', 'техас', 'карти', 'карты', 'фішк', 'фишк']),
+    ("smoking",      ['кальян', 'hookah', 'shisha', 'шиша'],
+                     ['дим', 'дым', 'покур', 'покурить', 'smoke', 'smoking']),
+    ("snooker",      ['більярд', 'бильярд', 'снукер', 'snooker'],
+                     ['pool', 'пул', 'кий', 'шар', 'шары', 'куля', 'кулі']),
+    ("table_games",  ['настол', 'настільн', 'настольн', 'board game', 'boardgame', 'table game', 'dice', 'дайс'],
+                     ['кубик', 'кубики', 'фішк', 'фишк', 'карточк', 'картк']),
+    ("tenis",        ['теніс', 'теннис', 'tennis', 'мяч тен', 'мʼяч тен'],
+                     ['ракетк', 'ракет', 'корт', 'подач']),
+    ("theatr",       ['театр', 'театральн', 'вистав', 'спектакл'],
+                     ['пʼєс', 'пьес', 'сцен', 'актор', 'актер', 'маск']),
+    ("training",     ['тренув', 'тренир', 'спортзал', 'фітнес', 'фитнес', 'качалк', 'workout', 'training', 'gym'],
+                     ['зал', 'гантел', 'зарядк']),
+    ("trip",         ['подорож', 'путешеств', 'мандр', 'trip', 'travel', 'туризм', 'турист', 'похід', 'поход'],
+                     ['гори', 'горы', 'рюкзак', 'валіз', 'чемодан']),
+]
+
+DEFAULT_CATEGORY = "default"
+_SHORT = 3
+
+
+def _norm(text: str) -> str:
+    """Нижній регістр і один вид апострофа (м'яч / м’яч / мʼяч)"""
+    return text.lower().replace("'", "ʼ").replace("’", "ʼ")
+
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _build_index():
+    """Індекси: перші 3 літери -> основи (найдовші першими), коротке слово -> ваги, фрази -> ваги"""
+    prefix, exact, phrases = {}, {}, {}
+    for cat, core, hints in CATEGORIES:
+        for words, weight in ((core, CORE), (hints, HINT)):
+            for w in words:
+                w = _norm(w)
+                target = phrases if ' ' in w else exact if len(w) <= _SHORT else prefix
+                cats = target.setdefault(w, {})
+                cats[cat] = max(cats.get(cat, 0.0), weight)
+    # Беремо найдовшу основу слова, тож "кубики" мусить нести й бали "кубик"
+    by_head = {}
+    for w in sorted(prefix, key=len, reverse=True):
+        merged = {}
+        for shorter, cats in prefix.items():
+            if w.startswith(shorter):
+                for cat, weight in cats.items(): merged[cat] = max(merged.get(cat, 0.0), weight)
+        by_head.setdefault(w[:_SHORT], []).append((w, merged))
+    return by_head, exact, phrases
+
+
+_BY_HEAD, _EXACT, _PHRASES = _build_index()
+_ORDER = {cat: i for i, (cat, _, _) in enumerate(CATEGORIES)}
+
+
+def category_scores(*parts) -> dict[str, float]:
+    """Бали всіх категорій, що спрацювали. Один прохід по словах; кожне слово рахується раз на текст"""
+    tokens = _TOKEN_RE.findall(_norm(" ".join(str(p) for p in parts if p)))
+    scores = {}
+    for tok in set(tokens):
+        cats = _EXACT.get(tok)
+        if cats is None:
+            for stem, merged in _BY_HEAD.get(tok[:_SHORT], ()):
+                if tok.startswith(stem):
+                    cats = merged; break
+            else: continue
+        for cat, weight in cats.items():
+            scores[cat] = scores.get(cat, 0.0) + weight
+    if _PHRASES:
+        spaced = " " + " ".join(tokens)
+        for phrase, cats in _PHRASES.items():
+            if " " + phrase in spaced:
+                for cat, weight in cats.items(): scores[cat] = scores.get(cat, 0.0) + weight
+    return scores
+
+
+def classify(*parts) -> str:
+    """Категорія з найбільшою сумою балів; при рівності — та, що раніше в CATEGORIES"""
+    scores = category_scores(*parts)
+    if not scores: return DEFAULT_CATEGORY
+    return min(scores, key=lambda c: (-scores[c], _ORDER[c]))
+
+
+# Розмічений набір для регресії: python categories.py
+REGRESSION_SET = [
+    ("Футбол у неділю", "Беремо мяч, граємо 5 на 5", "football"),
+    ("Баскетбол 3х3", "Стритбол на майданчику, свій мяч", "basketball"),
+    ("Вечір настолок", "Кубики, картки і багато чаю", "table_games"),
+    ("Монополія", "Кидаємо кубики, скуповуємо готелі", "monopoly"),
+    ("Старт пробіжки", "Збираємось біля парку", "default"),
+    ("Поїздка в Лондон", "Подорож на тиждень", "trip"),
+    ("Мафія в антикафе", "Ведучий є, карти ролей теж", "mafia"),
+    ("Покер з друзями", "Техаський холдем, фішки мої", "poker"),
+    ("Кава та розмови", "Чіл у кафе на Подолі", "chilling_speaking"),
+    ("Теніс", "Корт забронював, ракетки є", "tenis"),
+    ("Більярд", "Пул у барі на Оболоні", "snooker"),
+    ("Тренування в залі", "Фітнес і гантелі", "training"),
+    ("Похід у гори", "Рюкзак і намет", "trip"),
+    ("Караоке вечір", "Співаємо пісні до ранку", "karaoke"),
+    ("Кіно", "Йдемо на премʼєру фільму", "cinema"),
+    ("Пікнік у парку", "Плед і бутерброди", "picnic"),
+    ("Вистава", "Спектакль у театрі на Подолі", "theatr"),
+    ("Малюємо скетчі", "Живопис для новачків", "art_painting"),
+    ("Книжковий клуб", "Обговорюємо книгу місяця", "books"),
+    ("Вечірка на ДР", "Тусовка у клубі", "party"),
+]
+
+
+if __name__ == "__main__":
+    import timeit
+    fails = [(t, d, exp, classify(t, d)) for t, d, exp in REGRESSION_SET if classify(t, d) != exp]
+    for t, d, exp, got in fails: print(f"FAIL: {t!r} / {d!r}: очікували {exp}, отримали {got}")
+    print(f"регресія: {len(REGRESSION_SET) - len(fails)}/{len(REGRESSION_SET)}")
+    n = 20000
+    t = timeit.timeit(lambda: classify(*REGRESSION_SET[0][:2]), number=n)
+    print(f"classify(): {t / n * 1e6:.2f} µs")
@@ -3,6 +3,8 @@ import logging
 from datetime import datetime
 from math import radians, sin, cos, acos
 from config import DATABASE_URL
+from utils import CITIES, normalize_city
+from moderation import DEFAULT_STOP_WORDS, NEAR_DUP_THRESHOLD, minhash, minhash_buckets, minhash_similarity
 
 db_pool = None
 
@@ -58,27 +60,311 @@ async def init_db_pool():
                 await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS rating_part NUMERIC(3,2) DEFAULT 5.0;")
                 await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS votes_part INT DEFAULT 0;")
                 await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'active';")
+                # Чи доходять до юзера пуші (false після 403 / chat not found, скидається при наступній активності)
+                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS reachable BOOLEAN NOT NULL DEFAULT true;")
+                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_since TIMESTAMPTZ;")
             except Exception as e:
                 logging.error(f"Помилка оновлення колонок users: {e}")
                 
             # === ГАРАНТУЄМО НАЯВНІСТЬ created_at В events ДЛЯ ЛІМІТІВ ===
             try:
                 await conn.execute("ALTER TABLE events ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT now();")
+                # text_key тексту, який адмін схвалив вручну (AI-вердикт на той самий текст його вже не перекриває)
+                await conn.execute("ALTER TABLE events ADD COLUMN IF NOT EXISTS safety_approved_key TEXT;")
             except Exception as e:
                 logging.error(f"Помилка оновлення колонок events: {e}")
 
+            # === НОРМАЛІЗОВАНЕ МІСТО ДЛЯ МІСЬКИХ СТРІЧОК (замість ILIKE по адресі) ===
+            try:
+                await conn.execute("ALTER TABLE events ADD COLUMN IF NOT EXISTS city TEXT;")
+                await conn.execute("CREATE INDEX IF NOT EXISTS idx_events_city_active ON events (city, date) WHERE status = 'active';")
+                await conn.execute("CREATE INDEX IF NOT EXISTS idx_events_status_date ON events (status, date);")
+                # Один раз заповнюємо старі івенти з першої частини адреси ("Київ, вул. ..." / "Київ (За геолокацією)")
+                await conn.execute("""
+                    UPDATE events e SET city = a.slug
+                    FROM (SELECT unnest($1::text[]) AS alias, unnest($2::text[]) AS slug) a
+                    WHERE e.city IS NULL
+                      AND lower(trim(split_part(split_part(e.location, ',', 1), '(', 1))) = a.alias
+                """, list(CITIES.keys()), list(CITIES.values()))
+            except Exception as e:
+                logging.error(f"Помилка міграції міст events: {e}")
+
+            # === ВІДКЛАДЕНІ ПУШІ (тихий час 22:00-10:00) ===
+            # Один рядок на (отримувач, івент, тип): повтори лише збільшують count
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS deferred_pushes (
+                id SERIAL PRIMARY KEY, recipient_id BIGINT NOT NULL, event_id INT NOT NULL, kind TEXT NOT NULL,
+                count INT NOT NULL DEFAULT 1, release_at TIMESTAMPTZ NOT NULL, created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                UNIQUE(recipient_id, event_id, kind)
+            );
+            """)
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_deferred_pushes_release ON deferred_pushes (release_at);")
+            # Оренда рядка на час відправки: видаляється лише після пуша, після падіння рядок знову стає доступним
+            await conn.execute("ALTER TABLE deferred_pushes ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ;")
+
+            # === ВІКНО ОСТАННІХ ОЦІНОК: index scan замість сортування всіх відгуків ===
+            await conn.execute("ALTER TABLE reviews ADD COLUMN IF NOT EXISTS comment TEXT;")
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_reviews_target_role_created ON reviews (to_user_id, role_evaluated, created_at DESC);")
+
+            # === ЛИСТ ОЧІКУВАННЯ: черга по event_id у порядку подачі ===
+            try:
+                await conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_event_status_created ON requests (event_id, status, created_at);")
+            except Exception as e:
+                logging.error(f"Помилка створення індексу requests: {e}")
+
+            # === ЩОДЕННА СТАТИСТИКА ДЛЯ /admin (рахує фонова задача, не кожен виклик) ===
+            try:
+                await install_stats_rollup(conn)
+            except Exception as e:
+                logging.error(f"Помилка міграції stats_daily: {e}")
+
+            # === СЛОВНИК МОДЕРАЦІЇ (редагується в БД, движок перечитує на льоту) ===
+            try:
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS moderation_terms (
+                        term TEXT PRIMARY KEY, weight REAL NOT NULL DEFAULT 1
+                    );
+                """)
+                if not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM moderation_terms)"):
+                    await conn.executemany("INSERT INTO moderation_terms (term) VALUES ($1) ON CONFLICT DO NOTHING", [(w,) for w in DEFAULT_STOP_WORDS])
+            except Exception as e:
+                logging.error(f"Помилка міграції moderation_terms: {e}")
+
+            # === MINHASH-ПІДПИСИ ДЛЯ ПОШУКУ МАЙЖЕ-ДУБЛІКАТІВ ===
+            try:
+                await install_near_dup(conn)
+            except Exception as e:
+                logging.error(f"Помилка міграції near-dup: {e}")
+
+            # === КВОТИ НА СТВОРЕННЯ ІВЕНТІВ ===
+            try:
+                await install_event_quota(conn)
+            except Exception as e:
+                logging.error(f"Помилка міграції event_quota: {e}")
+
+            # === ЛІЧИЛЬНИКИ СКАРГ ДЛЯ АВТО-БАНУ ===
+            try:
+                await install_report_counters(conn)
+            except Exception as e:
+                logging.error(f"Помилка міграції report_counters: {e}")
+
+            # === СТАТИСТИКА ЮЗЕРІВ (замість COUNT/AVG на кожен показ) ===
+            try:
+                await install_user_stats(conn)
+            except Exception as e:
+                logging.error(f"Помилка міграції user_stats: {e}")
+
+            # === ЧАС НАГАДУВАНЬ (24 год / 1 год до початку) ===
+            try:
+                await install_reminders(conn)
+            except Exception as e:
+                logging.error(f"Помилка міграції нагадувань: {e}")
+
+            # === РОЗСИЛКИ АДМІНА ===
+            try:
+                await install_broadcasts(conn)
+            except Exception as e:
+                logging.error(f"Помилка міграції broadcasts: {e}")
+
+# Лічильники ведуть тригери, тож їх оновлюють усі шляхи запису (api, main, hobby_bot, ручний SQL)
+_USER_STATS_SQL = """
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id BIGINT PRIMARY KEY,
+    events_organized INT NOT NULL DEFAULT 0,
+    events_joined INT NOT NULL DEFAULT 0,
+    rating_sum BIGINT NOT NULL DEFAULT 0,
+    rating_count INT NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION user_stats_bump(uid BIGINT, d_org INT, d_join INT, d_sum BIGINT, d_cnt INT) RETURNS void AS $$
+    INSERT INTO user_stats (user_id, events_organized, events_joined, rating_sum, rating_count)
+    VALUES (uid, d_org, d_join, d_sum, d_cnt)
+    ON CONFLICT (user_id) DO UPDATE SET
+        events_organized = user_stats.events_organized + EXCLUDED.events_organized,
+        events_joined = user_stats.events_joined + EXCLUDED.events_joined,
+        rating_sum = user_stats.rating_sum + EXCLUDED.rating_sum,
+        rating_count = user_stats.rating_count + EXCLUDED.rating_count;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION user_stats_events_trg() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'DELETE' THEN PERFORM user_stats_bump(NEW.user_id::bigint, 1, 0, 0, 0); END IF;
+    IF TG_OP <> 'INSERT' THEN PERFORM user_stats_bump(OLD.user_id::bigint, -1, 0, 0, 0); END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION user_stats_requests_trg() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'DELETE' AND NEW.status = 'approved' THEN PERFORM user_stats_bump(NEW.seeker_id::bigint, 0, 1, 0, 0); END IF;
+    IF TG_OP <> 'INSERT' AND OLD.status = 'approved' THEN PERFORM user_stats_bump(OLD.seeker_id::bigint, 0, -1, 0, 0); END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION user_stats_ratings_trg() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'DELETE' AND NEW.status = 'done' AND NEW.score IS NOT NULL THEN
+        PERFORM user_stats_bump(NEW.organizer_id::bigint, 0, 0, NEW.score, 1);
+    END IF;
+    IF TG_OP <> 'INSERT' AND OLD.status = 'done' AND OLD.score IS NOT NULL THEN
+        PERFORM user_stats_bump(OLD.organizer_id::bigint, 0, 0, -OLD.score, -1);
+    END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_user_stats_events ON events;
+CREATE TRIGGER trg_user_stats_events AFTER INSERT OR DELETE OR UPDATE OF user_id ON events
+    FOR EACH ROW EXECUTE FUNCTION user_stats_events_trg();
+
+DROP TRIGGER IF EXISTS trg_user_stats_requests ON requests;
+CREATE TRIGGER trg_user_stats_requests AFTER INSERT OR DELETE OR UPDATE OF status, seeker_id ON requests
+    FOR EACH ROW EXECUTE FUNCTION user_stats_requests_trg();
+"""
+
+async def install_user_stats(conn):
+    """Створює user_stats і тригери; при першому запуску заповнює таблицю з наявних даних"""
+    async with conn.transaction():
+        is_new = not await conn.fetchval("SELECT to_regclass('public.user_stats') IS NOT NULL")
+        await conn.execute(_USER_STATS_SQL)
+        # Стара таблиця ratings (hobby_bot) може бути ще не створена
+        has_ratings = await conn.fetchval("SELECT to_regclass('public.ratings') IS NOT NULL")
+        if has_ratings:
+            await conn.execute("""
+                DROP TRIGGER IF EXISTS trg_user_stats_ratings ON ratings;
+                CREATE TRIGGER trg_user_stats_ratings AFTER INSERT OR DELETE OR UPDATE OF score, status, organizer_id ON ratings
+                    FOR EACH ROW EXECUTE FUNCTION user_stats_ratings_trg();
+            """)
+        if is_new:
+            # Тригери вже стоять, а транзакція тримає блокування — жоден запис між ними не загубиться
+            await conn.execute(f"""
+                INSERT INTO user_stats (user_id, events_organized, events_joined, rating_sum, rating_count)
+                SELECT uid, SUM(o), SUM(j), SUM(s), SUM(c) FROM (
+                    SELECT user_id::bigint AS uid, 1 AS o, 0 AS j, 0 AS s, 0 AS c FROM events
+                    UNION ALL
+                    SELECT seeker_id::bigint, 0, 1, 0, 0 FROM requests WHERE status = 'approved'
+                    {"UNION ALL SELECT organizer_id::bigint, 0, 0, score, 1 FROM ratings WHERE status = 'done' AND score IS NOT NULL" if has_ratings else ""}
+                ) x GROUP BY uid
+            """)
+
+async def load_moderation_terms() -> dict[str, float]:
+    """Словник модерації {термін: вага} (таблиця маленька — читаємо цілком)"""
+    async with db_pool.acquire() as conn:
+        return {r['term']: r['weight'] for r in await conn.fetch("SELECT term, weight FROM moderation_terms")}
+
+# === МАЙЖЕ-ДУБЛІКАТИ ІВЕНТІВ (MinHash + LSH-кошики, див. moderation.py) ===
+NEAR_DUP_DAYS = 30  # з якими івентами порівнюємо новий
+
+async def install_near_dup(conn):
+    """Колонка з підписом, таблиця кошиків; підписи для свіжих івентів без них; чистка кошиків старих івентів"""
+    await conn.execute("ALTER TABLE events ADD COLUMN IF NOT EXISTS minhash BIGINT[];")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS event_minhash_bands (
+            band SMALLINT NOT NULL, bucket INT NOT NULL, event_id INT NOT NULL, PRIMARY KEY (band, bucket, event_id)
+        );
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_event_minhash_bands_event ON event_minhash_bands (event_id);")
+    rows = await conn.fetch(f"SELECT id, title, description FROM events WHERE minhash IS NULL AND created_at > now() - interval '{NEAR_DUP_DAYS} days'")
+    for r in rows:
+        await save_event_minhash(conn, r['id'], minhash(r['title'], r['description']))
+    await conn.execute("""
+        DELETE FROM event_minhash_bands b USING events e
+        WHERE e.id = b.event_id AND e.created_at < now() - make_interval(days => $1)
+    """, NEAR_DUP_DAYS * 2)
+
+async def save_event_minhash(conn, event_id: int, sig: list[int] | None):
+    """Записує підпис івенту і перекладає його по кошиках (при редагуванні старі кошики прибираються)"""
+    await conn.execute("DELETE FROM event_minhash_bands WHERE event_id = $1", event_id)
+    await conn.execute("UPDATE events SET minhash = $2 WHERE id = $1", event_id, sig)
+    if not sig: return
+    buckets = minhash_buckets(sig)
+    await conn.execute("""
+        INSERT INTO event_minhash_bands (band, bucket, event_id)
+        SELECT band, bucket, $3 FROM unnest($1::smallint[], $2::int[]) AS t(band, bucket)
+        ON CONFLICT DO NOTHING
+    """, list(range(len(buckets))), buckets, event_id)
+
+async def find_near_duplicate(conn, sig: list[int] | None, exclude_id: int | None = None):
+    """Найсхожіший свіжий не видалений івент зі схожістю >= NEAR_DUP_THRESHOLD: (id, user_id, схожість) або None"""
+    if not sig: return None
+    buckets = minhash_buckets(sig)
+    rows = await conn.fetch(f"""
+        SELECT e.id, e.user_id, e.minhash FROM events e
+        WHERE e.id IN (
+            SELECT b.event_id FROM event_minhash_bands b
+            JOIN unnest($1::smallint[], $2::int[]) AS t(band, bucket) ON b.band = t.band AND b.bucket = t.bucket
+        )
+        AND e.status <> 'deleted' AND e.created_at > now() - interval '{NEAR_DUP_DAYS} days' AND e.id IS DISTINCT FROM $3
+    """, list(range(len(buckets))), buckets, exclude_id)
+    best = None
+    for r in rows:
+        if not r['minhash']: continue
+        sim = minhash_similarity(sig, r['minhash'])
+        if sim >= NEAR_DUP_THRESHOLD and (best is None or sim > best[2]):
+            best = (r['id'], r['user_id'], sim)
+    return best
+
+# === КВОТИ НА СТВОРЕННЯ ІВЕНТІВ: лічильник на (юзер, період), веде тригер на events ===
+# Новий період (напр. 'week') — додати в масив EVENT_QUOTA_PERIODS; перевірка лишається PK-лукапом
+EVENT_QUOTA_PERIODS = ('month', 'day', 'hour')
+
+_EVENT_QUOTA_SQL = f"""
+CREATE TABLE IF NOT EXISTS event_quota (
+    user_id BIGINT NOT NULL, period TEXT NOT NULL, period_start TIMESTAMPTZ NOT NULL, count INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, period, period_start)
+);
+
+CREATE OR REPLACE FUNCTION event_quota_trg() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO event_quota (user_id, period, period_start, count)
+        SELECT NEW.user_id::bigint, p, date_trunc(p, COALESCE(NEW.created_at, now())), 1
+        FROM unnest(ARRAY{list(EVENT_QUOTA_PERIODS)}) p
+        ON CONFLICT (user_id, period, period_start) DO UPDATE SET count = event_quota.count + 1;
+    ELSE
+        UPDATE event_quota SET count = count - 1
+        WHERE user_id = OLD.user_id::bigint AND period = ANY(ARRAY{list(EVENT_QUOTA_PERIODS)})
+          AND period_start = date_trunc(period, OLD.created_at) AND count > 0;
+    END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_event_quota ON events;
+CREATE TRIGGER trg_event_quota AFTER INSERT OR DELETE ON events FOR EACH ROW EXECUTE FUNCTION event_quota_trg();
+"""
+
+async def install_event_quota(conn):
+    """Створює event_quota і тригер; при першому запуску заповнює поточні періоди, старі періоди чистить"""
+    async with conn.transaction():
+        is_new = not await conn.fetchval("SELECT to_regclass('public.event_quota') IS NOT NULL")
+        await conn.execute(_EVENT_QUOTA_SQL)
+        if is_new:
+            await conn.execute(f"""
+                INSERT INTO event_quota (user_id, period, period_start, count)
+                SELECT e.user_id::bigint, p, date_trunc(p, e.created_at), COUNT(*)
+                FROM events e CROSS JOIN unnest(ARRAY{list(EVENT_QUOTA_PERIODS)}) p
+                WHERE e.created_at >= date_trunc(p, now())
+                GROUP BY 1, 2, 3
+            """)
+        await conn.execute("DELETE FROM event_quota WHERE period_start < date_trunc('month', now()) - interval '1 month'")
+
+_QUOTA_COUNTS_SQL = """
+    SELECT q.period, q.count FROM unnest($2::text[]) p
+    JOIN event_quota q ON q.user_id = $1 AND q.period = p AND q.period_start = date_trunc(p, now())
+"""
+
+async def get_user_quota_counts(user_id: int, conn=None) -> dict[str, int]:
+    """Кількість івентів юзера в поточних періодах: {'month': n, 'day': n, 'hour': n}. Лише PK-лукапи"""
+    if conn is not None:
+        rows = await conn.fetch(_QUOTA_COUNTS_SQL, user_id, list(EVENT_QUOTA_PERIODS))
+    else:
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch(_QUOTA_COUNTS_SQL, user_id, list(EVENT_QUOTA_PERIODS))
+    counts = dict.fromkeys(EVENT_QUOTA_PERIODS, 0)
+    counts.update({r['period']: r['count'] for r in rows})
+    return counts
+
 async def get_user_monthly_count(user_id: int):
     """Рахує кількість івентів юзера за поточний календарний місяць"""
-    async with db_pool.acquire() as conn:
-        # Використовуємо date_trunc для порівняння лише місяця та року
-        query = """
-            SELECT COUNT(*) FROM events 
-            WHERE user_id::text = $1 
-            AND date_trunc('month', created_at) = date_trunc('month', now())
-        """
-        # Приводимо user_id до строки, як у всіх інших запитах
-        count = await conn.fetchval(query, str(user_id))
-        return count or 0
+    return (await get_user_quota_counts(user_id))['month']
 
 async def get_user_from_db(user_id: int):
     async with db_pool.acquire() as conn: return await conn.fetchrow("SELECT * FROM users WHERE telegram_id::text = $1", str(user_id))
@@ -86,15 +372,24 @@ async def get_user_from_db(user_id: int):
 async def save_user_to_db(user_id, phone, name, city, photo, interests):
     async with db_pool.acquire() as conn:
         await conn.execute("""
-            INSERT INTO users (telegram_id, phone, name, city, photo, interests, last_active) VALUES ($1,$2,$3,$4,$5,$6, now())
-            ON CONFLICT (telegram_id) DO UPDATE SET phone=EXCLUDED.phone, name=EXCLUDED.name, city=EXCLUDED.city, photo=EXCLUDED.photo, interests=EXCLUDED.interests, last_active=now()
-        """, user_id, phone, name, city, photo, interests)
+            INSERT INTO users (telegram_id, phone, name, city, city_key, photo, interests, last_active) VALUES ($1,$2,$3,$4,$7,$5,$6, now())
+            ON CONFLICT (telegram_id) DO UPDATE SET phone=EXCLUDED.phone, name=EXCLUDED.name, city=EXCLUDED.city, city_key=EXCLUDED.city_key, photo=EXCLUDED.photo, interests=EXCLUDED.interests, last_active=now()
+        """, user_id, phone, name, city, photo, interests, normalize_city(city))
 
 async def update_user_activity(user_id: int):
     try:
-        async with db_pool.acquire() as conn: await conn.execute("UPDATE users SET last_active = now() WHERE telegram_id::text = $1", str(user_id))
+        async with db_pool.acquire() as conn: await conn.execute("UPDATE users SET last_active = now(), reachable = true, unreachable_since = NULL WHERE telegram_id::text = $1", str(user_id))
     except Exception as e: logging.error(f"Не вдалося оновити активність юзера: {e}")
 
+async def mark_unreachable(user_ids):
+    """Юзери, яким пуш не доходить (заблокували бота / видалили акаунт): наступні розсилки їх оминають"""
+    if not user_ids: return
+    async with db_pool.acquire() as conn:
+        await conn.execute("""
+            UPDATE users SET reachable = false, unreachable_since = now()
+            WHERE telegram_id = ANY($1::bigint[]) AND reachable
+        """, list(user_ids))
+
 # ТЕПЕР БЕРЕМО РЕЙТИНГ ПРЯМО З USERS (ДУЖЕ ШВИДКО)
 async def get_organizer_avg_rating(organizer_id: int):
     async with db_pool.acquire() as conn:
@@ -122,7 +417,17 @@ async def find_events_by_kw(keyword: str, limit: int = 10):
         """, f"%{keyword}%", limit)
 
 async def get_events_for_swipe(city: str, limit: int = 50):
+    city_key = normalize_city(city)
     async with db_pool.acquire() as conn:
+        if city_key:
+            # Індексний range scan по (city, date)
+            return await conn.fetch("""
+                SELECT e.*, u.name AS organizer_name, u.rating_org as org_rating
+                FROM events e LEFT JOIN users u ON u.telegram_id::text = e.user_id::text
+                WHERE e.status = 'active' AND e.city = $1 AND e.date >= now() AND e.needed_count > 0
+                ORDER BY e.date ASC LIMIT $2
+            """, city_key, limit)
+        # Невідоме місто — старий пошук по адресі
         return await conn.fetch("""
             SELECT e.*, u.name AS organizer_name, u.rating_org as org_rating
             FROM events e LEFT JOIN users u ON u.telegram_id::text = e.user_id::text
@@ -153,12 +458,39 @@ async def get_event_by_id(event_id: int):
             FROM events e LEFT JOIN users u ON u.telegram_id::text = e.user_id::text WHERE e.id = $1
         """, event_id)
 
+async def save_event_to_db(user_id: int, creator_name: str, creator_phone: str, title: str, description: str, date: datetime, location: str,
+                           capacity: int, needed_count: int, status: str, location_lat: float | None = None, location_lon: float | None = None,
+                           photo: str | None = None, city: str | None = None):
+    # Якщо місто не передали окремо — пробуємо витягнути з адреси
+    city_key = normalize_city(city) or normalize_city(location)
+    async with db_pool.acquire() as conn:
+        return await conn.fetchrow("""
+            INSERT INTO events (user_id, creator_name, creator_phone, title, description, date, location, capacity, needed_count, status, location_lat, location_lon, photo, city, created_at)
+            VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14, now()) RETURNING *
+        """, user_id, creator_name or '', creator_phone or '', title, description, date, location, capacity, needed_count, status, location_lat, location_lon, photo, city_key)
+
 async def create_join_request(event_id: int, user_id: int, message: str):
+    """Створює заявку: 'pending', якщо є місця, інакше 'waitlist'. Повертає (id, status, position) або None, якщо заявка вже є"""
     async with db_pool.acquire() as conn:
-        try:
-            row = await conn.fetchrow("INSERT INTO requests (event_id, seeker_id, status, message) VALUES ($1, $2, 'pending', $3) RETURNING id", event_id, user_id, message)
-            return row['id'] if row else None
-        except asyncpg.exceptions.UniqueViolationError: return -1
+        async with conn.transaction():
+            # Блокування івенту серіалізує вибір pending/waitlist зі звільненнями місць (leave/kick тримають той самий замок),
+            # тож ніхто не стане в чергу за вже вільним місцем
+            await conn.execute("SELECT 1 FROM events WHERE id = $1 FOR UPDATE", event_id)
+            return await conn.fetchrow("""
+                WITH ins AS (
+                    INSERT INTO requests (event_id, seeker_id, status, message)
+                    SELECT $1, $2, CASE WHEN e.needed_count > 0 THEN 'pending' ELSE 'waitlist' END, $3
+                    FROM events e WHERE e.id = $1
+                    ON CONFLICT (event_id, seeker_id) DO NOTHING
+                    RETURNING id, status, created_at
+                )
+                SELECT ins.id, ins.status,
+                       CASE WHEN ins.status = 'waitlist' THEN (
+                           SELECT COUNT(*) FROM requests w
+                           WHERE w.event_id = $1 AND w.status = 'waitlist' AND (w.created_at, w.id) < (ins.created_at, ins.id)
+                       ) + 1 END AS position
+                FROM ins
+            """, event_id, user_id, message)
 
 async def get_request_info(req_id: int):
     async with db_pool.acquire() as conn:
@@ -171,11 +503,151 @@ async def get_request_by_event_and_user(event_id: int, user_id: int):
     async with db_pool.acquire() as conn: return await conn.fetchrow("SELECT * FROM requests WHERE event_id = $1 AND seeker_id = $2", event_id, user_id)
 
 async def update_request_status_db(req_id: int, status: str):
-    async with db_pool.acquire() as conn: await conn.execute("UPDATE requests SET status = $1 WHERE id = $2", status, req_id)
+    async with db_pool.acquire() as conn: await conn.execute("UPDATE requests SET status = $1, decided_at = now() WHERE id = $2", status, req_id)
 
-async def decrement_needed_count(event_id: int):
-    async with db_pool.acquire() as conn: 
-        return await conn.fetchval("UPDATE events SET needed_count = GREATEST(needed_count - 1, 0) WHERE id = $1 RETURNING needed_count", event_id)
+# === АТОМАРНІ ПЕРЕХОДИ ЗАЯВОК (один запит, без овербукінгу) ===
+# Рядок заявки блокується через FOR UPDATE / UPDATE, рядок івенту — через UPDATE з умовою needed_count > 0.
+# Паралельні схвалення чекають на блокування івенту і перевіряють умову вже на свіжій версії рядка.
+
+async def approve_request_atomic(event_id: int, seeker_id: int):
+    """Схвалює pending-заявку і забирає одне місце. Повертає {"ok", "error", "needed_count"}"""
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            WITH rq AS (
+                SELECT id FROM requests WHERE event_id = $1 AND seeker_id = $2 AND status = 'pending' FOR UPDATE
+            ), ev AS (
+                UPDATE events SET needed_count = needed_count - 1
+                WHERE id = $1 AND needed_count > 0 AND EXISTS (SELECT 1 FROM rq)
+                RETURNING needed_count
+            ), upd AS (
+                UPDATE requests SET status = 'approved', decided_at = now()
+                WHERE id IN (SELECT id FROM rq) AND EXISTS (SELECT 1 FROM ev)
+                RETURNING id
+            )
+            SELECT EXISTS (SELECT 1 FROM rq) AS was_pending,
+                   (SELECT needed_count FROM ev) AS needed_count,
+                   (SELECT id FROM upd) AS req_id
+        """, event_id, seeker_id)
+    if not row['was_pending']: return {"ok": False, "error": "not_pending", "needed_count": None}
+    if row['req_id'] is None: return {"ok": False, "error": "full", "needed_count": 0}
+    return {"ok": True, "error": None, "needed_count": row['needed_count']}
+
+async def reject_request_atomic(event_id: int, seeker_id: int) -> bool:
+    """Відхиляє лише pending-заявку (вже схвалену так не скасуєш)"""
+    async with db_pool.acquire() as conn:
+        return bool(await conn.fetchval("""
+            UPDATE requests SET status = 'rejected', decided_at = now() WHERE event_id = $1 AND seeker_id = $2 AND status = 'pending' RETURNING id
+        """, event_id, seeker_id))
+
+async def decide_requests_bulk(event_id: int, owner_id: int, decisions: list[tuple[int, str]]):
+    """Застосовує пачку рішень (seeker_id, 'approved'|'rejected') в одній транзакції.
+    Схвалення йдуть у порядку списку, поки є місця. Повертає None, якщо івент не цього організатора"""
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            if not await conn.fetchval("SELECT 1 FROM events WHERE id = $1 AND user_id = $2", event_id, owner_id): return None
+            # Порядок блокувань як в approve_request_atomic: спершу заявки, потім івент (без дедлоків)
+            pending = {r['seeker_id']: r['id'] for r in await conn.fetch("""
+                SELECT id, seeker_id FROM requests WHERE event_id = $1 AND seeker_id = ANY($2::bigint[]) AND status = 'pending'
+                ORDER BY id FOR UPDATE
+            """, event_id, [sid for sid, _ in decisions])}
+            free = await conn.fetchval("SELECT needed_count FROM events WHERE id = $1 FOR UPDATE", event_id) or 0
+
+            approved, rejected, skipped = [], [], []
+            for seeker_id, status in decisions:
+                req_id = pending.pop(seeker_id, None)
+                if req_id is None: skipped.append({"seeker_id": seeker_id, "error": "not_pending"})
+                elif status == 'rejected': rejected.append(seeker_id)
+                elif status == 'approved' and free > len(approved): approved.append(seeker_id)
+                elif status == 'approved': skipped.append({"seeker_id": seeker_id, "error": "full"})
+                else: skipped.append({"seeker_id": seeker_id, "error": "bad_status"})
+
+            if approved or rejected:
+                await conn.execute("""
+                    UPDATE requests r SET status = d.status, decided_at = now()
+                    FROM unnest($2::bigint[], $3::text[]) AS d(seeker_id, status)
+                    WHERE r.event_id = $1 AND r.seeker_id = d.seeker_id
+                """, event_id, approved + rejected, ['approved'] * len(approved) + ['rejected'] * len(rejected))
+            if approved:
+                free = await conn.fetchval("UPDATE events SET needed_count = needed_count - $2 WHERE id = $1 RETURNING needed_count", event_id, len(approved))
+            return {"approved": approved, "rejected": rejected, "skipped": skipped, "needed_count": free}
+
+# Спільний хвіст для всіх запитів, що звільняють місце (CTE freed повертає event_id звільненого схваленого місця).
+# Якщо є лист очікування — місце одразу переходить першому в черзі, інакше needed_count + 1.
+# SKIP LOCKED: два паралельні звільнення не підхоплять одну й ту саму людину з черги.
+_PROMOTE_SQL = """
+    head AS (
+        SELECT w.id FROM requests w
+        WHERE w.event_id = (SELECT event_id FROM freed) AND w.status = 'waitlist'
+        ORDER BY w.created_at, w.id LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ), promoted AS (
+        UPDATE requests SET status = 'approved', decided_at = now() WHERE id IN (SELECT id FROM head) RETURNING seeker_id
+    ), ev AS (
+        UPDATE events SET needed_count = needed_count + 1
+        WHERE id = (SELECT event_id FROM freed) AND NOT EXISTS (SELECT 1 FROM promoted)
+        RETURNING needed_count
+    )
+"""
+
+async def _lock_seat(conn, event_id: int, seeker_id: int):
+    """Перед звільненням місця: заявка, потім івент (порядок як в approve_request_atomic — без дедлоків).
+    Наступний запит бере свіжий снапшот уже під замком івенту і бачить усіх, хто встиг стати в чергу"""
+    await conn.execute("SELECT 1 FROM requests WHERE event_id = $1 AND seeker_id = $2 FOR UPDATE", event_id, seeker_id)
+    await conn.execute("SELECT 1 FROM events WHERE id = $1 FOR UPDATE", event_id)
+
+async def leave_event_atomic(event_id: int, seeker_id: int):
+    """Видаляє заявку учасника; звільнене місце віддає черзі або повертає. Повертає (old_status, needed_count, promoted_id)"""
+    async with db_pool.acquire() as conn, conn.transaction():
+        await _lock_seat(conn, event_id, seeker_id)
+        return await conn.fetchrow(f"""
+            WITH rq AS (
+                DELETE FROM requests WHERE event_id = $1 AND seeker_id = $2 RETURNING event_id, status
+            ), freed AS (
+                SELECT event_id FROM rq WHERE status = 'approved'
+            ), {_PROMOTE_SQL}
+            SELECT (SELECT status FROM rq) AS old_status,
+                   COALESCE((SELECT needed_count FROM ev), (SELECT needed_count FROM events WHERE id = $1)) AS needed_count,
+                   (SELECT seeker_id FROM promoted) AS promoted_id
+        """, event_id, seeker_id)
+
+async def kick_participant_atomic(event_id: int, owner_id: int, seeker_id: int):
+    """Організатор вилучає схваленого учасника. Повертає (owner_id, title, req_id, needed_count, promoted_id)"""
+    async with db_pool.acquire() as conn, conn.transaction():
+        await _lock_seat(conn, event_id, seeker_id)
+        return await conn.fetchrow(f"""
+            WITH ev0 AS (
+                SELECT user_id, title FROM events WHERE id = $1
+            ), rq AS (
+                DELETE FROM requests
+                WHERE event_id = $1 AND seeker_id = $3 AND status = 'approved'
+                  AND EXISTS (SELECT 1 FROM ev0 WHERE user_id = $2)
+                RETURNING id, event_id
+            ), freed AS (
+                SELECT event_id FROM rq
+            ), {_PROMOTE_SQL}
+            SELECT (SELECT user_id FROM ev0) AS owner_id, (SELECT title FROM ev0) AS title, (SELECT id FROM rq) AS req_id,
+                   COALESCE((SELECT needed_count FROM ev), (SELECT needed_count FROM events WHERE id = $1)) AS needed_count,
+                   (SELECT seeker_id FROM promoted) AS promoted_id
+        """, event_id, owner_id, seeker_id)
+
+async def promote_waitlist(conn, event_id: int) -> list[int]:
+    """Віддає вільні місця (needed_count) першим у черзі — після збільшення місць організатором.
+    Викликати в транзакції з уже заблокованим рядком івенту. Повертає seeker_id переведених"""
+    return [r['seeker_id'] for r in await conn.fetch("""
+        WITH head AS (
+            SELECT w.id FROM requests w
+            WHERE w.event_id = $1 AND w.status = 'waitlist'
+            ORDER BY w.created_at, w.id
+            LIMIT (SELECT GREATEST(needed_count, 0) FROM events WHERE id = $1)
+            FOR UPDATE SKIP LOCKED
+        ), promoted AS (
+            UPDATE requests SET status = 'approved', decided_at = now() WHERE id IN (SELECT id FROM head) RETURNING seeker_id
+        ), ev AS (
+            UPDATE events SET needed_count = needed_count - (SELECT COUNT(*) FROM promoted)
+            WHERE id = $1 AND EXISTS (SELECT 1 FROM promoted)
+        )
+        SELECT seeker_id FROM promoted
+    """, event_id)]
 
 async def get_user_participations(user_id: int):
     async with db_pool.acquire() as conn:
@@ -184,109 +656,509 @@ async def get_user_participations(user_id: int):
             WHERE r.seeker_id::text = $1 AND r.status != 'rejected' AND r.status != 'cancelled' AND e.status != 'deleted' AND e.date >= now() ORDER BY e.date ASC
         """, str(user_id))
 
-async def get_approved_participants(event_id: int):
+async def get_approved_participants(event_id: int, reachable_only: bool = False):
+    """reachable_only=True — для розсилок: без тих, кому пуші не доходять"""
     async with db_pool.acquire() as conn:
         return await conn.fetch("""
             SELECT u.name, u.telegram_id FROM requests r JOIN users u ON r.seeker_id::text = u.telegram_id::text 
-            WHERE r.event_id = $1 AND r.status = 'approved'
-        """, event_id)
+            WHERE r.event_id = $1 AND r.status = 'approved' AND (u.reachable OR NOT $2)
+        """, event_id, reachable_only)
 
 async def cancel_event_db(event_id: int):
     async with db_pool.acquire() as conn: await conn.execute("UPDATE events SET status = 'deleted' WHERE id = $1", event_id)
 
-async def cancel_request_db(req_id: int, event_id: int, was_approved: bool):
+async def cancel_request_db(req_id: int):
+    """Скасовує заявку одним запитом. Старий статус беремо із заблокованого рядка, а не з того, що бачив хендлер.
+    Повертає (old_status, event_id, needed_count, promoted_id)"""
     async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE requests SET status = 'cancelled' WHERE id = $1", req_id)
-        if was_approved: await conn.execute("UPDATE events SET needed_count = needed_count + 1 WHERE id = $1", event_id)
+        return await conn.fetchrow(f"""
+            WITH old AS (
+                SELECT id, event_id, status FROM requests WHERE id = $1 AND status IN ('pending', 'approved', 'waitlist') FOR UPDATE
+            ), rq AS (
+                UPDATE requests r SET status = 'cancelled' FROM old WHERE r.id = old.id RETURNING old.status, old.event_id
+            ), freed AS (
+                SELECT event_id FROM rq WHERE status = 'approved'
+            ), {_PROMOTE_SQL}
+            SELECT (SELECT status FROM rq) AS old_status, (SELECT event_id FROM rq) AS event_id,
+                   COALESCE((SELECT needed_count FROM ev), (SELECT needed_count FROM events WHERE id = (SELECT event_id FROM rq))) AS needed_count,
+                   (SELECT seeker_id FROM promoted) AS promoted_id
+        """, req_id)
 
-async def get_upcoming_reminders():
-    async with db_pool.acquire() as conn: return await conn.fetch("SELECT * FROM events WHERE status='active' AND date >= now() AND date <= now() + interval '25 hours'")
+# === ВІДКЛАДЕНІ ПУШІ ===
+async def defer_push(recipient_id: int, event_id: int, kind: str, release_at: datetime, count: int = 1):
+    """Зберігає пуш до ранку. Дубль (той самий отримувач, івент і тип) лише додає до лічильника"""
+    async with db_pool.acquire() as conn:
+        await conn.execute("""
+            INSERT INTO deferred_pushes (recipient_id, event_id, kind, count, release_at) VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (recipient_id, event_id, kind) DO UPDATE SET count = deferred_pushes.count + EXCLUDED.count
+        """, recipient_id, event_id, kind, count, release_at)
 
-async def get_past_active_events():
-    async with db_pool.acquire() as conn: return await conn.fetch("SELECT * FROM events WHERE status='active' AND date < now() - interval '2 hours'")
+DEFERRED_LEASE = '5 minutes'  # якщо воркер впав посеред пачки, через стільки її підхопить інший
 
-async def mark_event_finished(event_id: int):
-    async with db_pool.acquire() as conn: await conn.execute("UPDATE events SET status='finished' WHERE id=$1", event_id)
+async def claim_deferred_pushes(limit: int, kinds: list[str]):
+    """Бере в оренду до limit пушів заданих типів, час яких настав (SKIP LOCKED — безпечно для кількох воркерів).
+    Рядки лишаються в таблиці, поки відправник не підтвердить їх через done_deferred_pushes"""
+    async with db_pool.acquire() as conn:
+        return await conn.fetch(f"""
+            UPDATE deferred_pushes SET claimed_until = now() + interval '{DEFERRED_LEASE}' WHERE id IN (
+                SELECT id FROM deferred_pushes
+                WHERE release_at <= now() AND kind = ANY($2::text[]) AND (claimed_until IS NULL OR claimed_until < now())
+                ORDER BY release_at LIMIT $1 FOR UPDATE SKIP LOCKED
+            ) RETURNING id, recipient_id, event_id, kind, count
+        """, limit, kinds)
+
+async def done_deferred_pushes(rows):
+    """Підтверджує відправлені пуші. Якщо поки ми слали, defer_push додав ще (count виріс) — лишаємо залишок у черзі"""
+    if not rows: return
+    async with db_pool.acquire() as conn:
+        await conn.execute("""
+            WITH d AS (SELECT * FROM unnest($1::int[], $2::int[]) AS d(id, sent)),
+            gone AS (DELETE FROM deferred_pushes p USING d WHERE p.id = d.id AND p.count <= d.sent RETURNING p.id)
+            UPDATE deferred_pushes p SET count = p.count - d.sent, claimed_until = NULL
+            FROM d WHERE p.id = d.id AND p.count > d.sent
+        """, [r['id'] for r in rows], [r['count'] for r in rows])
+
+# === НАГАДУВАННЯ: момент відправки зберігається в івенті, цикл лише забирає ті, що настали ===
+# events.date — час за Києвом (так його вводять і показують), тригер переводить його в момент часу і ставить
+# reminder_24h_at / reminder_1h_at; зміна дати скидає прапорці sent. Прострочене більше ніж на REMINDER_GRACE не шлемо
+# ("через 24 години" за 3 години до початку — гірше, ніж нічого).
+REMINDER_GRACE = {'24h': '1 hour', '1h': '30 minutes'}
+
+def _reminders_sql(date_is_tz: bool) -> str:
+    # asyncpg віддає TIMESTAMPTZ в UTC, а код завжди читав його настінний час як київський — тримаємось того ж
+    wall = "NEW.date AT TIME ZONE 'UTC'" if date_is_tz else "NEW.date"
+    return f"""
+        ALTER TABLE events ADD COLUMN IF NOT EXISTS reminder_24h_at TIMESTAMPTZ;
+        ALTER TABLE events ADD COLUMN IF NOT EXISTS reminder_1h_at TIMESTAMPTZ;
+        ALTER TABLE events ADD COLUMN IF NOT EXISTS reminder_24h_sent BOOLEAN NOT NULL DEFAULT false;
+        ALTER TABLE events ADD COLUMN IF NOT EXISTS reminder_1h_sent BOOLEAN NOT NULL DEFAULT false;
+        CREATE INDEX IF NOT EXISTS idx_events_reminder_24h ON events (reminder_24h_at) WHERE status = 'active' AND NOT reminder_24h_sent;
+        CREATE INDEX IF NOT EXISTS idx_events_reminder_1h ON events (reminder_1h_at) WHERE status = 'active' AND NOT reminder_1h_sent;
+
+        CREATE OR REPLACE FUNCTION events_reminders_trg() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' OR NEW.date IS DISTINCT FROM OLD.date THEN
+                NEW.reminder_24h_at := (({wall}) AT TIME ZONE 'Europe/Kiev') - interval '24 hours';
+                NEW.reminder_1h_at := (({wall}) AT TIME ZONE 'Europe/Kiev') - interval '1 hour';
+                NEW.reminder_24h_sent := false;
+                NEW.reminder_1h_sent := false;
+            END IF;
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS trg_events_reminders ON events;
+        CREATE TRIGGER trg_events_reminders BEFORE INSERT OR UPDATE OF date ON events FOR EACH ROW EXECUTE FUNCTION events_reminders_trg();
+    """
+
+async def install_reminders(conn):
+    """Колонки, індекси і тригер нагадувань; для майбутніх івентів без часу нагадувань — заповнює (що вже минуло — як надіслане)"""
+    date_type = await conn.fetchval("SELECT data_type FROM information_schema.columns WHERE table_name = 'events' AND column_name = 'date'")
+    date_is_tz = (date_type or '').startswith('timestamp with')
+    async with conn.transaction():
+        await conn.execute(_reminders_sql(date_is_tz))
+        wall = "date AT TIME ZONE 'UTC'" if date_is_tz else "date"
+        await conn.execute(f"""
+            UPDATE events SET
+                reminder_24h_at = (({wall}) AT TIME ZONE 'Europe/Kiev') - interval '24 hours',
+                reminder_1h_at = (({wall}) AT TIME ZONE 'Europe/Kiev') - interval '1 hour',
+                reminder_24h_sent = (({wall}) AT TIME ZONE 'Europe/Kiev') - interval '24 hours' <= now(),
+                reminder_1h_sent = (({wall}) AT TIME ZONE 'Europe/Kiev') - interval '1 hour' <= now()
+            WHERE status = 'active' AND reminder_1h_at IS NULL AND date IS NOT NULL
+        """)
+
+async def claim_due_reminders():
+    """Нагадування, час яких настав: позначає їх надісланими і повертає (id, title, user_id, kind, org_reachable, participants).
+    Лише індексні діапазони по reminder_*_at; двічі одне нагадування не віддасть навіть двом процесам"""
+    async with db_pool.acquire() as conn:
+        return await conn.fetch(f"""
+            WITH d24 AS (
+                UPDATE events SET reminder_24h_sent = true
+                WHERE status = 'active' AND NOT reminder_24h_sent
+                  AND reminder_24h_at <= now() AND reminder_24h_at > now() - interval '{REMINDER_GRACE['24h']}'
+                RETURNING id, title, user_id, '24h'::text AS kind
+            ), d1 AS (
+                UPDATE events SET reminder_1h_sent = true
+                WHERE status = 'active' AND NOT reminder_1h_sent
+                  AND reminder_1h_at <= now() AND reminder_1h_at > now() - interval '{REMINDER_GRACE['1h']}'
+                RETURNING id, title, user_id, '1h'::text AS kind
+            ), due AS (SELECT * FROM d24 UNION ALL SELECT * FROM d1)
+            SELECT d.id, d.title, d.user_id, d.kind, COALESCE(o.reachable, true) AS org_reachable,
+                   COALESCE(array_agg(u.telegram_id) FILTER (WHERE u.telegram_id IS NOT NULL), '{{}}') AS participants
+            FROM due d
+            LEFT JOIN users o ON o.telegram_id::text = d.user_id::text
+            LEFT JOIN requests r ON r.event_id = d.id AND r.status = 'approved'
+            LEFT JOIN users u ON u.telegram_id::text = r.seeker_id::text AND u.reachable
+            GROUP BY d.id, d.title, d.user_id, d.kind, o.reachable
+        """)
+
+async def finish_due_events(limit: int = 500) -> int:
+    """Закриває пачку минулих івентів і в тому ж запиті ставить досяжним схваленим учасникам прохання оцінити
+    (deferred_pushes, kind 'finish_rate', одразу до відправки). Рестарт після коміту нічого не губить — шле черга.
+    SKIP LOCKED — якщо цикл крутиться і в боті, і в api, кожен івент закриє лише один процес. Повертає кількість закритих"""
+    async with db_pool.acquire() as conn:
+        return await conn.fetchval("""
+            WITH done AS (
+                UPDATE events SET status = 'finished'
+                WHERE id IN (
+                    SELECT id FROM events WHERE status = 'active' AND date < now() - interval '2 hours'
+                    ORDER BY date LIMIT $1 FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id
+            ), queued AS (
+                INSERT INTO deferred_pushes (recipient_id, event_id, kind, release_at)
+                SELECT r.seeker_id, r.event_id, 'finish_rate', now()
+                FROM done d
+                JOIN requests r ON r.event_id = d.id AND r.status = 'approved'
+                JOIN users u ON u.telegram_id::text = r.seeker_id::text AND u.reachable
+                ON CONFLICT (recipient_id, event_id, kind) DO NOTHING
+            )
+            SELECT COUNT(*) FROM done
+        """, limit)
 
 # === НОВА МАТЕМАТИКА РЕЙТИНГУ (АЛГОРИТМ ЗГЛАДЖУВАННЯ) ===
+# Рейтинг = середнє останніх 30 оцінок ролі; поки їх менше 30, бракуючі добиваємо віртуальними "п'ятірками".
+# Все в одному запиті: upsert відгуку + вікно з індексу (нова оцінка + 29 попередніх) + інкремент лічильника голосів.
+# CTE не бачить щойно вставлений рядок, тому нову оцінку додаємо у вікно явно, а старий рядок цього ж відгуку виключаємо.
+VIRTUAL_VOTES = 30
+
+def _reviews_upsert_sql(on_conflict: str) -> str:
+    return f"""
+    WITH d AS (
+        SELECT * FROM unnest($3::bigint[], $4::text[], $5::int[], $6::text[]) AS d(to_user_id, role, score, comment)
+    ), up AS (
+        INSERT INTO reviews (event_id, from_user_id, to_user_id, role_evaluated, score, comment)
+        SELECT $1, $2, to_user_id, role, score, comment FROM d
+        ON CONFLICT (event_id, from_user_id, to_user_id) {on_conflict}
+        RETURNING to_user_id, (xmax = 0) AS inserted
+    ), agg AS (
+        SELECT d.to_user_id, d.role, CASE WHEN up.inserted THEN 1 ELSE 0 END AS new_vote,
+               1 + COUNT(o.score) AS n, d.score + COALESCE(SUM(o.score), 0) AS s
+        FROM d JOIN up ON up.to_user_id = d.to_user_id
+        LEFT JOIN LATERAL (
+            SELECT r.score FROM reviews r
+            WHERE r.to_user_id = d.to_user_id AND r.role_evaluated = d.role AND NOT (r.event_id = $1 AND r.from_user_id = $2)
+            ORDER BY r.created_at DESC LIMIT {VIRTUAL_VOTES - 1}
+        ) o ON true
+        GROUP BY d.to_user_id, d.role, d.score, up.inserted
+    ), rated AS (
+        SELECT to_user_id, role, new_vote,
+               round(CASE WHEN n < {VIRTUAL_VOTES} THEN (s + ({VIRTUAL_VOTES} - n) * 5.0) / {VIRTUAL_VOTES} ELSE s::numeric / n END, 2) AS rating
+        FROM agg
+    )
+    UPDATE users u SET
+        rating_org  = CASE WHEN rated.role = 'organizer' THEN rated.rating ELSE u.rating_org END,
+        votes_org   = CASE WHEN rated.role = 'organizer' THEN COALESCE(u.votes_org, 0) + rated.new_vote ELSE u.votes_org END,
+        rating_part = CASE WHEN rated.role = 'organizer' THEN u.rating_part ELSE rated.rating END,
+        votes_part  = CASE WHEN rated.role = 'organizer' THEN u.votes_part ELSE COALESCE(u.votes_part, 0) + rated.new_vote END
+    FROM rated WHERE u.telegram_id = rated.to_user_id
+    RETURNING u.telegram_id AS to_user_id, rated.rating, rated.new_vote = 1 AS inserted
+"""
+
+# Повторна оцінка перезаписує стару (бот, "всім по 5") або пропускається (веб-форма: already_rated)
+_REVIEWS_UPSERT_SQL = _reviews_upsert_sql("DO UPDATE SET score = EXCLUDED.score, comment = COALESCE(EXCLUDED.comment, reviews.comment), created_at = now()")
+_REVIEWS_INSERT_NEW_SQL = _reviews_upsert_sql("DO NOTHING")
+
+async def add_reviews_batch(event_id: int, from_user_id: int, items: list[tuple], conn=None, overwrite: bool = True):
+    """Пачка відгуків від одного юзера за один івент: items = [(to_user_id, role_evaluated, score[, comment]), ...]. Один запит.
+    Повертає рядки (to_user_id, rating, inserted) лише для записаних відгуків"""
+    # Один відгук на кожного адресата (ключ reviews — event, from, to); останній перемагає
+    uniq = {it[0]: (it[1], it[2], it[3] if len(it) > 3 else None) for it in items}
+    if not uniq: return []
+    args = (event_id, from_user_id, list(uniq), [v[0] for v in uniq.values()], [v[1] for v in uniq.values()], [v[2] for v in uniq.values()])
+    sql = _REVIEWS_UPSERT_SQL if overwrite else _REVIEWS_INSERT_NEW_SQL
+    if conn is not None:
+        return await conn.fetch(sql, *args)
+    async with db_pool.acquire() as conn:
+        return await conn.fetch(sql, *args)
+
 async def add_review_and_update_rating(event_id: int, from_user_id: int, to_user_id: int, role_evaluated: str, score: int):
     if not db_pool: return
+    try:
+        await add_reviews_batch(event_id, from_user_id, [(to_user_id, role_evaluated, score)])
+    except Exception as e:
+        logging.error(f"Помилка збереження рейтингу та оновлення профілю: {e}")
+
+# === ЩОДЕННІ АГРЕГАТИ (ROLLUP) ДЛЯ АДМІНКИ ===
+# Дельти дня рахуються діапазоном по created_at (індекси), схвалення — по decided_at (день рішення, а не подачі заявки),
+# знімок активності/тоталів — раз на прохід фонової задачі
+_STATS_DELTAS_SQL = """
+    INSERT INTO stats_daily (day, new_users, events_created, requests, approvals, reports, updated_at)
+    SELECT d::date,
+        (SELECT COUNT(*) FROM users WHERE created_at >= d AND created_at < d + interval '1 day'),
+        (SELECT COUNT(*) FROM events WHERE created_at >= d AND created_at < d + interval '1 day'),
+        (SELECT COUNT(*) FROM requests WHERE created_at >= d AND created_at < d + interval '1 day'),
+        (SELECT COUNT(*) FROM requests WHERE decided_at >= d AND decided_at < d + interval '1 day' AND status = 'approved'),
+        (SELECT COUNT(*) FROM reports WHERE created_at >= d AND created_at < d + interval '1 day'),
+        now()
+    FROM generate_series(COALESCE($1::date, CURRENT_DATE - 1), CURRENT_DATE, interval '1 day') d
+    ON CONFLICT (day) DO UPDATE SET
+        new_users = EXCLUDED.new_users, events_created = EXCLUDED.events_created, requests = EXCLUDED.requests,
+        approvals = EXCLUDED.approvals, reports = EXCLUDED.reports, updated_at = now()
+"""
+
+async def install_stats_rollup(conn):
+    """Створює stats_daily та індекси під діапазонні підрахунки; при першому запуску заповнює історію"""
+    # Старим юзерам дата реєстрації невідома — лишаємо NULL, щоб не записати їх усіх у "нові" сьогодні
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ;")
+    await conn.execute("ALTER TABLE users ALTER COLUMN created_at SET DEFAULT now();")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at);")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active);")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_events_created_at ON events (created_at);")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_created_at ON requests (created_at);")
+    # Час рішення по заявці. Старим схваленим він невідомий — один раз, при додаванні колонки, беремо час подачі,
+    # як рахували до її появи. Далі кожен шлях зміни статусу ставить decided_at сам
+    has_decided = await conn.fetchval("SELECT 1 FROM information_schema.columns WHERE table_schema = 'public' AND table_name = 'requests' AND column_name = 'decided_at'")
+    await conn.execute("ALTER TABLE requests ADD COLUMN IF NOT EXISTS decided_at TIMESTAMPTZ;")
+    if not has_decided:
+        await conn.execute("UPDATE requests SET decided_at = created_at WHERE status IN ('approved', 'rejected');")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_decided_at ON requests (decided_at) WHERE status = 'approved';")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_created_at ON reports (created_at);")
+    is_new = not await conn.fetchval("SELECT to_regclass('public.stats_daily') IS NOT NULL")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day DATE PRIMARY KEY,
+            new_users INT NOT NULL DEFAULT 0, events_created INT NOT NULL DEFAULT 0,
+            requests INT NOT NULL DEFAULT 0, approvals INT NOT NULL DEFAULT 0, reports INT NOT NULL DEFAULT 0,
+            dau INT, wau INT, mau INT,
+            total_users INT, active_events INT, total_requests INT, total_reports INT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    if is_new:
+        first_day = await conn.fetchval("SELECT LEAST((SELECT MIN(created_at) FROM events), (SELECT MIN(created_at) FROM requests), (SELECT MIN(created_at) FROM reports))::date")
+        if first_day: await conn.execute(_STATS_DELTAS_SQL, first_day)
+
+async def refresh_stats_rollup():
+    """Оновлює агрегати за вчора (добиваємо хвіст дня) і сьогодні + знімок активності/тоталів на сьогодні"""
     async with db_pool.acquire() as conn:
-        try:
-            # 1. Записуємо або оновлюємо відгук
+        async with conn.transaction():
+            await conn.execute(_STATS_DELTAS_SQL, None)
             await conn.execute("""
-                INSERT INTO reviews (event_id, from_user_id, to_user_id, role_evaluated, score) 
-                VALUES ($1, $2, $3, $4, $5)
-                ON CONFLICT (event_id, from_user_id, to_user_id) 
-                DO UPDATE SET score = EXCLUDED.score, created_at = now()
-            """, event_id, from_user_id, to_user_id, role_evaluated, score)
-            
-            # 2. Беремо останні 30 відгуків для цієї ролі
-            reviews = await conn.fetch("""
-                SELECT score FROM reviews 
-                WHERE to_user_id = $1 AND role_evaluated = $2 
-                ORDER BY created_at DESC LIMIT 30
-            """, to_user_id, role_evaluated)
-            
-            real_votes = len(reviews)
-            if real_votes == 0: return
-                
-            real_sum = sum(r['score'] for r in reviews)
-            
-            # 3. Формула довіри (згладжування)
-            # Беремо 30 віртуальних "п'ятірок", щоб оцінка не падала різко
-            VIRTUAL_VOTES = 30
-            if real_votes < VIRTUAL_VOTES:
-                new_rating = (real_sum + (VIRTUAL_VOTES - real_votes) * 5.0) / VIRTUAL_VOTES
-            else:
-                new_rating = real_sum / real_votes
-            
-            new_rating = round(new_rating, 2)
-            
-            # 4. Оновлюємо статистику в users (використовуємо пряме порівняння bigint)
-            if role_evaluated == 'organizer':
-                await conn.execute("""
-                    UPDATE users SET rating_org = $1, votes_org = (SELECT COUNT(*) FROM reviews WHERE to_user_id = $2 AND role_evaluated = 'organizer') 
-                    WHERE telegram_id = $3
-                """, new_rating, to_user_id, to_user_id)
-            else:
-                await conn.execute("""
-                    UPDATE users SET rating_part = $1, votes_part = (SELECT COUNT(*) FROM reviews WHERE to_user_id = $2 AND role_evaluated = 'participant') 
-                    WHERE telegram_id = $3
-                """, new_rating, to_user_id, to_user_id)
-                
-        except Exception as e:
-            logging.error(f"Помилка збереження рейтингу та оновлення профілю: {e}")
+                UPDATE stats_daily SET
+                    dau = (SELECT COUNT(*) FROM users WHERE last_active >= now() - interval '24 hours'),
+                    wau = (SELECT COUNT(*) FROM users WHERE last_active >= now() - interval '7 days'),
+                    mau = (SELECT COUNT(*) FROM users WHERE last_active >= now() - interval '30 days'),
+                    total_users = (SELECT COUNT(*) FROM users),
+                    active_events = (SELECT COUNT(*) FROM events WHERE status = 'active'),
+                    total_requests = (SELECT COUNT(*) FROM requests),
+                    total_reports = (SELECT COUNT(*) FROM reports),
+                    updated_at = now()
+                WHERE day = CURRENT_DATE
+            """)
+
+async def get_admin_stats(days: int = 7):
+    """Один запит до stats_daily: сьогоднішній знімок + тренд за останні дні"""
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT *, day = CURRENT_DATE AS is_today FROM stats_daily WHERE day > CURRENT_DATE - $1::int ORDER BY day DESC", days)
+    if not rows or not rows[0]['is_today'] or rows[0]['total_users'] is None:
+        # Фонова задача ще не відпрацювала сьогодні — рахуємо один раз на місці
+        await refresh_stats_rollup()
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch("SELECT *, day = CURRENT_DATE AS is_today FROM stats_daily WHERE day > CURRENT_DATE - $1::int ORDER BY day DESC", days)
+    today = rows[0]
+    return {"users": today['total_users'], "dau": today['dau'], "wau": today['wau'], "mau": today['mau'],
+            "events": today['active_events'], "requests": today['total_requests'], "reports": today['total_reports'],
+            "trend": [dict(r) for r in rows]}
+
+# === СКАРГИ: ЛІЧИЛЬНИКИ ЗАМІСТЬ COUNT ПО ВСІХ СКАРГАХ ===
+# Бан лише коли скаржились AUTOBAN_REPORTERS різних людей — один юзер сам не заблокує нікого
+AUTOBAN_REPORTERS = 3
+
+async def install_report_counters(conn):
+    """Лічильники скарг на організатора + множина тих, хто скаржився; при першому запуску заповнює з reports"""
+    async with conn.transaction():
+        is_new = not await conn.fetchval("SELECT to_regclass('public.report_counters') IS NOT NULL")
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS report_counters (
+                user_id BIGINT PRIMARY KEY, reports INT NOT NULL DEFAULT 0, reporters INT NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS report_reporters (
+                user_id BIGINT NOT NULL, reporter_id BIGINT NOT NULL, PRIMARY KEY (user_id, reporter_id)
+            );
+        """)
+        if is_new:
+            await conn.execute("""
+                INSERT INTO report_reporters (user_id, reporter_id)
+                SELECT DISTINCT e.user_id::bigint, r.reporter_id FROM reports r JOIN events e ON e.id = r.event_id;
+                INSERT INTO report_counters (user_id, reports, reporters)
+                SELECT e.user_id::bigint, COUNT(*), COUNT(DISTINCT r.reporter_id) FROM reports r JOIN events e ON e.id = r.event_id GROUP BY 1;
+            """)
 
-async def get_admin_stats():
+async def ban_user_cascade(user_id: int, conn=None) -> list[int]:
+    """Блокує юзера і видаляє всі його івенти одним запитом. Повертає id видалених івентів (для чистки кешів)"""
+    sql = """
+        WITH u AS (UPDATE users SET status = 'blocked' WHERE telegram_id = $1)
+        UPDATE events SET status = 'deleted' WHERE user_id = $1 AND status <> 'deleted' RETURNING id
+    """
+    if conn is not None:
+        return [r['id'] for r in await conn.fetch(sql, user_id)]
     async with db_pool.acquire() as conn:
-        users = await conn.fetchval("SELECT COUNT(*) FROM users")
-        dau = await conn.fetchval("SELECT COUNT(*) FROM users WHERE last_active >= now() - interval '24 hours'")
-        wau = await conn.fetchval("SELECT COUNT(*) FROM users WHERE last_active >= now() - interval '7 days'")
-        mau = await conn.fetchval("SELECT COUNT(*) FROM users WHERE last_active >= now() - interval '30 days'")
-        events = await conn.fetchval("SELECT COUNT(*) FROM events WHERE status='active'")
-        reqs = await conn.fetchval("SELECT COUNT(*) FROM requests")
-        reports = await conn.fetchval("SELECT COUNT(*) FROM reports")
-        return {"users": users, "dau": dau, "wau": wau, "mau": mau, "events": events, "requests": reqs, "reports": reports}
+        return [r['id'] for r in await conn.fetch(sql, user_id)]
 
 async def save_report_db(reporter_id: int, event_id: int, reason: str):
+    """Записує скаргу і атомарно оновлює лічильники організатора. Якщо спрацював авто-бан — повертає (user_id, [id видалених івентів])"""
     async with db_pool.acquire() as conn:
-        # 1. Записуємо скаргу
-        await conn.execute("INSERT INTO reports (reporter_id, event_id, reason) VALUES ($1, $2, $3)", reporter_id, event_id, reason)
-        
-        # 2. Знаходимо, на кого скаржаться (організатор івенту)
-        reported_user_id = await conn.fetchval("SELECT user_id FROM events WHERE id = $1", event_id)
-        
-        if reported_user_id:
-            # 3. Рахуємо загальну кількість скарг на цього користувача
-            reports_count = await conn.fetchval("""
-                SELECT COUNT(*) FROM reports r 
-                JOIN events e ON r.event_id = e.id 
-                WHERE e.user_id = $1
-            """, reported_user_id)
-            
-            # 4. Якщо скарг 3 або більше — блокуємо
-            if reports_count >= 3:
-                await conn.execute("UPDATE users SET status = 'blocked' WHERE telegram_id = $1", reported_user_id)
-                await conn.execute("UPDATE events SET status = 'deleted' WHERE user_id = $1", reported_user_id)
-                logging.warning(f"АВТО-БАН: Користувач {reported_user_id} заблокований через {reports_count} скарг.")
+        async with conn.transaction():
+            row = await conn.fetchrow("""
+                WITH rep AS (
+                    INSERT INTO reports (reporter_id, event_id, reason) VALUES ($1, $2, $3) RETURNING event_id
+                ), target AS (
+                    SELECT e.user_id::bigint AS uid FROM events e JOIN rep ON rep.event_id = e.id
+                ), pair AS (
+                    INSERT INTO report_reporters (user_id, reporter_id) SELECT uid, $1 FROM target
+                    ON CONFLICT DO NOTHING RETURNING user_id
+                ), cnt AS (
+                    INSERT INTO report_counters (user_id, reports, reporters)
+                    SELECT uid, 1, (SELECT COUNT(*) FROM pair) FROM target
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        reports = report_counters.reports + 1, reporters = report_counters.reporters + EXCLUDED.reporters
+                    RETURNING user_id, reports, reporters
+                )
+                SELECT cnt.*, EXISTS (SELECT 1 FROM pair) AS new_reporter FROM cnt
+            """, reporter_id, event_id, reason)
+
+            # Банимо рівно в момент, коли новий скаржник добив поріг
+            if row and row['new_reporter'] and row['reporters'] == AUTOBAN_REPORTERS:
+                deleted = await ban_user_cascade(row['user_id'], conn)
+                logging.warning(f"АВТО-БАН: Користувач {row['user_id']} заблокований через скарги {row['reporters']} людей ({row['reports']} скарг).")
+                return row['user_id'], deleted
+    return None
+
+# === РОЗСИЛКИ АДМІНА: сегмент юзерів + курсор-чекпоінт ===
+# Отримувачі йдуть сторінками по telegram_id (keyset по первинному ключу), позиція пишеться в broadcasts.cursor_id
+# після кожної пачки — після рестарту розсилка продовжується з останньої збереженої позиції.
+BROADCAST_RATE = 20  # повідомлень/с за замовчуванням (загальний ліміт fan-out все одно діє)
+
+async def install_broadcasts(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY, text TEXT NOT NULL,
+            city TEXT, interest TEXT, active_days INT, user_ids BIGINT[],
+            rate INT NOT NULL DEFAULT 20, status TEXT NOT NULL DEFAULT 'running',
+            total INT NOT NULL DEFAULT 0, sent INT NOT NULL DEFAULT 0, failed INT NOT NULL DEFAULT 0, unreachable INT NOT NULL DEFAULT 0,
+            cursor_id BIGINT NOT NULL DEFAULT 0, lease_until TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(), updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), finished_at TIMESTAMPTZ
+        );
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts (id) WHERE status = 'running';")
+    # Ключ міста юзера рахує лише utils.normalize_city (при збереженні профілю) — SQL-копія нормалізації не розійдеться з нею
+    is_new = not await conn.fetchval("SELECT 1 FROM information_schema.columns WHERE table_schema = 'public' AND table_name = 'users' AND column_name = 'city_key'")
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS city_key TEXT;")
+    if is_new:
+        cities = [r['city'] for r in await conn.fetch("SELECT DISTINCT city FROM users WHERE city IS NOT NULL")]
+        keys = [normalize_city(c) for c in cities]
+        await conn.execute("""
+            UPDATE users u SET city_key = m.key FROM unnest($1::text[], $2::text[]) AS m(city, key)
+            WHERE u.city = m.city AND m.key IS NOT NULL
+        """, cities, keys)
+
+# Сегмент: місто (ключ з utils.CITIES), інтерес (підрядок), активність за N днів, явний список id. NULL = без фільтра
+_SEGMENT_SQL = """
+    FROM users u
+    WHERE u.reachable AND COALESCE(u.status, 'active') <> 'blocked'
+      AND ($1::text IS NULL OR u.city_key = $1)
+      AND ($2::text IS NULL OR u.interests ILIKE '%' || $2 || '%')
+      AND ($3::int IS NULL OR u.last_active >= now() - make_interval(days => $3))
+      AND ($4::bigint[] IS NULL OR u.telegram_id = ANY($4::bigint[]))
+"""
+
+def _segment_args(city, interest, active_days, user_ids):
+    return city or None, interest or None, active_days, list(user_ids) if user_ids else None
+
+async def count_segment(city=None, interest=None, active_days=None, user_ids=None) -> int:
+    async with db_pool.acquire() as conn:
+        return await conn.fetchval(f"SELECT COUNT(*) {_SEGMENT_SQL}", *_segment_args(city, interest, active_days, user_ids))
+
+async def create_broadcast(text: str, city=None, interest=None, active_days=None, user_ids=None, rate: int = BROADCAST_RATE):
+    """Ставить розсилку в чергу (її підхопить broadcast_loop). Повертає (id, кількість отримувачів на зараз)"""
+    async with db_pool.acquire() as conn:
+        total = await conn.fetchval(f"SELECT COUNT(*) {_SEGMENT_SQL}", *_segment_args(city, interest, active_days, user_ids))
+        bid = await conn.fetchval("""
+            INSERT INTO broadcasts (text, city, interest, active_days, user_ids, rate, total)
+            VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id
+        """, text, city, interest or None, active_days, list(user_ids) if user_ids else None, rate, total)
+    return bid, total
+
+async def claim_running_broadcast():
+    """Бере активну розсилку в оренду на пачку: бот і api можуть крутити broadcast_loop одночасно, але пачку шле один"""
+    async with db_pool.acquire() as conn:
+        return await conn.fetchrow("""
+            UPDATE broadcasts SET lease_until = now() + interval '5 minutes'
+            WHERE id = (
+                SELECT id FROM broadcasts WHERE status = 'running' AND (lease_until IS NULL OR lease_until < now())
+                ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *
+        """)
+
+async def next_broadcast_batch(b, limit: int) -> list[int]:
+    """Наступна сторінка отримувачів після cursor_id (по індексу первинного ключа users)"""
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(f"SELECT u.telegram_id {_SEGMENT_SQL} AND u.telegram_id > $5 ORDER BY u.telegram_id LIMIT $6",
+                                *_segment_args(b['city'], b['interest'], b['active_days'], b['user_ids']), b['cursor_id'], limit)
+    return [r['telegram_id'] for r in rows]
+
+async def checkpoint_broadcast(broadcast_id: int, cursor_id: int, sent: int, failed: int, unreachable: int, done: bool):
+    """Фіксує пачку: лічильники + позиція курсора; done закриває розсилку (скасовану не перезаписує)"""
+    async with db_pool.acquire() as conn:
+        await conn.execute("""
+            UPDATE broadcasts SET cursor_id = $2, sent = sent + $3, failed = failed + $4, unreachable = unreachable + $5,
+                updated_at = now(), lease_until = NULL,
+                status = CASE WHEN $6 AND status = 'running' THEN 'done' ELSE status END,
+                finished_at = CASE WHEN $6 AND status = 'running' THEN now() ELSE finished_at END
+            WHERE id = $1
+        """, broadcast_id, cursor_id, sent, failed, unreachable, done)
+
+async def cancel_broadcast(broadcast_id: int) -> bool:
+    async with db_pool.acquire() as conn:
+        return await conn.fetchval("""
+            UPDATE broadcasts SET status = 'cancelled', finished_at = now() WHERE id = $1 AND status = 'running' RETURNING true
+        """, broadcast_id) or False
+
+async def get_broadcasts_progress(limit: int = 3):
+    """Активні розсилки + завершені за добу (для /admin)"""
+    async with db_pool.acquire() as conn:
+        return await conn.fetch("""
+            SELECT * FROM broadcasts WHERE status = 'running' OR finished_at > now() - interval '1 day'
+            ORDER BY id DESC LIMIT $1
+        """, limit)
+
+
+if __name__ == "__main__":
+    # Стрес-тест атомарних схвалень: python database.py [N]
+    # Потрібна ТЕСТОВА база в DATABASE_URL (і будь-який BOT_TOKEN). N заявок б'ються за останнє місце — схвалена рівно одна,
+    # needed_count ніколи не йде нижче 0. Тимчасові юзери/івент/заявки видаляються в кінці.
+    import asyncio
+    import sys
+
+    async def _stress_last_seat(n: int):
+        await init_db_pool()
+        org_id, seekers = 990000000001, [990000001000 + i for i in range(n)]
+        async with db_pool.acquire() as conn:
+            await conn.executemany("INSERT INTO users (telegram_id, phone, name, city) VALUES ($1, '', 'stress', 'Київ') ON CONFLICT DO NOTHING",
+                                   [(uid,) for uid in [org_id] + seekers])
+            event_id = await conn.fetchval("""
+                INSERT INTO events (user_id, creator_name, title, description, date, location, capacity, needed_count, status)
+                VALUES ($1, 'stress', 'stress: last seat', '', now() + interval '7 days', 'Київ', 2, 1, 'active') RETURNING id
+            """, org_id)
+            await conn.executemany("INSERT INTO requests (event_id, seeker_id, status) VALUES ($1, $2, 'pending')",
+                                   [(event_id, sid) for sid in seekers])
+        try:
+            results = await asyncio.gather(*(approve_request_atomic(event_id, sid) for sid in seekers))
+            async with db_pool.acquire() as conn:
+                needed = await conn.fetchval("SELECT needed_count FROM events WHERE id = $1", event_id)
+                approved = await conn.fetchval("SELECT COUNT(*) FROM requests WHERE event_id = $1 AND status = 'approved'", event_id)
+            oks = sum(r['ok'] for r in results)
+            print(f"{n} паралельних схвалень: ok={oks}, full={sum(r['error'] == 'full' for r in results)}, "
+                  f"approved у БД={approved}, needed_count={needed}")
+            assert oks == 1 and approved == 1, "схвалено не рівно одну заявку"
+            assert needed == 0 and all((r['needed_count'] or 0) >= 0 for r in results), "needed_count пішов нижче 0"
+            print("OK")
+        finally:
+            async with db_pool.acquire() as conn:
+                await conn.execute("DELETE FROM requests WHERE event_id = $1", event_id)
+                await conn.execute("DELETE FROM events WHERE id = $1", event_id)
+                await conn.execute("DELETE FROM users WHERE telegram_id = ANY($1::bigint[])", [org_id] + seekers)
+            await db_pool.close()
+
+    asyncio.run(_stress_last_seat(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database
+
+# === МАСОВІ ПУШІ (FAN-OUT) ===
+# Отримувачів вибирають ДО розсилки і відпускають з'єднання з пулом — розсилка не тримає БД.
+# Далі паралельно, але не більше FANOUT_CONCURRENCY одночасних запитів і не швидше FANOUT_RATE повідомлень на секунду
+# на весь процес (ліміт Bot API ~30/с на бота спільний для всіх розсилок). RetryAfter від Telegram — чекаємо і пробуємо ще раз.
+# Кому пуш не дійшов назавжди (403, chat not found) — позначаються users.reachable = false, і запити отримувачів їх відсіюють.
+
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "8"))
+FANOUT_RATE = int(os.getenv("FANOUT_RATE", "25"))
+FANOUT_RETRIES = 2
+
+OK, BLOCKED, FAILED = "ok", "blocked", "failed"
+
+
+class RateLimiter:
+    """Рівномірно видає слоти: не більше rate на секунду для всіх, хто чекає"""
+
+    def __init__(self, rate: int):
+        self.interval = 1 / rate
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0: await asyncio.sleep(delay)
+
+
+limiter = RateLimiter(FANOUT_RATE)
+
+
+async def send_one(bot, chat_id: int, text: str, pace: RateLimiter | None = None, **kwargs) -> str:
+    """Одне повідомлення під спільним лімітом (і власним pace, якщо заданий); результат — OK / BLOCKED / FAILED"""
+    for _ in range(FANOUT_RETRIES):
+        if pace: await pace.wait()
+        await limiter.wait()
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+            return OK
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError:
+            return BLOCKED
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e).lower(): return BLOCKED
+            logging.warning(f"Пуш {chat_id} не доставлено: {e}")
+            return FAILED
+        except Exception as e:
+            logging.warning(f"Пуш {chat_id} не доставлено: {e}")
+            return FAILED
+    return FAILED
+
+
+async def send_to(bot, chat_id: int, text: str, **kwargs) -> str:
+    """Окремий пуш одному юзеру: як send_one, але недосяжного одразу позначаємо в БД"""
+    result = await send_one(bot, chat_id, text, **kwargs)
+    if result == BLOCKED:
+        try: await database.mark_unreachable([chat_id])
+        except Exception as e: logging.error(f"Не вдалося позначити недосяжного юзера {chat_id}: {e}")
+    return result
+
+
+async def send_many(bot, chat_ids, text: str, pace: RateLimiter | None = None, **kwargs) -> dict[int, str]:
+    """Один текст багатьом: {chat_id: результат}. Дублікати і None відкидаються, недосяжні записуються в БД одним запитом"""
+    ids = list(dict.fromkeys(c for c in chat_ids if c))
+    sem = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def one(chat_id):
+        async with sem: return await send_one(bot, chat_id, text, pace, **kwargs)
+
+    results = dict(zip(ids, await asyncio.gather(*(one(c) for c in ids))))
+    gone = [c for c, r in results.items() if r == BLOCKED]
+    if gone:
+        try: await database.mark_unreachable(gone)
+        except Exception as e: logging.error(f"Не вдалося позначити недосяжних юзерів: {e}")
+    return results
+
+
+# === РОЗСИЛКИ АДМІНА ===
+# Цикл можна крутити в кількох процесах одночасно (бот, api, hobby_bot): пачку бере в оренду лише один
+BROADCAST_BATCH = 100  # скільки отримувачів між чекпоінтами (після рестарту максимум стільки можуть отримати повтор)
+_broadcast_paces: dict[int, RateLimiter] = {}
+
+
+async def broadcast_loop(bot):
+    """Фоновий процес: шле активну розсилку пачками і після кожної зберігає позицію — рестарт продовжує з неї"""
+    await asyncio.sleep(10)
+    while True:
+        b = None
+        if database.db_pool:
+            try:
+                b = await database.claim_running_broadcast()
+                if b:
+                    ids = await database.next_broadcast_batch(b, BROADCAST_BATCH)
+                    pace = _broadcast_paces.setdefault(b['rate'], RateLimiter(b['rate']))
+                    results = await send_many(bot, ids, b['text'], pace=pace)
+                    outcomes = list(results.values())
+                    await database.checkpoint_broadcast(b['id'], ids[-1] if ids else b['cursor_id'], outcomes.count(OK),
+                                                        outcomes.count(FAILED), outcomes.count(BLOCKED), done=len(ids) < BROADCAST_BATCH)
+            except Exception as e:
+                logging.error(f"Помилка у broadcast_loop: {e}")
+                b = None
+        await asyncio.sleep(0 if b else 15)
@@ -9,7 +9,10 @@ from datetime import datetime, timedelta, timezone, date
 from math import radians, sin, cos, acos
 
 import asyncpg
-from aiogram import Bot, Dispatcher, types, F
+import database
+from fanout import send_many, broadcast_loop
+from utils import normalize_city
+from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton,
@@ -29,6 +32,18 @@ if not BOT_TOKEN or not DATABASE_URL:
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+
+class ActivityMiddleware(BaseMiddleware):
+    """Як у main.py: будь-яка дія юзера оновлює last_active і знову робить його досяжним для пушів"""
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user: await database.update_user_activity(user.id)
+        return await handler(event, data)
+
+
+dp.message.middleware(ActivityMiddleware())
+dp.callback_query.middleware(ActivityMiddleware())
+
 # ========= In-memory FSM + timers =========
 user_states: dict[int, dict] = {}
 
@@ -331,9 +346,11 @@ def tg_link_from_username(username: str | None) -> str:
 
 # ========= DB helpers =========
 async def init_db():
+    # ---- Общий пул подключений (как в main.py), без connect/close на каждый вызов ----
+    await database.init_db_pool()
+
     # ---- Таблица рейтингов ----
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         await conn.execute("""
         CREATE TABLE IF NOT EXISTS ratings (
             id SERIAL PRIMARY KEY,
@@ -346,12 +363,19 @@ async def init_db():
             UNIQUE(event_id, seeker_id)
         );
         """)
-    finally:
-        await conn.close()
+        # триггер user_stats на ratings (если таблица появилась только сейчас)
+        await database.install_user_stats(conn)
+
+    # ---- Индексы чатов: история по беседе и поиск просроченных ----
+    async with database.db_pool.acquire() as conn:
+        try:
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_conv_created ON messages (conv_id, created_at DESC);")
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_active_expires ON conversations (expires_at) WHERE status = 'active';")
+        except Exception as e:
+            logging.warning("chat indexes: %s", e)
 
     # ---- Таблица подписок на уведомления ----
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         await conn.execute("""
         CREATE TABLE IF NOT EXISTS event_notifications (
             id SERIAL PRIMARY KEY,
@@ -366,31 +390,23 @@ async def init_db():
             created_at TIMESTAMPTZ NOT NULL DEFAULT now()
         );
         """)
-    finally:
-        await conn.close()
 
                 
    
 
 async def get_user_from_db(user_id: int) -> asyncpg.Record | None:
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         return await conn.fetchrow("SELECT * FROM users WHERE telegram_id::text = $1", str(user_id))
-    finally:
-        await conn.close()
 
 async def save_user_to_db(user_id: int, phone: str, name: str, city: str, photo: str, interests: str):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         await conn.execute("""
-            INSERT INTO users (telegram_id, phone, name, city, photo, interests)
-            VALUES ($1,$2,$3,$4,$5,$6)
+            INSERT INTO users (telegram_id, phone, name, city, photo, interests, city_key)
+            VALUES ($1,$2,$3,$4,$5,$6,$7)
             ON CONFLICT (telegram_id) DO UPDATE SET
               phone=EXCLUDED.phone, name=EXCLUDED.name, city=EXCLUDED.city,
-              photo=EXCLUDED.photo, interests=EXCLUDED.interests
-        """, user_id, phone, name, city, photo, interests)
-    finally:
-        await conn.close()
+              photo=EXCLUDED.photo, interests=EXCLUDED.interests, city_key=EXCLUDED.city_key
+        """, user_id, phone, name, city, photo, interests, normalize_city(city))
 
 async def save_event_to_db(
     user_id: int, creator_name: str, creator_phone: str,
@@ -399,32 +415,26 @@ async def save_event_to_db(
     location_lat: float | None = None, location_lon: float | None = None,
     photo: str | None = None
 ):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         row = await conn.fetchrow("""
             INSERT INTO events (
                 user_id, creator_name, creator_phone, title,
                 description, date, location, capacity, needed_count, status,
-                location_lat, location_lon, photo
-            ) VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13)
+                location_lat, location_lon, photo, city
+            ) VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14)
             RETURNING *
         """, user_id, creator_name or '', creator_phone or '', title, description, date, location,
-           capacity, needed_count, status, location_lat, location_lon, photo)
+           capacity, needed_count, status, location_lat, location_lon, photo, normalize_city(location))
         return row
-    finally:
-        await conn.close()
 
 
 async def update_event_status(event_id: int, owner_id: int, new_status: str) -> bool:
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         res = await conn.execute("""
             UPDATE events SET status=$3
             WHERE id=$1 AND user_id::text=$2
         """, event_id, str(owner_id), new_status)
         return res.startswith("UPDATE")
-    finally:
-        await conn.close()
 
 async def update_event_field(event_id: int, owner_id: int, field: str, value):
     whitelist = {
@@ -434,16 +444,17 @@ async def update_event_field(event_id: int, owner_id: int, field: str, value):
     if field not in whitelist:
         raise ValueError("field not allowed")
     sql = f"UPDATE events SET {field}=$3 WHERE id=$1 AND user_id::text=$2"
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
-        res = await conn.execute(sql, event_id, str(owner_id), value)
+    args = [event_id, str(owner_id), value]
+    if field == "location":
+        # Нова адреса — нове місто для міських стрічок
+        sql = "UPDATE events SET location=$3, city=$4 WHERE id=$1 AND user_id::text=$2"
+        args.append(normalize_city(value))
+    async with database.db_pool.acquire() as conn:
+        res = await conn.execute(sql, *args)
         return res.startswith("UPDATE")
-    finally:
-        await conn.close()
 
 async def list_user_events(user_id: int, filter_kind: str | None = None):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         rows = await conn.fetch("""
             WITH mine AS (
                 SELECT e.id, e.title, e.date, e.needed_count, e.capacity, e.status, e.created_at,
@@ -467,8 +478,6 @@ async def list_user_events(user_id: int, filter_kind: str | None = None):
             FROM allrows
             ORDER BY id, role_order
         """, str(user_id))
-    finally:
-        await conn.close()
 
     def is_active(st):   return st in ('active','collected')
     def is_finished(st): return st in ('finished',)
@@ -484,8 +493,7 @@ async def list_user_events(user_id: int, filter_kind: str | None = None):
     return sorted(rows, key=lambda r: (r['date'] or datetime.max, r['created_at'] or datetime.max))
 
 async def list_pending_requests(event_id: int):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         return await conn.fetch("""
             SELECT r.id AS req_id, r.seeker_id, u.name, u.city, u.interests, u.photo
             FROM requests r
@@ -493,12 +501,9 @@ async def list_pending_requests(event_id: int):
             WHERE r.event_id=$1 AND r.status='pending'
             ORDER BY r.created_at ASC
         """, event_id)
-    finally:
-        await conn.close()
 
 async def list_approved_members(event_id: int):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         return await conn.fetch("""
             SELECT r.seeker_id, u.name, u.city, u.interests, u.photo
             FROM requests r
@@ -506,12 +511,9 @@ async def list_approved_members(event_id: int):
             WHERE r.event_id=$1 AND r.status='approved'
             ORDER BY r.created_at ASC
         """, event_id)
-    finally:
-        await conn.close()
 
 async def list_active_conversations_for_user(uid: int):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         return await conn.fetch("""
             SELECT c.id, c.event_id, e.title,
                    CASE WHEN c.organizer_id=$1 THEN c.seeker_id ELSE c.organizer_id END AS other_id,
@@ -523,93 +525,257 @@ async def list_active_conversations_for_user(uid: int):
               AND (c.organizer_id=$1 OR c.seeker_id=$1)
             ORDER BY c.expires_at DESC
         """, uid)
-    finally:
-        await conn.close()
+
+# ---- Кеш активных чатов + буфер сообщений ----
+# Ретрансляция сообщения не ходит в БД: беседа берётся из кеша, сообщение
+# кладётся в буфер и пишется пачкой (по размеру или раз в MSG_FLUSH_SEC).
+MSG_BATCH_SIZE = 50
+MSG_FLUSH_SEC = 2
+HISTORY_PAGE = 20
+CONV_SWEEP_SEC = 60
+
+_conv_cache: dict[int, asyncpg.Record] = {}
+_msg_buffer: list[tuple[int, int, str, datetime]] = []
+_msg_flush_lock = asyncio.Lock()
+
 
 async def get_conversation(conv_id: int):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
-        return await conn.fetchrow("SELECT * FROM conversations WHERE id=$1", conv_id)
-    finally:
-        await conn.close()
+    conv = _conv_cache.get(conv_id)
+    if conv:
+        return conv
+    async with database.db_pool.acquire() as conn:
+        conv = await conn.fetchrow("SELECT * FROM conversations WHERE id=$1", conv_id)
+    if conv and conv['status'] == 'active':
+        _conv_cache[conv_id] = conv
+    return conv
 
 async def get_or_create_conversation(event_id: int, organizer_id: int, seeker_id: int, minutes: int = 30):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         row = await conn.fetchrow("""
             SELECT * FROM conversations
             WHERE event_id=$1 AND organizer_id=$2 AND seeker_id=$3 AND status='active' AND expires_at > now()
             ORDER BY id DESC LIMIT 1
         """, event_id, organizer_id, seeker_id)
-        if row:
-            return row
-        expires = datetime.now(timezone.utc) + timedelta(minutes=minutes)
-        row = await conn.fetchrow("""
-            INSERT INTO conversations (event_id, organizer_id, seeker_id, expires_at)
-            VALUES ($1,$2,$3,$4)
-            RETURNING *
-        """, event_id, organizer_id, seeker_id, expires)
-        return row
-    finally:
-        await conn.close()
+        if not row:
+            expires = datetime.now(timezone.utc) + timedelta(minutes=minutes)
+            row = await conn.fetchrow("""
+                INSERT INTO conversations (event_id, organizer_id, seeker_id, expires_at)
+                VALUES ($1,$2,$3,$4)
+                RETURNING *
+            """, event_id, organizer_id, seeker_id, expires)
+    _conv_cache[row['id']] = row
+    return row
 
 async def close_conversation(conv_id: int, reason: str):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    _conv_cache.pop(conv_id, None)
+    await flush_messages()
+    async with database.db_pool.acquire() as conn:
         await conn.execute("UPDATE conversations SET status=$2 WHERE id=$1",
                            conv_id, 'expired' if reason=='expired' else 'closed')
-    finally:
-        await conn.close()
 
 async def save_message(conv_id: int, sender_id: int, text: str):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
-        await conn.execute("INSERT INTO messages (conv_id, sender_id, text) VALUES ($1,$2,$3)",
-                           conv_id, sender_id, text)
-    finally:
-        await conn.close()
+    # Час ставимо тут, а не DEFAULT now(): у пачці now() однаковий для всіх рядків
+    _msg_buffer.append((conv_id, sender_id, text, datetime.now(timezone.utc)))
+    if len(_msg_buffer) >= MSG_BATCH_SIZE:
+        await flush_messages()
+
+async def flush_messages():
+    async with _msg_flush_lock:
+        if not _msg_buffer:
+            return
+        batch = _msg_buffer[:]
+        del _msg_buffer[:]
+        try:
+            async with database.db_pool.acquire() as conn:
+                await conn.execute("""
+                    INSERT INTO messages (conv_id, sender_id, text, created_at)
+                    SELECT * FROM unnest($1::int[], $2::bigint[], $3::text[], $4::timestamptz[])
+                """, [m[0] for m in batch], [m[1] for m in batch], [m[2] for m in batch], [m[3] for m in batch])
+        except Exception as e:
+            # повертаємо в буфер, спробуємо наступного разу
+            _msg_buffer[:0] = batch
+            logging.warning("flush_messages failed: %s", e)
+
+async def load_last_messages(conv_id: int, limit: int = HISTORY_PAGE, before: datetime | None = None):
+    """Сторінка історії від новіших до старіших; before — created_at найстаршого вже показаного повідомлення"""
+    await flush_messages()
+    async with database.db_pool.acquire() as conn:
+        return await conn.fetch("""
+            SELECT sender_id, text, created_at FROM messages
+            WHERE conv_id=$1 AND ($3::timestamptz IS NULL OR created_at < $3)
+            ORDER BY created_at DESC LIMIT $2
+        """, conv_id, limit, before)
+
+async def messages_flush_loop():
+    while True:
+        await asyncio.sleep(MSG_FLUSH_SEC)
+        await flush_messages()
+
+async def conversations_sweeper_loop():
+    """Раз на хвилину закриваємо всі прострочені чати одним UPDATE і повідомляємо обидві сторони."""
+    while True:
+        try:
+            await flush_messages()
+            async with database.db_pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    UPDATE conversations SET status='expired'
+                    WHERE status='active' AND expires_at <= now()
+                    RETURNING id, organizer_id, seeker_id
+                """)
+            for conv in rows:
+                _conv_cache.pop(conv['id'], None)
+                for uid in (conv['organizer_id'], conv['seeker_id']):
+                    st = user_states.get(uid)
+                    if st and st.get('active_conv_id') == conv['id']:
+                        st['active_conv_id'] = None
+                    try:
+                        await bot.send_message(uid, "⌛ Час чату вичерпано, його завершено. Активні чати — у «📨 Мої чати».")
+                    except Exception:
+                        pass
+        except Exception as e:
+            logging.warning("conversations_sweeper_loop error: %s", e)
+        await asyncio.sleep(CONV_SWEEP_SEC)
 
-async def load_last_messages(conv_id: int, limit: int = 20):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
-        return await conn.fetch(
-            "SELECT sender_id, text, created_at FROM messages WHERE conv_id=$1 ORDER BY created_at DESC LIMIT $2",
-            conv_id, limit
-        )
-    finally:
-        await conn.close()
 # ========= Notifications Logic =========
 
+# ---- Индекс подписок в памяти ----
+# token -> sub ids для keyword/interests, клетка сетки -> sub ids для radius.
+# Новое событие проверяет только подписки по своим словам и по своей клетке,
+# а не все активные строки event_notifications.
+NOTIF_GRID_DEG = 0.1        # ~11 км по широте
+NOTIF_MIN_PREFIX = 2
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class SubscriptionIndex:
+    def __init__(self):
+        self.subs: dict[int, dict] = {}
+        self.by_token: dict[str, set[int]] = {}
+        self.by_cell: dict[tuple[int, int], set[int]] = {}
+
+    @staticmethod
+    def _cell(lat: float, lon: float) -> tuple[int, int]:
+        return int(lat // NOTIF_GRID_DEG), int(lon // NOTIF_GRID_DEG)
+
+    @staticmethod
+    def _phrases(sub: dict) -> list[str]:
+        if sub["type"] == "keyword":
+            return [(sub["keyword"] or "").lower().strip()] if sub["keyword"] else []
+        if sub["type"] == "interests" and sub["interests"]:
+            return [i.strip().lower() for i in sub["interests"].split(",") if i.strip()]
+        return []
+
+    def _keys(self, sub: dict):
+        """Ключи, под которыми подписка лежит в индексе"""
+        if sub["type"] == "radius":
+            if sub["lat"] is None or sub["lon"] is None:
+                return
+            r = sub["radius_km"] or 5
+            dlat = r / 111.0
+            dlon = r / (111.0 * max(cos(radians(sub["lat"])), 0.01))
+            (la0, lo0), (la1, lo1) = self._cell(sub["lat"] - dlat, sub["lon"] - dlon), self._cell(sub["lat"] + dlat, sub["lon"] + dlon)
+            for i in range(la0, la1 + 1):
+                for j in range(lo0, lo1 + 1):
+                    yield self.by_cell, (i, j)
+            return
+        # Первое слово фразы: кандидаты потом проверяются полной подстрокой
+        for phrase in self._phrases(sub):
+            words = _WORD_RE.findall(phrase)
+            if words:
+                yield self.by_token, words[0]
+
+    def add(self, sub) -> None:
+        sub = dict(sub)
+        self.remove(sub["id"])
+        self.subs[sub["id"]] = sub
+        for bucket, key in self._keys(sub):
+            bucket.setdefault(key, set()).add(sub["id"])
+
+    def remove(self, sub_id: int) -> None:
+        sub = self.subs.pop(sub_id, None)
+        if not sub:
+            return
+        for bucket, key in self._keys(sub):
+            ids = bucket.get(key)
+            if ids:
+                ids.discard(sub_id)
+                if not ids:
+                    del bucket[key]
+
+    def match(self, event) -> list[dict]:
+        title = (event.get("title") or "").lower()
+        descr = (event.get("description") or "").lower()
+        lat, lon = event.get("location_lat"), event.get("location_lon")
+
+        # Кандидаты по словам: ключ подписки должен быть префиксом слова события ("футбол" -> "футболу")
+        cand: set[int] = set()
+        for word in set(_WORD_RE.findall(f"{title} {descr}")):
+            for n in range(NOTIF_MIN_PREFIX, len(word) + 1):
+                cand |= self.by_token.get(word[:n], set())
+        if lat is not None and lon is not None:
+            cand |= self.by_cell.get(self._cell(lat, lon), set())
+
+        matched = []
+        for sub_id in cand:
+            sub = self.subs[sub_id]
+            if sub["type"] == "radius":
+                R = 6371
+                d = R * acos(max(-1.0, min(1.0,
+                    cos(radians(sub["lat"])) * cos(radians(lat)) * cos(radians(lon) - radians(sub["lon"])) +
+                    sin(radians(sub["lat"])) * sin(radians(lat))
+                )))
+                ok = d <= (sub["radius_km"] or 5)
+            else:
+                ok = any(p in title or p in descr for p in self._phrases(sub))
+            if ok:
+                matched.append(sub)
+        return matched
+
+
+sub_index = SubscriptionIndex()
+
+
+async def load_subscription_index():
+    async with database.db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT * FROM event_notifications WHERE active = TRUE")
+    for row in rows:
+        sub_index.add(row)
+    logging.info(f"[notif] Subscription index loaded: {len(rows)} active subscriptions")
+
+
 async def add_event_notification(user_id: int, type_: str,
                                  keyword: str | None = None,
                                  lat: float | None = None,
                                  lon: float | None = None,
                                  radius_km: float | None = None,
                                  interests: str | None = None):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
-        await conn.execute("""
+    async with database.db_pool.acquire() as conn:
+        row = await conn.fetchrow("""
             INSERT INTO event_notifications(user_id, type, keyword, lat, lon, radius_km, interests)
             VALUES ($1,$2,$3,$4,$5,$6,$7)
+            RETURNING *
         """, user_id, type_, keyword, lat, lon, radius_km, interests)
-    finally:
-        await conn.close()
+    sub_index.add(row)
+
+
+async def deactivate_subscriptions(sub_ids: list[int]):
+    if not sub_ids:
+        return
+    async with database.db_pool.acquire() as conn:
+        await conn.execute("UPDATE event_notifications SET active=FALSE WHERE id = ANY($1::int[])", sub_ids)
+    for sub_id in sub_ids:
+        sub_index.remove(sub_id)
 
 
 async def deactivate_subscription(sub_id: int):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
-        await conn.execute("UPDATE event_notifications SET active=FALSE WHERE id=$1", sub_id)
-    finally:
-        await conn.close()
+    await deactivate_subscriptions([sub_id])
 
 
 async def reactivate_subscription(sub_id: int):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
-        await conn.execute("UPDATE event_notifications SET active=TRUE WHERE id=$1", sub_id)
-    finally:
-        await conn.close()
+    async with database.db_pool.acquire() as conn:
+        row = await conn.fetchrow("UPDATE event_notifications SET active=TRUE WHERE id=$1 RETURNING *", sub_id)
+    if row:
+        sub_index.add(row)
 
 
 def notification_choice_kb(sub_id: int, event_id: int) -> InlineKeyboardMarkup:
@@ -658,90 +824,41 @@ async def check_event_notifications(event: asyncpg.Record):
     # Для дебагу в логах
     logging.info(f"[notif] New event {event.get('id')} title={event.get('title')}")
 
-    # тягнемо всі активні підписки
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
-        subs = await conn.fetch("SELECT * FROM event_notifications WHERE active = TRUE")
-    finally:
-        await conn.close()
-
-    logging.info(f"[notif] Active subscriptions count = {len(subs)}")
+    matched = sub_index.match(event)
+    logging.info(f"[notif] Matched {len(matched)} of {len(sub_index.subs)} active subscriptions")
 
-    if not subs:
+    if not matched:
         return
 
-    title = (event.get("title") or "").lower()
-    descr = (event.get("description") or "").lower()
-    lat = event.get("location_lat")
-    lon = event.get("location_lon")
-
-    for sub in subs:
-        ok = False
-        reason = ""
+    # деактивуємо всі спрацьовані підписки одним запитом, щоб не спамити
+    await deactivate_subscriptions([sub["id"] for sub in matched])
 
-        # --- keyword ---
-        if sub["type"] == "keyword":
-            kw = (sub["keyword"] or "").lower()
-            if kw and (kw in title or kw in descr):
-                ok = True
-                reason = f"keyword match: {kw}"
-
-        # --- interests ---
-        elif sub["type"] == "interests":
-            if sub["interests"]:
-                interests = [i.strip().lower() for i in sub["interests"].split(",") if i.strip()]
-                if any(i in title or i in descr for i in interests):
-                    ok = True
-                    reason = f"interests match: {interests}"
-
-        # --- radius ---
-        elif sub["type"] == "radius" and lat is not None and lon is not None \
-                and sub["lat"] is not None and sub["lon"] is not None:
-            R = 6371
-            d = R * acos(
-                cos(radians(sub["lat"])) *
-                cos(radians(lat)) *
-                cos(radians(lon) - radians(sub["lon"])) +
-                sin(radians(sub["lat"])) * sin(radians(lat))
+    for sub in matched:
+        try:
+            await bot.send_message(
+                sub["user_id"],
+                "🎉 З’явився новий івент, який може вам підійти!"
             )
-            if d <= (sub["radius_km"] or 5):
-                ok = True
-                reason = f"radius match: dist={d:.2f}km <= {sub['radius_km']}km"
-
-        logging.info(f"[notif] check sub #{sub['id']} type={sub['type']} -> ok={ok} ({reason})")
-
-        if ok:
-            # деактивуємо підписку, щоб не спамити
-            await deactivate_subscription(sub["id"])
-
-            try:
-                await bot.send_message(
-                    sub["user_id"],
-                    "🎉 З’явився новий івент, який може вам підійти!"
-                )
-            except Exception as e:
-                logging.warning(f"[notif] send_message failed for user {sub['user_id']}: {e}")
+        except Exception as e:
+            logging.warning(f"[notif] send_message failed for user {sub['user_id']}: {e}")
 
-            # Надсилаємо повну карточку івенту
-            try:
-                await send_event_cards(sub["user_id"], [event])
-            except Exception as e:
-                logging.warning(f"[notif] send_event_cards failed: {e}")
+        # Надсилаємо повну карточку івенту
+        try:
+            await send_event_cards(sub["user_id"], [event])
+        except Exception as e:
+            logging.warning(f"[notif] send_event_cards failed: {e}")
 
 
 
 # ========= Rating =========
 async def get_organizer_avg_rating(organizer_id: int) -> float | None:
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
-        row = await conn.fetchrow("""
-            SELECT AVG(score)::float AS avg
-            FROM ratings
-            WHERE organizer_id=$1 AND status='done' AND score IS NOT NULL
+    async with database.db_pool.acquire() as conn:
+        return await conn.fetchval("""
+            SELECT rating_sum::float / NULLIF(rating_count, 0)
+            FROM user_stats
+            WHERE user_id=$1
         """, organizer_id)
-        return row["avg"]
-    finally:
-        await conn.close()
+
 
 def rating_kb(event_id: int) -> InlineKeyboardMarkup:
     row1 = [InlineKeyboardButton(text=str(i), callback_data=f"rate:{event_id}:{i}") for i in range(1,6)]
@@ -755,16 +872,16 @@ async def cb_rate(call: types.CallbackQuery):
     event_id, score = int(ev_id_str), int(score_str)
     uid = call.from_user.id
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        ev = await conn.fetchrow("SELECT user_id, title FROM events WHERE id=$1", event_id)
+        async with database.db_pool.acquire() as conn:
+            ev = await conn.fetchrow("SELECT user_id, title FROM events WHERE id=$1", event_id)
+            if ev:
+                await conn.execute("""
+                    INSERT INTO ratings(event_id, organizer_id, seeker_id, score, status)
+                    VALUES ($1,$2,$3,$4,'done')
+                    ON CONFLICT (event_id, seeker_id) DO UPDATE SET score=EXCLUDED.score, status='done'
+                """, event_id, ev['user_id'], uid, score)
         if not ev:
-            await safe_alert(call, "Подію не знайдено."); await conn.close(); return
-        await conn.execute("""
-            INSERT INTO ratings(event_id, organizer_id, seeker_id, score, status)
-            VALUES ($1,$2,$3,$4,'done')
-            ON CONFLICT (event_id, seeker_id) DO UPDATE SET score=EXCLUDED.score, status='done'
-        """, event_id, ev['user_id'], uid, score)
-        await conn.close()
+            await safe_alert(call, "Подію не знайдено."); return
         await safe_alert(call, "Дякуємо за оцінку!", show_alert=False)
         # після оцінки — у головне меню
         await bot.send_message(uid, "Повертаю у головне меню.", reply_markup=main_menu())
@@ -777,15 +894,14 @@ async def cb_rate_skip(call: types.CallbackQuery):
     event_id = int(call.data.split(":")[1])
     uid = call.from_user.id
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        ev = await conn.fetchrow("SELECT user_id FROM events WHERE id=$1", event_id)
-        if ev:
-            await conn.execute("""
-                INSERT INTO ratings(event_id, organizer_id, seeker_id, score, status)
-                VALUES ($1,$2,$3,NULL,'skipped')
-                ON CONFLICT (event_id, seeker_id) DO UPDATE SET score=NULL, status='skipped'
-            """, event_id, ev['user_id'], uid)
-        await conn.close()
+        async with database.db_pool.acquire() as conn:
+            ev = await conn.fetchrow("SELECT user_id FROM events WHERE id=$1", event_id)
+            if ev:
+                await conn.execute("""
+                    INSERT INTO ratings(event_id, organizer_id, seeker_id, score, status)
+                    VALUES ($1,$2,$3,NULL,'skipped')
+                    ON CONFLICT (event_id, seeker_id) DO UPDATE SET score=NULL, status='skipped'
+                """, event_id, ev['user_id'], uid)
         await safe_alert(call, "Зрозуміло, дякуємо!", show_alert=False)
         await bot.send_message(uid, "Повертаю у головне меню.", reply_markup=main_menu())
     except Exception:
@@ -796,13 +912,12 @@ async def cb_rate_skip(call: types.CallbackQuery):
 @dp.message(Command("dbinfo"))
 async def cmd_dbinfo(message: types.Message):
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        row = await conn.fetchrow("""
-            SELECT current_database() AS db, current_user AS usr, current_schema AS sch,
-                   current_setting('server_version') AS ver,
-                   current_setting('TimeZone', true) AS tz;
-        """)
-        await conn.close()
+        async with database.db_pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT current_database() AS db, current_user AS usr, current_schema AS sch,
+                       current_setting('server_version') AS ver,
+                       current_setting('TimeZone', true) AS tz;
+            """)
         await message.answer(
             f"🗄 DB={row['db']}\n👤 user={row['usr']}\n📚 schema={row['sch']}\n"
             f"🐘 pg={row['ver']}\n🌍 tz={row['tz']}"
@@ -889,18 +1004,12 @@ async def cmd_sendto(message: types.Message):
         await message.answer("Не знайшов жодного валідного ID.")
         return
 
-    ok, fail = 0, 0
-    for uid in ids:
-        try:
-            await bot.send_message(uid, body)
-            ok += 1
-        except Exception as e:
-            logging.warning("sendto fail %s: %s", uid, e)
-            fail += 1
-
+    # Шле broadcast_loop (крутиться і тут, і в основному боті): з темпом, чекпоінтами і прогресом у /admin
+    bid, total = await database.create_broadcast(body, user_ids=ids)
     await message.answer(
-        f"✅ Відправлено {ok} користувачам.\n"
-        f"⚠️ З помилкою: {fail}" if fail else f"✅ Відправлено {ok} користувачам без помилок."
+        f"📣 Розсилку #{bid} поставлено в чергу: {total} з {len(ids)} отримувачів.\n"
+        f"(Пропущено тих, кого немає в базі, заблокованих і недосяжних.)" if total < len(ids) else
+        f"📣 Розсилку #{bid} поставлено в чергу: {total} отримувачів."
     )
 
 
@@ -1092,12 +1201,9 @@ async def handle_location(message: types.Message):
 
 # ========= Notifiers for members on change =========
 async def notify_members_event_changed(event_id: int, what: str):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         ev = await conn.fetchrow("SELECT title FROM events WHERE id=$1", event_id)
         rows = await conn.fetch("SELECT seeker_id FROM requests WHERE event_id=$1 AND status='approved'", event_id)
-    finally:
-        await conn.close()
     if not ev: return
     text = f"ℹ️ Подія “{ev['title']}” оновлена: {what}"
     for r in rows:
@@ -1114,7 +1220,8 @@ async def send_event_cards(chat_id: int, rows: list[asyncpg.Record]):
         organizer_name = r.get("organizer_name") or "—"
         org_interests = r.get("organizer_interests") or "—"
         org_count = r.get("org_count") or 0
-        avg = await get_organizer_avg_rating(r['user_id']) if 'user_id' in r else None
+        # Пошукові запити вже віддають org_avg з user_stats — окремий запит лише для інших рядків
+        avg = r['org_avg'] if 'org_avg' in r else (await get_organizer_avg_rating(r['user_id']) if 'user_id' in r else None)
         rating_line = f"\n⭐ Рейтинг орг.: {avg:.1f}/10" if avg else ""
 
         filled = max((r['capacity'] or 0) - (r['needed_count'] or 0), 0)
@@ -1144,12 +1251,9 @@ async def send_event_cards(chat_id: int, rows: list[asyncpg.Record]):
 
 # ========= Collect complete -> notify all =========
 async def notify_collected(event_id: int):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         ev  = await conn.fetchrow("SELECT * FROM events WHERE id=$1", event_id)
         rows = await conn.fetch("SELECT seeker_id FROM requests WHERE event_id=$1 AND status='approved'", event_id)
-    finally:
-        await conn.close()
     if not ev: return
     dt = ev['date'].strftime('%Y-%m-%d %H:%M') if ev['date'] else '—'
     addr = (ev['location'] or '—')
@@ -1157,12 +1261,7 @@ async def notify_collected(event_id: int):
             f"📅 Час: {dt}\n"
             f"📍 Адреса: {addr}\n"
             f"До зустрічі!")
-    ids = [r['seeker_id'] for r in rows] + [ev['user_id']]
-    for uid in ids:
-        try:
-            await bot.send_message(uid, text)
-        except Exception:
-            pass
+    await send_many(bot, [r['seeker_id'] for r in rows] + [ev['user_id']], text)
 
 # ========= Message router (main FSM) =========
 @dp.message(F.text)
@@ -1926,39 +2025,45 @@ async def cb_join(call: types.CallbackQuery):
     event_id = int(call.data.split(":")[1])
     seeker_id = call.from_user.id
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
+        async with database.db_pool.acquire() as conn:
+            # перевіряємо, чи не було заявки раніше
+            existing = await conn.fetchrow(
+                "SELECT id, status FROM requests WHERE event_id=$1 AND seeker_id=$2",
+                event_id, seeker_id
+            )
+            if existing and existing['status'] == 'waitlist':
+                # позиція в черзі — як у /api/events/{id}: (created_at, id) до своєї заявки включно
+                position = await conn.fetchval("""
+                    SELECT COUNT(*) FROM requests w, requests me
+                    WHERE me.id=$1 AND w.event_id=me.event_id AND w.status='waitlist'
+                      AND (w.created_at, w.id) <= (me.created_at, me.id)
+                """, existing['id'])
+            if not existing:
+                # створюємо нову заявку
+                req = await conn.fetchrow(
+                    "INSERT INTO requests (event_id, seeker_id) VALUES ($1,$2) RETURNING id",
+                    event_id, seeker_id
+                )
+                ev = await conn.fetchrow(
+                    "SELECT id, title, user_id FROM events WHERE id=$1",
+                    event_id
+                )
+                seeker = await conn.fetchrow(
+                    "SELECT name, city, interests, photo FROM users WHERE telegram_id::text=$1",
+                    str(seeker_id)
+                )
 
-        # перевіряємо, чи не було заявки раніше
-        existing = await conn.fetchrow(
-            "SELECT id, status FROM requests WHERE event_id=$1 AND seeker_id=$2",
-            event_id, seeker_id
-        )
         if existing:
             st = existing['status']
             msg = (
                 "Заявку вже відправлено, очікуйте відповіді ✅" if st == 'pending'
-                else ("Заявку вже підтверджено. Перейдіть у «📨 Мої чати»" if st == 'approved'
-                      else "На жаль, вашу заявку відхилено.")
+                else "Заявку вже підтверджено. Перейдіть у «📨 Мої чати»" if st == 'approved'
+                else f"🕒 Ви в листі очікування №{position}. Щойно місце звільниться, вас додадуть автоматично." if st == 'waitlist'
+                else "На жаль, вашу заявку відхилено."
             )
             await safe_alert(call, msg, show_alert=False)
-            await conn.close()
             return
 
-        # створюємо нову заявку
-        req = await conn.fetchrow(
-            "INSERT INTO requests (event_id, seeker_id) VALUES ($1,$2) RETURNING id",
-            event_id, seeker_id
-        )
-        ev = await conn.fetchrow(
-            "SELECT id, title, user_id FROM events WHERE id=$1",
-            event_id
-        )
-        seeker = await conn.fetchrow(
-            "SELECT name, city, interests, photo FROM users WHERE telegram_id::text=$1",
-            str(seeker_id)
-        )
-        await conn.close()
-
         await safe_alert(call, "Запит на приєднання надіслано ✅", show_alert=False)
 
         # Додаткове повідомлення пошукачу
@@ -2028,9 +2133,8 @@ async def cb_join(call: types.CallbackQuery):
 async def reminder_decision(req_id: int, organizer_id: int, event_id: int, delay_min: int = 30):
     try:
         await asyncio.sleep(delay_min * 60)
-        conn = await asyncpg.connect(DATABASE_URL)
-        req = await conn.fetchrow("SELECT status FROM requests WHERE id=$1", req_id)
-        await conn.close()
+        async with database.db_pool.acquire() as conn:
+            req = await conn.fetchrow("SELECT status FROM requests WHERE id=$1", req_id)
         if req and req['status'] == 'pending':
             kb = request_actions_kb(req_id)
             try:
@@ -2044,11 +2148,10 @@ async def reminder_decision(req_id: int, organizer_id: int, event_id: int, delay
 async def cb_req_open_chat(call: types.CallbackQuery):
     req_id = int(call.data.split(":")[1])
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        req = await conn.fetchrow("SELECT * FROM requests WHERE id=$1", req_id)
-        if not req: await safe_alert(call, "Заявку не знайдено."); await conn.close(); return
-        ev  = await conn.fetchrow("SELECT id, title, user_id FROM events WHERE id=$1", req['event_id'])
-        await conn.close()
+        async with database.db_pool.acquire() as conn:
+            req = await conn.fetchrow("SELECT * FROM requests WHERE id=$1", req_id)
+            ev  = await conn.fetchrow("SELECT id, title, user_id FROM events WHERE id=$1", req['event_id']) if req else None
+        if not req: await safe_alert(call, "Заявку не знайдено."); return
         if not ev or ev['user_id'] != call.from_user.id:
             await safe_alert(call, "Лише організатор може відкрити чат."); return
 
@@ -2073,59 +2176,49 @@ async def cb_req_open_chat(call: types.CallbackQuery):
 async def cb_approve(call: types.CallbackQuery):
     req_id = int(call.data.split(":")[1])
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        async with conn.transaction():
-            req = await conn.fetchrow("SELECT * FROM requests WHERE id=$1 FOR UPDATE", req_id)
-            if not req:
-                await safe_alert(call, "Заявку не знайдено.")
-                return
-
-            ev = await conn.fetchrow("SELECT * FROM events WHERE id=$1 FOR UPDATE", req['event_id'])
-            if not ev:
-                await safe_alert(call, "Подію не знайдено.")
-                return
-
-            if call.from_user.id != ev['user_id']:
-                await safe_alert(call, "Лише організатор може підтвердити.")
-                return
-
-            if req['status'] == 'approved':
-                await safe_alert(call, "Вже підтверджено.")
-                return
-
-            if req['status'] == 'rejected':
-                await safe_alert(call, "Вже відхилено.")
-                return
-
-            if ev['needed_count'] is not None and ev['needed_count'] <= 0:
-                await safe_alert(call, "Немає вільних місць.")
-                return
-
-            conv = await conn.fetchrow("""
-                SELECT * FROM conversations
-                 WHERE event_id=$1 AND organizer_id=$2 AND seeker_id=$3
-                   AND status='active' AND expires_at > now()
-                 ORDER BY id DESC LIMIT 1
-            """, ev['id'], ev['user_id'], req['seeker_id'])
-
-            if not conv:
-                expires = _now_utc() + timedelta(minutes=30)
-                conv = await conn.fetchrow("""
-                    INSERT INTO conversations (event_id, organizer_id, seeker_id, expires_at)
-                    VALUES ($1,$2,$3,$4) RETURNING *
-                """, ev['id'], ev['user_id'], req['seeker_id'], expires)
-
-            await conn.execute("UPDATE requests SET status='approved' WHERE id=$1", req_id)
-
-            row = await conn.fetchrow("""
-                UPDATE events
-                   SET needed_count = CASE WHEN needed_count > 0 THEN needed_count - 1 ELSE 0 END,
-                       status        = CASE WHEN needed_count <= 1 THEN 'collected' ELSE status END
-                 WHERE id = $1
-                 RETURNING needed_count, status, title, user_id, location, date, id
-            """, ev['id'])
+        async with database.db_pool.acquire() as conn:
+            async with conn.transaction():
+                # Відмову лише запам'ятовуємо: відповідаємо після виходу з транзакції, не тримаючи з'єднання і блокування
+                req = await conn.fetchrow("SELECT * FROM requests WHERE id=$1 FOR UPDATE", req_id)
+                ev = await conn.fetchrow("SELECT * FROM events WHERE id=$1 FOR UPDATE", req['event_id']) if req else None
+                refusal = (
+                    "Заявку не знайдено." if not req
+                    else "Подію не знайдено." if not ev
+                    else "Лише організатор може підтвердити." if call.from_user.id != ev['user_id']
+                    else "Вже підтверджено." if req['status'] == 'approved'
+                    else "Вже відхилено." if req['status'] == 'rejected'
+                    else "Немає вільних місць." if ev['needed_count'] is not None and ev['needed_count'] <= 0
+                    else None
+                )
 
-        await conn.close()
+                if not refusal:
+                    conv = await conn.fetchrow("""
+                        SELECT * FROM conversations
+                         WHERE event_id=$1 AND organizer_id=$2 AND seeker_id=$3
+                           AND status='active' AND expires_at > now()
+                         ORDER BY id DESC LIMIT 1
+                    """, ev['id'], ev['user_id'], req['seeker_id'])
+
+                    if not conv:
+                        expires = _now_utc() + timedelta(minutes=30)
+                        conv = await conn.fetchrow("""
+                            INSERT INTO conversations (event_id, organizer_id, seeker_id, expires_at)
+                            VALUES ($1,$2,$3,$4) RETURNING *
+                        """, ev['id'], ev['user_id'], req['seeker_id'], expires)
+
+                    await conn.execute("UPDATE requests SET status='approved', decided_at=now() WHERE id=$1", req_id)
+
+                    row = await conn.fetchrow("""
+                        UPDATE events
+                           SET needed_count = CASE WHEN needed_count > 0 THEN needed_count - 1 ELSE 0 END,
+                               status        = CASE WHEN needed_count <= 1 THEN 'collected' ELSE status END
+                         WHERE id = $1
+                         RETURNING needed_count, status, title, user_id, location, date, id
+                    """, ev['id'])
+
+        if refusal:
+            await safe_alert(call, refusal)
+            return
 
         new_needed = row['needed_count']
         ev_title   = row['title']
@@ -2176,10 +2269,9 @@ async def cb_approve(call: types.CallbackQuery):
 async def cb_reject(call: types.CallbackQuery):
     req_id = int(call.data.split(":")[1])
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        req = await conn.fetchrow("UPDATE requests SET status='rejected' WHERE id=$1 RETURNING seeker_id, event_id", req_id)
-        ev  = await conn.fetchrow("SELECT id, title, user_id FROM events WHERE id=$1", req['event_id']) if req else None
-        await conn.close()
+        async with database.db_pool.acquire() as conn:
+            req = await conn.fetchrow("UPDATE requests SET status='rejected', decided_at=now() WHERE id=$1 RETURNING seeker_id, event_id", req_id)
+            ev  = await conn.fetchrow("SELECT id, title, user_id FROM events WHERE id=$1", req['event_id']) if req else None
         if not req: await safe_alert(call, "Заявку не знайдено."); return
         if ev and call.from_user.id != ev['user_id']:
             await safe_alert(call, "Лише організатор може відхилити."); return
@@ -2203,7 +2295,7 @@ async def cb_chat_open(call: types.CallbackQuery):
         await safe_alert(call, "Чат прострочено."); return
     user_states.setdefault(uid, {})['active_conv_id'] = conv_id
     await call.answer()
-    msgs = await load_last_messages(conv_id, 20)
+    msgs = await load_last_messages(conv_id, HISTORY_PAGE)
     if msgs:
         transcript = []
         for m in reversed(msgs):
@@ -2215,21 +2307,31 @@ async def cb_chat_open(call: types.CallbackQuery):
 
 @dp.callback_query(F.data.startswith("chat:history:"))
 async def cb_chat_history(call: types.CallbackQuery):
-    conv_id = int(call.data.split(":")[2])
+    # chat:history:<conv_id>[:<created_at найстаршого показаного, мкс>]
+    parts = call.data.split(":")
+    conv_id = int(parts[2])
+    before = datetime.fromtimestamp(int(parts[3]) / 1_000_000, tz=timezone.utc) if len(parts) > 3 else None
     uid = call.from_user.id
     conv = await get_conversation(conv_id)
     if not conv or not (conv['organizer_id']==uid or conv['seeker_id']==uid):
         await safe_alert(call, "Чат недоступний."); return
     await call.answer()
-    msgs = await load_last_messages(conv_id, 20)
+    msgs = await load_last_messages(conv_id, HISTORY_PAGE, before)
     if not msgs:
-        await bot.send_message(uid, "Поки що історія порожня."); return
+        await bot.send_message(uid, "Поки що історія порожня." if not before else "Більше повідомлень немає."); return
     transcript = []
     for m in reversed(msgs):
         who = "Ви" if m['sender_id']==uid else "Співрозмовник"
         ts  = m['created_at'].strftime('%d.%m %H:%M')
         transcript.append(f"[{ts}] {who}: {m['text']}")
-    await bot.send_message(uid, "📜 Останні повідомлення:\n" + "\n".join(transcript))
+    kb = None
+    if len(msgs) == HISTORY_PAGE:
+        oldest_us = int(msgs[-1]['created_at'].timestamp() * 1_000_000)
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="⬅️ Раніше", callback_data=f"chat:history:{conv_id}:{oldest_us}")
+        ]])
+    title = "📜 Останні повідомлення:\n" if not before else "📜 Раніше:\n"
+    await bot.send_message(uid, title + "\n".join(transcript), reply_markup=kb)
 
 @dp.callback_query(F.data.startswith("chat:close:"))
 async def cb_chat_close(call: types.CallbackQuery):
@@ -2263,9 +2365,8 @@ async def stop_chat(message: types.Message):
 @dp.callback_query(F.data.startswith("event:info:"))
 async def cb_event_info(call: types.CallbackQuery):
     ev_id = int(call.data.split(":")[2])
-    conn = await asyncpg.connect(DATABASE_URL)
-    ev = await conn.fetchrow("SELECT * FROM events WHERE id=$1", ev_id)
-    await conn.close()
+    async with database.db_pool.acquire() as conn:
+        ev = await conn.fetchrow("SELECT * FROM events WHERE id=$1", ev_id)
     if not ev:
         await safe_alert(call, "Подію не знайдено."); return
     dt = ev['date'].strftime('%Y-%m-%d %H:%M') if ev['date'] else '—'
@@ -2345,22 +2446,21 @@ async def cb_event_requests(call: types.CallbackQuery):
 async def cb_event_members(call: types.CallbackQuery):
     """Показати підтверджених учасників (і @username, і прямий чат Telegram)."""
     event_id = int(call.data.split(":")[2])
-    conn = await asyncpg.connect(DATABASE_URL)
-    ev = await conn.fetchrow("SELECT id, title, user_id FROM events WHERE id=$1", event_id)
+    async with database.db_pool.acquire() as conn:
+        ev = await conn.fetchrow("SELECT id, title, user_id FROM events WHERE id=$1", event_id)
+        if ev:
+            approved = await conn.fetchrow("""
+                SELECT 1 FROM requests WHERE event_id=$1 AND seeker_id=$2 AND status='approved' LIMIT 1
+            """, event_id, call.from_user.id)
+            rows = await conn.fetch("""
+                SELECT r.seeker_id, u.name, u.city, u.interests, u.photo
+                FROM requests r
+                LEFT JOIN users u ON u.telegram_id::text=r.seeker_id::text
+                WHERE r.event_id=$1 AND r.status='approved'
+                ORDER BY r.created_at ASC
+            """, event_id)
     if not ev:
-        await conn.close(); await safe_alert(call, "Подію не знайдено."); return
-
-    approved = await conn.fetchrow("""
-        SELECT 1 FROM requests WHERE event_id=$1 AND seeker_id=$2 AND status='approved' LIMIT 1
-    """, event_id, call.from_user.id)
-    rows = await conn.fetch("""
-        SELECT r.seeker_id, u.name, u.city, u.interests, u.photo
-        FROM requests r
-        LEFT JOIN users u ON u.telegram_id::text=r.seeker_id::text
-        WHERE r.event_id=$1 AND r.status='approved'
-        ORDER BY r.created_at ASC
-    """, event_id)
-    await conn.close()
+        await safe_alert(call, "Подію не знайдено."); return
 
     if ev['user_id'] != call.from_user.id and not approved:
         await safe_alert(call, "Перегляд учасників недоступний."); return
@@ -2402,11 +2502,9 @@ async def cb_event_orginfo(call: types.CallbackQuery):
     event_id = int(call.data.split(":")[2])
     uid = call.from_user.id
 
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         ev = await conn.fetchrow("SELECT id, title, user_id FROM events WHERE id=$1", event_id)
         if not ev:
-            await conn.close()
             await safe_alert(call, "Подію не знайдено.")
             return
 
@@ -2422,8 +2520,6 @@ async def cb_event_orginfo(call: types.CallbackQuery):
             "SELECT name, city, interests FROM users WHERE telegram_id::text=$1",
             str(ev['user_id'])
         )
-    finally:
-        await conn.close()
 
     if not approved and uid != ev['user_id']:
         await safe_alert(call, "Контакти організатора доступні лише учасникам події.")
@@ -2464,22 +2560,17 @@ async def cb_event_contactorg(call: types.CallbackQuery):
     event_id = int(call.data.split(":")[2])
     uid = call.from_user.id
 
-    try:
-        conn = await asyncpg.connect(DATABASE_URL)
+    async with database.db_pool.acquire() as conn:
         ev = await conn.fetchrow("SELECT id, title, user_id FROM events WHERE id=$1", event_id)
-        if not ev:
-            await conn.close()
-            await safe_alert(call, "Подію не знайдено.")
-            return
-
         approved = await conn.fetchrow("""
             SELECT 1
             FROM requests
             WHERE event_id=$1 AND seeker_id=$2 AND status='approved'
             LIMIT 1
-        """, event_id, uid)
-    finally:
-        await conn.close()
+        """, event_id, uid) if ev else None
+    if not ev:
+        await safe_alert(call, "Подію не знайдено.")
+        return
 
     if not approved and uid != ev['user_id']:
         await safe_alert(call, "Чат з організатором доступний лише учасникам події.")
@@ -2517,9 +2608,8 @@ async def cb_event_contactorg(call: types.CallbackQuery):
 async def cb_event_memberchat(call: types.CallbackQuery):
     event_id, seeker_id = map(int, call.data.split(":")[2:4])
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        ev = await conn.fetchrow("SELECT id, title, user_id FROM events WHERE id=$1", event_id)
-        await conn.close()
+        async with database.db_pool.acquire() as conn:
+            ev = await conn.fetchrow("SELECT id, title, user_id FROM events WHERE id=$1", event_id)
         if not ev:
             await safe_alert(call, "Подію не знайдено."); return
         if ev['user_id'] != call.from_user.id:
@@ -2597,9 +2687,8 @@ async def cb_event_cancel(call: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("event:open:"))
 async def cb_event_open(call: types.CallbackQuery):
     event_id = int(call.data.split(":")[2])
-    conn = await asyncpg.connect(DATABASE_URL)
-    ev = await conn.fetchrow("SELECT needed_count FROM events WHERE id=$1 AND user_id::text=$2", event_id, str(call.from_user.id))
-    await conn.close()
+    async with database.db_pool.acquire() as conn:
+        ev = await conn.fetchrow("SELECT needed_count FROM events WHERE id=$1 AND user_id::text=$2", event_id, str(call.from_user.id))
     if not ev:
         await safe_alert(call, "Подію не знайдено."); return
     if ev['needed_count'] <= 0:
@@ -2614,7 +2703,7 @@ async def cb_event_open(call: types.CallbackQuery):
 async def cb_notif_continue(call: types.CallbackQuery):
     notif_id = int(call.data.split(":")[1])
     try:
-        await activate_notification(notif_id)
+        await reactivate_subscription(notif_id)
         await call.answer("Підписку активовано", show_alert=False)
         await bot.send_message(
             call.from_user.id,
@@ -2630,7 +2719,7 @@ async def cb_notif_continue(call: types.CallbackQuery):
 async def cb_notif_stop(call: types.CallbackQuery):
     notif_id = int(call.data.split(":")[1])
     try:
-        await deactivate_notification(notif_id)
+        await deactivate_subscription(notif_id)
         await call.answer("Відписано", show_alert=False)
         await bot.send_message(
             call.from_user.id,
@@ -2649,26 +2738,27 @@ async def cb_event_leave(call: types.CallbackQuery):
     event_id = int(call.data.split(":")[2])
     seeker_id = call.from_user.id
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        ev = await conn.fetchrow("SELECT id, user_id, title, status FROM events WHERE id=$1", event_id)
+        req = None
+        async with database.db_pool.acquire() as conn:
+            ev = await conn.fetchrow("SELECT id, user_id, title, status FROM events WHERE id=$1", event_id)
+            if ev:
+                req = await conn.fetchrow("""
+                    UPDATE requests SET status='rejected', decided_at=now()
+                    WHERE event_id=$1 AND seeker_id=$2 AND status='approved'
+                    RETURNING id
+                """, event_id, seeker_id)
+            if req:
+                # повернемо одне місце у ліміт
+                await conn.execute("""
+                    UPDATE events
+                       SET needed_count = CASE WHEN needed_count IS NULL THEN 1 ELSE needed_count + 1 END,
+                           status = CASE WHEN status='collected' THEN 'active' ELSE status END
+                     WHERE id=$1
+                """, event_id)
         if not ev:
-            await conn.close(); await safe_alert(call, "Подію не знайдено."); return
-        req = await conn.fetchrow("""
-            UPDATE requests SET status='rejected'
-            WHERE event_id=$1 AND seeker_id=$2 AND status='approved'
-            RETURNING id
-        """, event_id, seeker_id)
+            await safe_alert(call, "Подію не знайдено."); return
         if not req:
-            await conn.close(); await safe_alert(call, "Ви не значитесь серед підтверджених учасників."); return
-
-        # повернемо одне місце у ліміт
-        await conn.execute("""
-            UPDATE events
-               SET needed_count = CASE WHEN needed_count IS NULL THEN 1 ELSE needed_count + 1 END,
-                   status = CASE WHEN status='collected' THEN 'active' ELSE status END
-             WHERE id=$1
-        """, event_id)
-        await conn.close()
+            await safe_alert(call, "Ви не значитесь серед підтверджених учасників."); return
 
         await safe_alert(call, "✅ Ви вийшли з івенту", show_alert=False)
 
@@ -2690,31 +2780,30 @@ async def cb_event_leave(call: types.CallbackQuery):
 
 # ========= Search queries =========
 async def find_events_by_kw(keyword: str, limit: int = 10):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         rows = await conn.fetch("""
             SELECT e.*,
                    u.name AS organizer_name, u.interests AS organizer_interests,
-                   (SELECT COUNT(*) FROM events ev2 WHERE ev2.user_id = e.user_id) AS org_count
+                   COALESCE(us.events_organized, 0) AS org_count,
+                   us.rating_sum::float / NULLIF(us.rating_count, 0) AS org_avg
             FROM events e
             LEFT JOIN users u ON u.telegram_id::text = e.user_id::text
+            LEFT JOIN user_stats us ON us.user_id = e.user_id::bigint
             WHERE e.status='active' AND (e.title ILIKE $1 OR e.description ILIKE $1)
               AND e.date IS NOT NULL AND e.date >= now()
             ORDER BY e.date ASC NULLS LAST, e.id DESC
             LIMIT $2
         """, f"%{keyword}%", limit)
         return rows
-    finally:
-        await conn.close()
 
 async def find_events_near(lat: float, lon: float, radius_km: float, limit: int = 10):
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         rows = await conn.fetch("""
             WITH params AS (SELECT $1::float AS lat, $2::float AS lon, $3::float AS r)
             SELECT e.*,
                    u.name AS organizer_name, u.interests AS organizer_interests,
-                   (SELECT COUNT(*) FROM events ev2 WHERE ev2.user_id = e.user_id) AS org_count,
+                   COALESCE(us.events_organized, 0) AS org_count,
+                   us.rating_sum::float / NULLIF(us.rating_count, 0) AS org_avg,
                    (6371 * acos(
                        cos(radians(p.lat)) * cos(radians(e.location_lat)) *
                        cos(radians(e.location_lon) - radians(p.lon)) +
@@ -2723,6 +2812,7 @@ async def find_events_near(lat: float, lon: float, radius_km: float, limit: int
             FROM events e
             JOIN params p ON true
             LEFT JOIN users u ON u.telegram_id::text = e.user_id::text
+            LEFT JOIN user_stats us ON us.user_id = e.user_id::bigint
             WHERE e.status='active'
               AND e.location_lat IS NOT NULL AND e.location_lon IS NOT NULL
               AND e.date IS NOT NULL AND e.date >= now()
@@ -2735,8 +2825,6 @@ async def find_events_near(lat: float, lon: float, radius_km: float, limit: int
             LIMIT $4
         """, lat, lon, radius_km, limit)
         return rows
-    finally:
-        await conn.close()
 
 async def find_events_by_user_interests(user_id: int, limit: int = 20):
     user = await get_user_from_db(user_id)
@@ -2744,14 +2832,15 @@ async def find_events_by_user_interests(user_id: int, limit: int = 20):
     tokens = [t.strip() for t in user['interests'].split(",") if t.strip()]
     if not tokens: return []
     patterns = [f"%{t}%" for t in tokens]
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with database.db_pool.acquire() as conn:
         rows = await conn.fetch("""
             SELECT e.*,
                    u.name AS organizer_name, u.interests AS organizer_interests,
-                   (SELECT COUNT(*) FROM events ev2 WHERE ev2.user_id = e.user_id) AS org_count
+                   COALESCE(us.events_organized, 0) AS org_count,
+                   us.rating_sum::float / NULLIF(us.rating_count, 0) AS org_avg
             FROM events e
             LEFT JOIN users u ON u.telegram_id::text = e.user_id::text
+            LEFT JOIN user_stats us ON us.user_id = e.user_id::bigint
             WHERE e.status='active'
               AND (e.title ILIKE ANY($1::text[]) OR e.description ILIKE ANY($1::text[]))
               AND e.date IS NOT NULL AND e.date >= now()
@@ -2759,27 +2848,23 @@ async def find_events_by_user_interests(user_id: int, limit: int = 20):
             LIMIT $2
         """, patterns, limit)
         return rows
-    finally:
-        await conn.close()
 
 # ========= Background: auto-finish + rating prompt =========
 async def fini_and_rate_loop():
     """Кожні 2 хв: переносимо минулі active/collected у finished та шлемо оцінку учасникам."""
     while True:
         try:
-            conn = await asyncpg.connect(DATABASE_URL)
-            rows = await conn.fetch("""
-                UPDATE events
-                   SET status='finished'
-                 WHERE date IS NOT NULL AND date < now()
-                   AND status IN ('active','collected')
-                 RETURNING id, user_id, title, date
-            """)
-            await conn.close()
+            async with database.db_pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    UPDATE events
+                       SET status='finished'
+                     WHERE date IS NOT NULL AND date < now()
+                       AND status IN ('active','collected')
+                     RETURNING id, user_id, title, date
+                """)
             for ev in rows:
-                conn2 = await asyncpg.connect(DATABASE_URL)
-                members = await conn2.fetch("SELECT seeker_id FROM requests WHERE event_id=$1 AND status='approved'", ev['id'])
-                await conn2.close()
+                async with database.db_pool.acquire() as conn:
+                    members = await conn.fetch("SELECT seeker_id FROM requests WHERE event_id=$1 AND status='approved'", ev['id'])
                 if not members: continue
                 for m in members:
                     try:
@@ -2796,8 +2881,15 @@ async def fini_and_rate_loop():
 async def main():
     logging.info("Starting polling")
     await init_db()
+    await load_subscription_index()
     asyncio.create_task(fini_and_rate_loop())
-    await dp.start_polling(bot, skip_updates=True)
+    asyncio.create_task(messages_flush_loop())
+    asyncio.create_task(conversations_sweeper_loop())
+    asyncio.create_task(broadcast_loop(bot))
+    try:
+        await dp.start_polling(bot, skip_updates=True)
+    finally:
+        await flush_messages()
 
 if __name__ == "__main__":
     asyncio.run(main())
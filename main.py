@@ -5,6 +5,8 @@ import database
 from datetime import datetime, date
 import pytz # Додали бібліотеку часових поясів
 from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import CommandStart, Command
 from aiogram.types import ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types.web_app_info import WebAppInfo
@@ -12,12 +14,15 @@ from aiogram.types.web_app_info import WebAppInfo
 from config import BOT_TOKEN
 from database import *
 from keyboards import *
-from utils import _now_utc, parse_user_datetime, parse_time_hhmm
+from utils import _now_utc, parse_user_datetime, parse_time_hhmm, normalize_city, CITIES
+from fanout import send_many, send_to, broadcast_loop, FANOUT_RATE
+from safety import event_text, text_key
 
-bot = Bot(token=BOT_TOKEN)
+# TELEGRAM_API_URL дозволяє направити бота на локальний Bot API сервер або заглушку (перевірка розсилок)
+_api_url = os.getenv("TELEGRAM_API_URL")
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(_api_url)) if _api_url else None)
 dp = Dispatcher()
 user_states: dict[int, dict] = {}
-sent_reminders = set()
 
 # === ТВІЙ TELEGRAM ID ДЛЯ ПАНЕЛІ АДМІНА ===
 ADMIN_ID = 275419532 # <-- Зміни на свій ID
@@ -32,6 +37,16 @@ class ActivityMiddleware(BaseMiddleware):
         if user: await update_user_activity(user.id)
         return await handler(event, data)
 
+def forget_deleted_events(event_ids):
+    """Прибирає видалені івенти з ще не показаної частини свайп-стрічок у пам'яті"""
+    gone = set(event_ids)
+    if not gone: return
+    for st in user_states.values():
+        lst = st.get('swipe_list')
+        if not lst: continue
+        cut = st.get('swipe_index', 0) + 1
+        st['swipe_list'] = lst[:cut] + [ev for ev in lst[cut:] if ev['id'] not in gone]
+
 def get_tma_inline_kb():
     # ВСТАВЬ СВОЙ ДОМЕН ИЗ RAILWAY СЮДА
     url = "https://worker-production-784c.up.railway.app/" 
@@ -50,59 +65,111 @@ def get_persistent_tma_kb():
         is_persistent=True
     )
 
+REMINDER_TEXT = {'24h': "24 години", '1h': "1 годину"}
+
 async def reminders_loop():
+    """Фоновий процес: щохвилини забирає нагадування, час яких настав (див. database.claim_due_reminders)"""
     await asyncio.sleep(5) 
     while True:
         try:
-            upcoming = await get_upcoming_reminders()
-            for ev in upcoming:
-                ev_id = ev['id']
-                # Тепер рахуємо час строго за Києвом
-                hours_left = (ev['date'].replace(tzinfo=None) - now_kyiv()).total_seconds() / 3600
-                if 23.5 <= hours_left <= 24.5 and f"{ev_id}_24h" not in sent_reminders:
-                    await send_reminder(ev, "24 години"); sent_reminders.add(f"{ev_id}_24h")
-                elif 0.5 <= hours_left <= 1.5 and f"{ev_id}_1h" not in sent_reminders:
-                    await send_reminder(ev, "1 годину"); sent_reminders.add(f"{ev_id}_1h")
+            due = await database.claim_due_reminders()
+            await asyncio.gather(*(send_reminder(ev, REMINDER_TEXT[ev['kind']]) for ev in due))
         except Exception as e: logging.error(f"Помилка в ремайндер-лупі: {e}")
-        await asyncio.sleep(60 * 10)
+        await asyncio.sleep(60)
+
+FINISH_BATCH = 500
 
 async def finish_events_loop():
-    """Фоновий процес: перевіряє минулі івенти, закриває їх і просить відгуки"""
+    """Фоновий процес: щохвилини закриває минулі івенти (пачкою) і просить відгуки"""
+    domain = os.getenv("RAILWAY_PUBLIC_DOMAIN", "worker-production-784c.up.railway.app")
+    clean_domain = domain.replace("https://", "").replace("http://", "").strip("/")
     while True:
+        finished, rows = 0, []
         if database.db_pool:
             try:
-                past_events = await database.get_past_active_events()
-                for ev in past_events:
-                    # Закриваємо івент
-                    await database.mark_event_finished(ev['id'])
-                    
-                    domain = os.getenv("RAILWAY_PUBLIC_DOMAIN", "worker-production-784c.up.railway.app")
-                    clean_domain = domain.replace("https://", "").replace("http://", "").strip("/")
-
-                    # 1. Пуш ОРГАНІЗАТОРУ (з магічною кнопкою)
-                    markup_org = InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="🌟 Оцінити всіх на 5", callback_data=f"rate_all5:{ev['id']}")],
-                        # ЗМІНЕНО: Тепер веде на окремий екран списку учасників для оцінки
-                        [InlineKeyboardButton(text="🎯 Оцінити вибірково", web_app=WebAppInfo(url=f"https://{clean_domain}/rate_participants.html?event_id={ev['id']}"))]
-                    ])
-
-                    # 2. Пуш УЧАСНИКАМ (щоб оцінили організатора)
-                    participants = await database.get_approved_participants(ev['id'])
-                    for p in participants:
-                        markup_part = InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text="⭐️ Оцінити івент", web_app=WebAppInfo(url=f"https://{clean_domain}/rating.html?event_id={ev['id']}&role=organizer&target_id={ev['user_id']}"))]
-                        ])
-                        try:
-                            await bot.send_message(
-                                p['telegram_id'],
-                                f"👋 Як все пройшло на івенті «{ev['title']}»?\n\nПоділись своїми враженнями та оціни організатора!",
-                                reply_markup=markup_part
-                            )
-                        except Exception: pass
+                # Закриття і постановка прохань оцінити в чергу — один запит; шлемо вже з черги (deferred_pushes),
+                # тож рестарт посеред розсилки лише відкладає пуші до кінця оренди, а не губить їх
+                finished = await database.finish_due_events(FINISH_BATCH)
+                rows = await database.claim_deferred_pushes(FINISH_BATCH, ['finish_rate'])
+                await _send_finish_pushes(rows, clean_domain)
             except Exception as e:
                 logging.error(f"Помилка у finish_events_loop: {e}")
-        
-        await asyncio.sleep(3600) # Перевіряємо щогодини
+        # Після простою могла накопичитись черга — тоді одразу беремо наступну пачку
+        await asyncio.sleep(0 if finished == FINISH_BATCH or len(rows) == FINISH_BATCH else 60)
+
+async def _send_finish_pushes(rows, clean_domain: str):
+    """Пуш УЧАСНИКАМ (щоб оцінили організатора): один fan-out на івент, рядки черги підтверджуємо після нього"""
+    by_event: dict[int, list] = {}
+    for r in rows: by_event.setdefault(r['event_id'], []).append(r)
+    if not by_event: return
+    async with database.db_pool.acquire() as conn:
+        events = {e['id']: e for e in await conn.fetch("SELECT id, title, user_id FROM events WHERE id = ANY($1::int[])", list(by_event))}
+
+    async def one(ev, ev_rows):
+        if ev:
+            markup_part = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⭐️ Оцінити івент", web_app=WebAppInfo(url=f"https://{clean_domain}/rating.html?event_id={ev['id']}&role=organizer&target_id={ev['user_id']}"))]
+            ])
+            await send_many(bot, [r['recipient_id'] for r in ev_rows],
+                            f"👋 Як все пройшло на івенті «{ev['title']}»?\n\nПоділись своїми враженнями та оціни організатора!",
+                            reply_markup=markup_part)
+        await database.done_deferred_pushes(ev_rows)
+
+    await asyncio.gather(*(one(events.get(eid), ev_rows) for eid, ev_rows in by_event.items()))
+
+async def stats_rollup_loop():
+    """Фоновий процес: оновлює щоденні агрегати для /admin"""
+    await asyncio.sleep(30)
+    while True:
+        if database.db_pool:
+            try: await database.refresh_stats_rollup()
+            except Exception as e: logging.error(f"Помилка у stats_rollup_loop: {e}")
+        await asyncio.sleep(60 * 15)
+
+# === РОЗСИЛКИ АДМІНА ===
+def format_broadcast_progress(b) -> str:
+    done = b['sent'] + b['failed'] + b['unreachable']
+    line = f"#{b['id']} [{b['status']}] {done}/{b['total']} (✅ {b['sent']} / ⚠️ {b['failed']} / 🚫 {b['unreachable']})"
+    if b['status'] == 'running':
+        rate = max(min(b['rate'], FANOUT_RATE), 1)  # загальний ліміт fan-out обмежує і розсилку
+        eta = max(b['total'] - done, 0) / rate
+        line += f", {rate}/с, ETA ~{int(eta // 60)} хв {int(eta % 60)} с"
+    return line
+
+_BROADCAST_HELP = ("Формат:\n/broadcast city=kyiv interest=футбол active=30 rate=20\nТекст повідомлення з нового рядка\n\n"
+                   "Всі фільтри необовʼязкові: city — ключ міста (kyiv, lviv...), interest — підрядок інтересів, "
+                   "active — заходив за N днів, ids — 1,2,3 (явний список). /broadcast_cancel <id> — зупинити.")
+
+@dp.message(Command("broadcast"))
+async def broadcast_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("Ця команда доступна лише адміну.")
+    head, _, body = message.text.partition("\n")
+    body = body.strip()
+    if not body: return await message.answer(_BROADCAST_HELP)
+    opts = dict(arg.split("=", 1) for arg in head.split()[1:] if "=" in arg)
+    try:
+        user_ids = [int(x) for x in opts["ids"].replace(";", ",").split(",") if x.strip()] if opts.get("ids") else None
+        active_days = int(opts["active"]) if opts.get("active") else None
+        rate = int(opts.get("rate", database.BROADCAST_RATE))
+    except ValueError:
+        return await message.answer(_BROADCAST_HELP)
+    city = normalize_city(opts["city"]) or opts["city"] if opts.get("city") else None
+    # Невідоме місто дало б 0 отримувачів і "успішну" розсилку в нікуди
+    if city and city not in set(CITIES.values()):
+        return await message.answer(f"❌ Невідоме місто «{opts['city']}». Доступні: {', '.join(sorted(set(CITIES.values())))}")
+    bid, total = await database.create_broadcast(body, city=city, interest=opts.get("interest"), active_days=active_days,
+                                                 user_ids=user_ids, rate=max(1, rate))
+    await message.answer(f"📣 Розсилку #{bid} поставлено в чергу: {total} отримувачів. Прогрес — у /admin.")
+
+@dp.message(Command("broadcast_cancel"))
+async def broadcast_cancel_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("Ця команда доступна лише адміну.")
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit(): return await message.answer("Формат: /broadcast_cancel <id>")
+    ok = await database.cancel_broadcast(int(parts[1]))
+    await message.answer("🛑 Розсилку зупинено." if ok else "Активної розсилки з таким id немає.")
 
 # --- Хендлер магічної кнопки "Оцінити всіх на 5" ---
 @dp.callback_query(F.data.startswith("rate_all5:"))
@@ -110,14 +177,11 @@ async def handle_rate_all_5(call: types.CallbackQuery):
     event_id = int(call.data.split(":")[1])
     participants = await database.get_approved_participants(event_id)
     
-    for p in participants:
-        await database.add_review_and_update_rating(
-            event_id=event_id, 
-            from_user_id=call.from_user.id, 
-            to_user_id=p['telegram_id'], 
-            role_evaluated='participant', 
-            score=5
-        )
+    # Всі оцінки одним запитом
+    try:
+        await database.add_reviews_batch(event_id, call.from_user.id, [(p['telegram_id'], 'participant', 5) for p in participants])
+    except Exception as e:
+        logging.error(f"Помилка пакетного збереження оцінок: {e}")
     
     await call.message.edit_text("✅ Всі учасники отримали по 5 зірок! Дякуємо за твій фідбек.")
     await call.answer()
@@ -125,12 +189,8 @@ async def handle_rate_all_5(call: types.CallbackQuery):
 async def send_reminder(ev: dict, time_str: str):
     title = str(ev['title']).upper()
     text = f"⏰ <b>НАГАДУВАННЯ!</b>\nПодія <b>🎟 {title}</b> почнеться вже через {time_str}!"
-    try: await bot.send_message(ev['user_id'], text, parse_mode="HTML")
-    except: pass
-    participants = await get_approved_participants(ev['id'])
-    for p in participants:
-        try: await bot.send_message(p['telegram_id'], text, parse_mode="HTML")
-        except: pass
+    org = [ev['user_id']] if ev['org_reachable'] else []
+    await send_many(bot, org + list(ev['participants']), text, parse_mode="HTML")
 
 def format_event_card(ev: dict, show_org_link: bool = False) -> str:
     dt_str = ev['date'].strftime('%d.%m.%Y о %H:%M') if ev['date'] else "—"
@@ -191,7 +251,12 @@ async def admin_panel(message: types.Message):
             f"🌟 MAU (за 30 днів): <b>{stats['mau']}</b>\n\n"
             f"🎟 Активних подій: <b>{stats['events']}</b>\n"
             f"📝 Заявок: <b>{stats['requests']}</b>\n"
-            f"🚨 Скарг: <b>{stats['reports']}</b>")
+            f"🚨 Скарг: <b>{stats['reports']}</b>\n\n"
+            f"📈 <b>По днях</b> (нові юзери / івенти / заявки / прийнято):\n")
+    text += "\n".join(f"{d['day'].strftime('%d.%m')}: +{d['new_users']} / +{d['events_created']} / +{d['requests']} / +{d['approvals']}" for d in stats['trend'])
+    broadcasts = await database.get_broadcasts_progress()
+    if broadcasts:
+        text += "\n\n📣 <b>Розсилки:</b>\n" + "\n".join(format_broadcast_progress(b) for b in broadcasts)
     await message.answer(text, parse_mode="HTML")
 
 @dp.message(Command("nuke"))
@@ -308,25 +373,30 @@ async def handle_text(message: types.Message):
 
     if step == 'wait_report_reason':
         ev_id = st.get('report_event_id')
-        await save_report_db(uid, ev_id, text)
+        banned = await save_report_db(uid, ev_id, text)
+        if banned: forget_deleted_events(banned[1])
         await message.answer("✅ Скаргу прийнято! Модератори перевірять цю подію.", reply_markup=main_menu(is_guest=not bool(await get_user_from_db(uid))))
         st['step'] = 'menu'; return
 
     if step == 'wait_welcome_msg':
         event_id = st.get('join_event_id')
         msg_to_org = text if text != "⏭ Пропустити" else "Хочу долучитися!"
-        req_id = await create_join_request(event_id, uid, msg_to_org)
-        if req_id == -1: 
+        req = await create_join_request(event_id, uid, msg_to_org)
+        if not req: 
             await message.answer("⚠️ Ти вже подавав заявку на цей івент!", reply_markup=main_menu(is_guest=False))
+        elif req['status'] == 'waitlist':
+            # Місць немає — організатору нічого вирішувати, місце прийде автоматично
+            await message.answer(f"🕒 Всі місця вже зайняті. Ти в листі очікування під №{req['position']} — щойно місце звільниться, ми тебе автоматично додамо!", reply_markup=main_menu(is_guest=False))
         else:
+            req_id = req['id']
             await message.answer("✅ Заявку відправлено організатору! Очікуй підтвердження.", reply_markup=main_menu(is_guest=False))
             ev = await get_event_by_id(event_id)
             user = await get_user_from_db(uid)
             org_text = (f"🔔 <b>Нова заявка на «{ev['title']}»</b>!\n\n👤 Від: <a href='tg://user?id={uid}'>{user['name']}</a>\n💬 Повідомлення: <i>{msg_to_org}</i>\n\nРішення за тобою:")
             try: 
                 if user.get('photo'): await bot.send_photo(ev['user_id'], photo=user['photo'], caption=org_text, parse_mode="HTML", reply_markup=request_decision_kb(req_id))
-                else: await bot.send_message(ev['user_id'], org_text, parse_mode="HTML", reply_markup=request_decision_kb(req_id))
-            except: pass
+                else: await send_to(bot, ev['user_id'], org_text, parse_mode="HTML", reply_markup=request_decision_kb(req_id))
+            except Exception as e: logging.warning(f"Пуш про заявку {ev['user_id']} не доставлено: {e}")
         st['step'] = 'menu'; return
 
     if "Мої івенти" in text: await message.answer("📦 Обери розділ:", reply_markup=myevents_role_kb()); return
@@ -472,7 +542,7 @@ async def handle_text(message: types.Message):
     if step == 'create_event_review':
         if text == '✅ Опублікувати':
             try:
-                await save_event_to_db(uid, st.get('creator_name',''), "", st['event_title'], st['event_description'], st['event_date'], st.get('event_location',''), st['capacity'], st['needed_count'], 'active', st.get('event_lat'), st.get('event_lon'), st.get('event_photo'))
+                await save_event_to_db(uid, st.get('creator_name',''), "", st['event_title'], st['event_description'], st['event_date'], st.get('event_location',''), st['capacity'], st['needed_count'], 'active', st.get('event_lat'), st.get('event_lon'), st.get('event_photo'), city=st.get('event_city'))
                 await message.answer("🚀 Подія опублікована!", reply_markup=main_menu(is_guest=False))
             except Exception: await message.answer("❌ Помилка публікації", reply_markup=main_menu(is_guest=False))
             st['step'] = 'menu'
@@ -523,7 +593,10 @@ async def mod_approve_callback(call: types.CallbackQuery):
     if not database.db_pool: return
     
     async with database.db_pool.acquire() as conn:
-        await conn.execute("UPDATE events SET status = 'active' WHERE id = $1", event_id)
+        ev = await conn.fetchrow("SELECT title, description, additional_info FROM events WHERE id = $1", event_id)
+        # Запам'ятовуємо схвалений текст: той самий кешований вердикт AI не поверне івент у карантин після правки дати чи місць
+        key = text_key(event_text(ev['title'], ev['description'], ev['additional_info'])) if ev else None
+        await conn.execute("UPDATE events SET status = 'active', safety_approved_key = $2 WHERE id = $1", event_id, key)
         
     await call.message.edit_text(call.message.html_text + "\n\n✅ <b>Схвалено та опубліковано на карті!</b>", parse_mode="HTML")
     await call.answer()
@@ -539,8 +612,7 @@ async def mod_ban_callback(call: types.CallbackQuery):
     async with database.db_pool.acquire() as conn:
         user_id = await conn.fetchval("SELECT user_id FROM events WHERE id = $1", event_id)
         if user_id:
-            await conn.execute("UPDATE users SET status = 'blocked' WHERE telegram_id = $1", user_id)
-            await conn.execute("UPDATE events SET status = 'deleted' WHERE user_id = $1", user_id)
+            forget_deleted_events(await database.ban_user_cascade(user_id, conn))
             await call.message.edit_text(call.message.html_text + f"\n\n❌ <b>Юзера заблоковано, всі його івенти видалено!</b>", parse_mode="HTML")
         else:
             await call.answer("Івент не знайдено в БД", show_alert=True)
@@ -572,19 +644,18 @@ async def approve_request_callback(call: types.CallbackQuery):
     req_id = int(call.data.split(":")[1]); req = await get_request_info(req_id)
     if not req or req['status'] != 'pending': return await call.answer("Заявка вже оброблена.", show_alert=True)
     
-    await update_request_status_db(req_id, 'approved')
-    new_needed = await decrement_needed_count(req['event_id'])
+    res = await approve_request_atomic(req['event_id'], req['seeker_id'])
+    if res['error'] == 'full': return await call.answer("Вільних місць більше немає.", show_alert=True)
+    if not res['ok']: return await call.answer("Заявка вже оброблена.", show_alert=True)
+    new_needed = res['needed_count']
     
     await call.message.edit_text(call.message.html_text + f"\n\n✅ <b>Схвалено!</b>\nНапиши учаснику: <a href='tg://user?id={req['seeker_id']}'>{req['seeker_name']}</a>", parse_mode="HTML")
     
-    try: 
-        kb = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="💬 Написати організатору", url=f"tg://user?id={req['organizer_id']}")]])
-        await bot.send_message(req['seeker_id'], f"🎉 Твою заявку на <b>{req['event_title']}</b> схвалено!\n\nЗв'яжися з організатором, щоб домовитись про деталі:", parse_mode="HTML", reply_markup=kb)
-    except: pass
+    kb = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="💬 Написати організатору", url=f"tg://user?id={req['organizer_id']}")]])
+    await send_to(bot, req['seeker_id'], f"🎉 Твою заявку на <b>{req['event_title']}</b> схвалено!\n\nЗв'яжися з організатором, щоб домовитись про деталі:", parse_mode="HTML", reply_markup=kb)
     
     if new_needed == 0:
-        try: await bot.send_message(req['organizer_id'], f"🥳 <b>Бінго!</b>\n\nТвій івент <b>«{req['event_title']}»</b> повністю зібрано! Вільних місць більше немає.", parse_mode="HTML")
-        except: pass
+        await send_to(bot, req['organizer_id'], f"🥳 <b>Бінго!</b>\n\nТвій івент <b>«{req['event_title']}»</b> повністю зібрано! Вільних місць більше немає.", parse_mode="HTML")
         
     await call.answer()
 
@@ -592,10 +663,9 @@ async def approve_request_callback(call: types.CallbackQuery):
 async def reject_request_callback(call: types.CallbackQuery):
     req_id = int(call.data.split(":")[1]); req = await get_request_info(req_id)
     if not req or req['status'] != 'pending': return await call.answer("Заявка вже оброблена.", show_alert=True)
-    await update_request_status_db(req_id, 'rejected')
+    if not await reject_request_atomic(req['event_id'], req['seeker_id']): return await call.answer("Заявка вже оброблена.", show_alert=True)
     await call.message.edit_text(call.message.html_text + "\n\n❌ <b>Відхилено.</b>", parse_mode="HTML")
-    try: await bot.send_message(req['seeker_id'], f"😕 На жаль, заявку на <b>{req['event_title']}</b> відхилено.", parse_mode="HTML")
-    except: pass
+    await send_to(bot, req['seeker_id'], f"😕 На жаль, заявку на <b>{req['event_title']}</b> відхилено.", parse_mode="HTML")
     await call.answer()
 
 @dp.callback_query(F.data.startswith("rate:"))
@@ -627,7 +697,7 @@ async def myevents_role_callback(call: types.CallbackQuery):
         events = await get_user_participations(uid)
         if not events: 
             return await call.message.edit_text("Ти ще не подавав заявки на майбутні події 🤷‍♂️", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="⬅️ Назад", callback_data="myevents:back")]]))
-        status_emoji = {"pending": "⏳", "approved": "✅"}
+        status_emoji = {"pending": "⏳", "approved": "✅", "waitlist": "🕒"}
         for ev in events[:10]:
             st_emoji = status_emoji.get(ev['req_status'], "❓")
             kb.append([types.InlineKeyboardButton(text=f"{st_emoji} {ev['title']} ({ev['date'].strftime('%d.%m')})", callback_data=f"view_ev:{ev['id']}:part")])
@@ -683,10 +753,8 @@ async def cancel_event_handler(call: types.CallbackQuery):
     ev = await get_event_by_id(ev_id)
     if str(ev['user_id']) != str(call.from_user.id): return await call.answer("Немає доступу!", show_alert=True)
     await cancel_event_db(ev_id)
-    parts = await get_approved_participants(ev_id)
-    for p in parts:
-        try: await bot.send_message(p['telegram_id'], f"⚠️ Організатор на жаль скасував подію <b>{ev['title']}</b>.", parse_mode="HTML")
-        except: pass
+    parts = await get_approved_participants(ev_id, reachable_only=True)
+    asyncio.create_task(send_many(bot, [p['telegram_id'] for p in parts], f"⚠️ Організатор на жаль скасував подію <b>{ev['title']}</b>.", parse_mode="HTML"))
     await call.message.edit_text("❌ Подію успішно скасовано.", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="⬅️ Назад", callback_data="myevents:role:org")]]))
 
 @dp.callback_query(F.data.startswith("leave_ev:"))
@@ -694,11 +762,14 @@ async def leave_event_handler(call: types.CallbackQuery):
     ev_id = int(call.data.split(":")[1])
     req = await get_request_by_event_and_user(ev_id, call.from_user.id)
     if not req: return await call.answer("Заявку не знайдено.", show_alert=True)
-    await cancel_request_db(req['id'], ev_id, req['status'] == 'approved')
+    res = await cancel_request_db(req['id'])
+    if not res['old_status']: return await call.answer("Заявку вже скасовано.", show_alert=True)
     ev = await get_event_by_id(ev_id)
     user = await get_user_from_db(call.from_user.id)
-    try: await bot.send_message(ev['user_id'], f"ℹ️ Учасник <a href='tg://user?id={call.from_user.id}'>{user['name']}</a> скасував свою участь у події <b>{ev['title']}</b>. Місце знову вільне!", parse_mode="HTML")
-    except: pass
+    seat_text = "Місце знову вільне!" if not res['promoted_id'] else "Місце автоматично отримав перший з листа очікування."
+    await send_to(bot, ev['user_id'], f"ℹ️ Учасник <a href='tg://user?id={call.from_user.id}'>{user['name']}</a> скасував свою участь у події <b>{ev['title']}</b>. {seat_text}", parse_mode="HTML")
+    if res['promoted_id']:
+        await send_to(bot, res['promoted_id'], f"🎉 Звільнилося місце! Тебе автоматично додано до події <b>{ev['title']}</b> з листа очікування.", parse_mode="HTML")
     await call.message.edit_text("🚪 Ти успішно скасував свою участь у цій події.", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="⬅️ Назад", callback_data="myevents:role:part")]]))
 
 @dp.callback_query(F.data.startswith("cal:"))
@@ -732,6 +803,8 @@ async def main():
     
     asyncio.create_task(reminders_loop())
     asyncio.create_task(finish_events_loop())
+    asyncio.create_task(stats_rollup_loop())
+    asyncio.create_task(broadcast_loop(bot))
     
     await bot.delete_webhook(drop_pending_updates=True)
     await dp.start_polling(bot)
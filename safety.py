@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import httpx
+
+from moderation import clean_text
+
+# === АСИНХРОННА AI-ПЕРЕВІРКА КОНТЕНТУ ===
+# Івент публікується одразу, а перевірка моделлю йде у фоні: черга + пул воркерів з одним постійним HTTP-клієнтом.
+# Вердикти кешуються за хешем нормалізованого тексту, при збоях моделі спрацьовує запобіжник (circuit breaker).
+# SAFETY_API_URL дозволяє направити перевірку на локальну заглушку замість Gemini.
+
+SAFETY_WORKERS = int(os.getenv("SAFETY_WORKERS", "4"))
+SAFETY_TIMEOUT = float(os.getenv("SAFETY_TIMEOUT", "5"))
+SAFETY_BREAKER_FAILS = int(os.getenv("SAFETY_BREAKER_FAILS", "5"))          # скільки збоїв поспіль відкривають запобіжник
+SAFETY_BREAKER_COOLDOWN = int(os.getenv("SAFETY_BREAKER_COOLDOWN", "60"))   # скільки секунд не ходимо до моделі
+SAFETY_CACHE_SIZE = int(os.getenv("SAFETY_CACHE_SIZE", "5000"))
+
+SAFE, SUSPICIOUS = "safe", "suspicious"
+
+PROMPT = "Перевір текст на наявність пропозицій ескорту, скаму або продажу наркотиків. Відповідай 'SUSPICIOUS' або 'SAFE'. Текст: {text}"
+
+
+def _api_url() -> str | None:
+    url = os.getenv("SAFETY_API_URL")
+    if url: return url
+    api_key = os.getenv("GEMINI_API_KEY", "")
+    if not api_key: return None
+    return f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-09-2025:generateContent?key={api_key}"
+
+
+def text_key(text: str) -> str:
+    """Ключ кешу: однаковий для текстів, що відрізняються лише регістром, пробілами чи невидимими символами"""
+    return hashlib.sha1(" ".join(clean_text(text).split()).encode()).hexdigest()
+
+
+def event_text(title, description, additional_info) -> str:
+    """Текст івенту на перевірку — однаковий при створенні, редагуванні і зіставленні вердикту"""
+    return "\n".join(filter(None, [title, description, additional_info]))
+
+
+class SafetyPipeline:
+    def __init__(self):
+        self.queue: asyncio.Queue | None = None
+        self.client: httpx.AsyncClient | None = None
+        self.cache: OrderedDict[str, str] = OrderedDict()
+        self.inflight: dict[str, asyncio.Future] = {}  # однаковий текст, що вже перевіряється, не шлемо вдруге
+        self.workers: list[asyncio.Task] = []
+        self.on_verdict = None
+        self.fails = 0
+        self.open_until = 0.0
+
+    async def start(self, on_verdict):
+        """on_verdict(job_id, verdict, key) викликається для кожного отриманого вердикту; key — text_key перевіреного тексту"""
+        self.on_verdict = on_verdict
+        self.queue = asyncio.Queue(maxsize=1000)
+        self.client = httpx.AsyncClient(timeout=SAFETY_TIMEOUT, limits=httpx.Limits(max_connections=SAFETY_WORKERS))
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(SAFETY_WORKERS)]
+
+    async def stop(self):
+        for w in self.workers: w.cancel()
+        if self.client: await self.client.aclose()
+
+    def submit(self, job_id, text: str) -> bool:
+        """Ставить текст у чергу на перевірку. Не блокує; False — черга переповнена або пайплайн вимкнено"""
+        if self.queue is None or not text or not _api_url(): return False
+        try:
+            self.queue.put_nowait((job_id, text))
+            return True
+        except asyncio.QueueFull:
+            logging.warning(f"Черга AI-модерації переповнена, пропускаємо {job_id}")
+            return False
+
+    async def check(self, text: str) -> str | None:
+        """SAFE / SUSPICIOUS, або None якщо модель недоступна (тоді нічого не блокуємо)"""
+        key = text_key(text)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key in self.inflight: return await asyncio.shield(self.inflight[key])
+        if time.monotonic() < self.open_until: return None
+        url = _api_url()
+        if not url: return None
+        fut = self.inflight[key] = asyncio.get_running_loop().create_future()
+        verdict = None
+        try:
+            verdict = await self._ask_model(url, text)
+        finally:
+            del self.inflight[key]
+            fut.set_result(verdict)
+        if verdict is not None:
+            self.cache[key] = verdict
+            if len(self.cache) > SAFETY_CACHE_SIZE: self.cache.popitem(last=False)
+        return verdict
+
+    async def _ask_model(self, url: str, text: str) -> str | None:
+        try:
+            resp = await self.client.post(url, json={"contents": [{"parts": [{"text": PROMPT.format(text=text)}]}]})
+            resp.raise_for_status()
+            word = resp.json()['candidates'][0]['content']['parts'][0]['text'].strip().upper()
+        except Exception as e:
+            self.fails += 1
+            if self.fails >= SAFETY_BREAKER_FAILS:
+                # Запобіжник: модель лежить — не тримаємо воркери на таймаутах, пробуємо знову після паузи
+                self.open_until = time.monotonic() + SAFETY_BREAKER_COOLDOWN
+                logging.error(f"AI-модерація недоступна ({e}), пауза {SAFETY_BREAKER_COOLDOWN}с")
+            return None
+        self.fails = 0
+        return SUSPICIOUS if "SUSPICIOUS" in word else SAFE
+
+    async def _worker(self):
+        while True:
+            job_id, text = await self.queue.get()
+            try:
+                verdict = await self.check(text)
+                if verdict is not None and self.on_verdict:
+                    await self.on_verdict(job_id, verdict, text_key(text))
+            except Exception as e:
+                logging.error(f"Помилка воркера AI-модерації: {e}")
+            finally:
+                self.queue.task_done()
+
+
+pipeline = SafetyPipeline()
@@ -14,6 +14,32 @@ MONTHS = {
     "july":7,"august":8,"september":9,"october":10,"november":11,"december":12,
 }
 
+# === СЛОВНИК МІСТ (uk/ru/en написання -> нормалізований ключ) ===
+CITIES = {
+    "київ":"kyiv","киев":"kyiv","kyiv":"kyiv","kiev":"kyiv",
+    "дніпро":"dnipro","днепр":"dnipro","днепропетровск":"dnipro","dnipro":"dnipro","dnepr":"dnipro",
+    "львів":"lviv","львов":"lviv","lviv":"lviv","lvov":"lviv",
+    "одеса":"odesa","одесса":"odesa","odesa":"odesa","odessa":"odesa",
+    "харків":"kharkiv","харьков":"kharkiv","kharkiv":"kharkiv","kharkov":"kharkiv",
+    "запоріжжя":"zaporizhzhia","запорожье":"zaporizhzhia","zaporizhzhia":"zaporizhzhia","zaporozhye":"zaporizhzhia",
+    "вінниця":"vinnytsia","винница":"vinnytsia","vinnytsia":"vinnytsia","vinnitsa":"vinnytsia",
+    "івано-франківськ":"ivano-frankivsk","ивано-франковск":"ivano-frankivsk","ivano-frankivsk":"ivano-frankivsk",
+}
+
+# Як показуємо місто користувачу
+CITY_NAMES = {
+    "kyiv":"Київ","dnipro":"Дніпро","lviv":"Львів","odesa":"Одеса","kharkiv":"Харків",
+    "zaporizhzhia":"Запоріжжя","vinnytsia":"Вінниця","ivano-frankivsk":"Івано-Франківськ",
+}
+
+def normalize_city(text: str | None) -> str | None:
+    """Повертає ключ міста (kyiv, lviv...) з назви або адреси, або None якщо місто невідоме"""
+    if not text: return None
+    # Беремо лише першу частину адреси: "Київ, вул. ..." / "Київ (За геолокацією)"
+    s = str(text).split(',')[0].split('(')[0].strip().lower()
+    s = re.sub(r"^(м|г)\.\s*", "", s)
+    return CITIES.get(s)
+
 def parse_user_datetime(text: str) -> datetime | None:
     """Парсить дату та час, введені користувачем"""
     s = text.strip().lower()